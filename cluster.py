@@ -0,0 +1,172 @@
+"""
+Process the scenes of one or more dates on several nodes sharing a file system.
+
+A producer enqueues one job per scene in a work queue on the shared file system (see utils.work_queue). Any number of
+workers, on any node, claim scenes, download, preprocess and predict them, and store the outputs in the queue folder.
+When all scenes of a date are done, the mosaics are made from the stored outputs.
+
+Usage:
+    python cluster.py enqueue /shared/queue 20210401 [20210402 ...]
+    python cluster.py work /shared/queue            (on each node, as many processes as wanted)
+    python cluster.py status /shared/queue
+    python cluster.py mosaic /shared/queue 20210401
+"""
+import argparse
+import datetime
+import os
+import shutil
+import sys
+
+from utils.work_queue import WorkQueue, run_worker
+
+
+def enqueue(queue, dates):
+    """
+    Add the scenes of dates to the queue
+    Args:
+        queue (WorkQueue): queue
+        dates (list): dates as datetime.datetime
+
+    Returns:
+        (int) number of jobs added
+    """
+    from utils.data_download import get_product_identifiers
+
+    added = 0
+    for date in dates:
+        scenes = get_product_identifiers(date)
+        for scene in scenes:
+            identifier = scene['properties']['title'].replace('.SEN3', '')
+            added += queue.enqueue(identifier, {'date': date.strftime('%Y%m%d'), 'scene': scene})
+        print('{}: {} scenes'.format(date.date(), len(scenes)))
+    return added
+
+
+def make_handler(queue_root, work_dir):
+    """
+    Make the job handler of a worker
+    Args:
+        queue_root (str): queue folder, outputs are stored in its outputs/ subfolder
+        work_dir (str): local folder for downloads and preprocessing
+    """
+
+    def handle(payload):
+        from predict import model_hash, predict
+        from preprocess import convert_sen3
+        from utils.data_download import download_sentinel_data
+
+        scene = payload['scene']
+        identifier = scene['properties']['title'].replace('.SEN3', '')
+        sen3_folder = download_sentinel_data(scene, work_dir)
+        data_channels, transform = convert_sen3(sen3_folder)
+        fsc_tiff, rgb_tiff = predict(*data_channels, identifier, transform)
+
+        # Copy to the shared outputs. Rerunning a job writes the same files, so a worker that lost its lease
+        # can not leave partial outputs behind.
+        out_dir = os.path.join(queue_root, 'outputs', payload['date'])
+        os.makedirs(out_dir, exist_ok=True)
+        result = {'model_sha256': model_hash()}
+        for kind, tiff in (('fsc', fsc_tiff), ('rgb', rgb_tiff)):
+            path = os.path.join(out_dir, os.path.basename(tiff))
+            shutil.copyfile(tiff, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            result[kind] = path
+        return result
+
+    return handle
+
+
+def mosaic(queue, date, out_dir='.'):
+    """
+    Merge the outputs of the finished scenes of a date
+    Args:
+        queue (WorkQueue): queue
+        date (datetime.datetime): date
+        out_dir (str): folder for fsc_YYYYMMDD.tif and rgb_YYYYMMDD.tif
+
+    Returns:
+        (fsc mosaic path, rgb mosaic path) or None if no scenes are done
+    """
+    from utils.rasterio_utils import merge_aligned_tiff_files
+
+    day = date.strftime('%Y%m%d')
+    results = [r['result'] for _, r in sorted(queue.results().items()) if r['payload']['date'] == day]
+    if len(results) == 0:
+        print('No finished scenes for {}'.format(day))
+        return None
+
+    hashes = sorted(set(r['model_sha256'] for r in results))
+    if len(hashes) > 1:
+        print('Warning, the scenes of {} were predicted with different models: {}'.format(day, hashes))
+    tags = {'model_sha256': ','.join(hashes)}
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for kind in ('fsc', 'rgb'):
+        path = os.path.join(out_dir, '{}_{}.tif'.format(kind, day))
+        merge_aligned_tiff_files([r[kind] for r in results], path, no_data_val=-2, tags=tags)
+        paths.append(path)
+    print('Merged {} scenes for {}'.format(len(results), day))
+    return tuple(paths)
+
+
+def parse_date(text):
+    try:
+        return datetime.datetime.strptime(text, "%Y%m%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError('Could not parse date {}'.format(text))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('enqueue', help='Add the scenes of dates to the queue')
+    p.add_argument('queue')
+    p.add_argument('dates', nargs='+', type=parse_date, help='Dates as YYYYMMDD')
+
+    p = commands.add_parser('work', help='Process scenes from the queue')
+    p.add_argument('queue')
+    p.add_argument(
+        '--work-dir',
+        default=os.path.dirname(os.path.abspath(__file__)),
+        help='Local folder for downloads and preprocessing',
+    )
+    p.add_argument('--lease', type=float, default=1800, help='Seconds a worker may go without a heartbeat')
+    p.add_argument('--max-attempts', type=int, default=3)
+    p.add_argument('--poll', type=float, default=30, help='Seconds between checks of an empty queue')
+    p.add_argument('--forever', action='store_true', help='Keep waiting for jobs when the queue is empty')
+
+    p = commands.add_parser('status', help='Show the number of jobs in each state')
+    p.add_argument('queue')
+
+    p = commands.add_parser('mosaic', help='Merge the outputs of a date')
+    p.add_argument('queue')
+    p.add_argument('date', type=parse_date)
+    p.add_argument('--out-dir', default='.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    queue = WorkQueue(args.queue, lease=getattr(args, 'lease', 1800), max_attempts=getattr(args, 'max_attempts', 3))
+
+    if args.command == 'enqueue':
+        print('Added {} jobs'.format(enqueue(queue, args.dates)))
+    elif args.command == 'work':
+        os.makedirs(args.work_dir, exist_ok=True)
+        completed = run_worker(
+            queue,
+            make_handler(args.queue, args.work_dir),
+            poll=args.poll,
+            exit_when_empty=not args.forever,
+        )
+        print('Completed {} jobs'.format(completed))
+    elif args.command == 'status':
+        print(queue.status())
+    elif args.command == 'mosaic':
+        if mosaic(queue, args.date, args.out_dir) is None:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
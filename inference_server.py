@@ -0,0 +1,280 @@
+"""
+Local inference service keeping the model loaded between requests.
+
+Loading torch and the model takes much longer than predicting a scene. The service loads the model once, runs a warm-up
+batch, and then predicts scenes submitted over localhost HTTP. Requests are queued and handled by a single model worker,
+which packs the tiles of all queued scenes (up to --max-batch-scenes) into full batches, see utils.tile_scheduler.
+
+Usage:
+    python inference_server.py --port 8766
+
+Scenes are passed by path, preferably as a model input cube (preprocess.cube.write_cube), which is memory-mapped and
+not copied. Reflectance files are also accepted. From python:
+
+    from inference_server import submit
+    fsc_tif, rgb_tif = submit('http://127.0.0.1:8766', 'workdir/cube/S3A_SL_1_RBT____20210401T090000_....npy')
+
+or with curl:
+
+    curl -X POST -d '{"path": "workdir/cube/S3A_....npy"}' http://127.0.0.1:8766/predict
+
+Outputs are written as by predict.predict (to the tmp folder) and returned as paths. GET /status reports the model hash,
+queue length, scenes per micro-batch and request counts.
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+
+class _Job:
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.submitted = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InferenceWorker:
+    """
+    Owns the model and predicts queued jobs in micro-batches
+    Args:
+        batch_size (int): number of tiles pr model batch
+        max_queue (int): maximum number of waiting jobs, further requests are rejected
+        max_batch_scenes (int): maximum number of scenes predicted together
+        batch_wait (float): seconds to wait for more jobs before predicting a partial set of scenes
+    """
+
+    def __init__(self, batch_size=8, max_queue=32, max_batch_scenes=8, batch_wait=0.05):
+        self.batch_size = batch_size
+        self.max_batch_scenes = max_batch_scenes
+        self.batch_wait = batch_wait
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.stats = {'requests': 0, 'failed': 0, 'rejected': 0, 'scenes_per_batch': []}
+        self._thread = None
+
+    def start(self):
+        from predict import load_model, model_hash
+        from utils.tile_scheduler import TileScheduler
+        import numpy as np
+
+        model = load_model()
+        self.model_hash = model_hash()
+
+        # Run full batches so lazy initialization (CUDA context, kernel selection, allocator growth) is done for the batch
+        # shape before the first request. Images smaller than a patch are predicted whole, without batching.
+        t0 = time.time()
+        scheduler = TileScheduler(model, [512, 512], [128, 128], batch_size=self.batch_size)
+        scheduler.submit('warmup', np.zeros((512, 512 * self.batch_size, 9), dtype='float32'))
+        scheduler.flush()
+        print('Model {} loaded, warm-up took {:.2f} s'.format(self.model_hash, time.time() - t0))
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, job):
+        """
+        Queue a job
+        Returns:
+            (bool) False if the queue is full
+        """
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return False
+        return True
+
+    def _next_jobs(self, block=True):
+        jobs = [self.jobs.get()] if block else []
+        deadline = time.time() + self.batch_wait
+        while len(jobs) < self.max_batch_scenes:
+            try:
+                jobs.append(self.jobs.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self):
+        deferred = []
+        while True:
+            jobs = deferred + self._next_jobs(block=not deferred)
+            # Output files are named after the scene, so one scene is predicted at a time
+            names = set()
+            batch, deferred = [], []
+            for job in jobs:
+                (deferred if job.name in names else batch).append(job)
+                names.add(job.name)
+            self._predict(batch)
+
+    def _predict(self, jobs):
+        from predict import predict_cubes
+        from reinfer import load_scene
+
+        scenes = []
+        for job in jobs:
+            try:
+                scenes.append((job.name,) + load_scene(job.path))
+            except Exception as e:
+                self._finish(job, error='Could not read {}: {}'.format(job.path, e))
+        by_name = {job.name: job for job in jobs if not job.done.is_set()}
+        if len(scenes) == 0:
+            return
+
+        self.stats['scenes_per_batch'].append(len(scenes))
+        try:
+            for name, fsc, rgb in predict_cubes(scenes, self.batch_size):
+                self._finish(by_name.pop(name), result={'fsc': fsc, 'rgb': rgb})
+        except Exception as e:
+            traceback.print_exc()
+            for job in by_name.values():
+                self._finish(job, error='Prediction failed: {}'.format(e))
+
+    def _finish(self, job, result=None, error=None):
+        self.stats['requests'] += 1
+        if error is not None:
+            self.stats['failed'] += 1
+        job.result = result
+        job.error = error
+        job.done.set()
+
+    def status(self):
+        per_batch = self.stats['scenes_per_batch']
+        return {
+            'model_sha256': self.model_hash,
+            'queued': self.jobs.qsize(),
+            'requests': self.stats['requests'],
+            'failed': self.stats['failed'],
+            'rejected': self.stats['rejected'],
+            'mean_scenes_per_batch': sum(per_batch) / len(per_batch) if per_batch else 0.0,
+        }
+
+
+def make_handler(worker, timeout=600):
+    """
+    Make a request handler class for the service
+    Args:
+        worker (InferenceWorker): worker predicting the jobs
+        timeout (float): seconds a request waits for its result
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, obj, status=200):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/status':
+                return self._send_json(worker.status())
+            self._send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            if self.path != '/predict':
+                self.rfile.read(length)
+                return self._send_json({'error': 'not found'}, 404)
+            try:
+                request = json.loads(self.rfile.read(length))
+                path = request['path']
+            except (ValueError, KeyError, TypeError):
+                return self._send_json({'error': 'expected {"path": ..., "name": ...}'}, 400)
+            if not os.path.exists(path):
+                return self._send_json({'error': '{} does not exist'.format(path)}, 400)
+
+            name = request.get('name') or os.path.splitext(os.path.basename(path.rstrip('/')))[0]
+            job = _Job(path, name)
+            if not worker.put(job):
+                return self._send_json({'error': 'queue is full'}, 503)
+            if not job.done.wait(timeout):
+                return self._send_json({'error': 'timed out'}, 504)
+            if job.error is not None:
+                return self._send_json({'error': job.error}, 500)
+            self._send_json(dict(
+                job.result,
+                name=name,
+                model_sha256=worker.model_hash,
+                seconds=time.time() - job.submitted,
+            ))
+
+    return Handler
+
+
+def serve(host='127.0.0.1', port=8766, timeout=600, **kwargs):
+    """
+    Load the model and start the service in a background thread
+    Args:
+        host (str): interface to listen on
+        port (int): port to listen on (0 to pick a free port)
+        timeout (float): seconds a request waits for its result
+        **kwargs: passed on to InferenceWorker
+
+    Returns:
+        (server, url)
+    """
+    worker = InferenceWorker(**kwargs)
+    worker.start()
+    server = ThreadingHTTPServer((host, port), make_handler(worker, timeout))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}'.format(*server.server_address)
+
+
+def submit(url, path, name=None, timeout=600):
+    """
+    Predict a scene with a running service
+    Args:
+        url (str): url of the service
+        path (str): model input cube (.npy) or reflectance file
+        name (None, str): name of the outputs (default: file name of path)
+        timeout (float): seconds to wait
+
+    Returns:
+        (fsc tiff path, rgb tiff path)
+    """
+    body = json.dumps({'path': os.path.abspath(path), 'name': name}).encode('utf-8')
+    request = Request(url.rstrip('/') + '/predict', data=body, headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        result = json.loads(response.read())
+    return result['fsc'], result['rgb']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--batch-size', type=int, default=8, help='Tiles pr model batch')
+    parser.add_argument('--max-queue', type=int, default=32, help='Waiting requests before new ones are rejected')
+    parser.add_argument('--max-batch-scenes', type=int, default=8, help='Scenes predicted together')
+    parser.add_argument('--batch-wait', type=float, default=0.05, help='Seconds to wait for more scenes to batch')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds a request waits for its result')
+    args = parser.parse_args()
+
+    server, url = serve(
+        args.host,
+        args.port,
+        args.timeout,
+        batch_size=args.batch_size,
+        max_queue=args.max_queue,
+        max_batch_scenes=args.max_batch_scenes,
+        batch_wait=args.batch_wait,
+    )
+    print('Serving on {}'.format(url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
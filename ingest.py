@@ -0,0 +1,325 @@
+"""
+Event-driven processing of new Sentinel-3 products.
+
+Watches a landing folder for new products (.SEN3 folders or .zip files) and/or polls the product catalog for scenes of
+the current day. Each new product is preprocessed as soon as it arrives (in a pool of --workers processes), predicted
+with the model held in this process, and added to the mosaics of its date (fsc_YYYYMMDD.tif / rgb_YYYYMMDD.tif in
+--out-dir), so the mosaic of the day is updated scene by scene instead of once the day after.
+
+Products are identified by their product identifier. Processed and failed identifiers are stored in a state file in the
+work folder, so a product is only processed once, also across restarts. Remove a product from the state file to
+process it again.
+
+The peak memory of each product is estimated from its footprint before it is started (see preprocess.admission), and
+products are only started while the sum of the estimates of the running products stays under --memory-gb (budget_gb
+in preprocess/config/preprocess.memory.yml). Products wait in order of arrival until there is room.
+
+Usage:
+    python ingest.py --landing-dir /data/landing --work-dir /data/work --out-dir /data/out
+    python ingest.py --catalog --work-dir /data/work --out-dir /data/out
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+import time
+import traceback
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from reinfer import load_scene, scene_date
+
+
+def product_identifier(path):
+    """Product identifier of a .SEN3 folder or .zip file"""
+    name = os.path.basename(path.rstrip('/'))
+    for suffix in ('.zip', '.SEN3'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def find_products(landing_dir, settle=10.0):
+    """
+    Find products in the landing folder that are completely written
+    Args:
+        landing_dir (str): folder to watch
+        settle (float): seconds without modification before a product is considered complete
+
+    Returns:
+        (dict) product identifier -> path
+    """
+    paths = glob.glob(os.path.join(landing_dir, '*.zip')) + glob.glob(os.path.join(landing_dir, '*.SEN3'))
+    products = {}
+    now = time.time()
+    for path in sorted(paths):
+        try:
+            if os.path.isdir(path):
+                mtime = max([os.path.getmtime(p) for p in glob.glob(os.path.join(path, '*'))] + [os.path.getmtime(path)])
+            else:
+                mtime = os.path.getmtime(path)
+        except OSError:
+            continue  # Removed or renamed while listing
+        if now - mtime >= settle:
+            products[product_identifier(path)] = path
+    return products
+
+
+class IngestState:
+    """
+    Processed products, stored as JSON
+    Args:
+        path (str): state file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.products = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.products = json.load(f)
+
+    def __contains__(self, identifier):
+        return identifier in self.products
+
+    def set(self, identifier, status, **kwargs):
+        self.products[identifier] = dict(kwargs, status=status, time=datetime.datetime.now().isoformat())
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.products, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def prepare_product(source, work_dir, memory_gb=None):
+    """
+    Get a product into the work folder and preprocess it (run in a worker process)
+    Args:
+        source (str, dict): .SEN3 folder, .zip file, or catalog scene (Finder API feature) to download
+        work_dir (str): work folder
+        memory_gb (None, float): memory budget the preprocessing mode is planned with (budget_gb of the memory config
+            if None)
+
+    Returns:
+        (str) path of the model input cube if the product was preprocessed out-of-core, else of the reflectance file
+    """
+    from preprocess import preprocess_sen3
+
+    if isinstance(source, dict):
+        from utils.data_download import download_sentinel_data
+        sen3_folder = download_sentinel_data(source, work_dir)
+    else:
+        identifier = product_identifier(source)
+        safe_folder = os.path.join(work_dir, identifier + '.SAFE')
+        sen3_folder = os.path.join(safe_folder, identifier + '.SEN3')
+        if not os.path.isdir(sen3_folder):
+            tmp_folder = safe_folder + '.tmp'
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            if source.endswith('.zip'):
+                with zipfile.ZipFile(source) as f:
+                    f.extractall(tmp_folder)
+            else:
+                shutil.copytree(source, os.path.join(tmp_folder, identifier + '.SEN3'))
+            shutil.rmtree(safe_folder, ignore_errors=True)
+            os.replace(tmp_folder, safe_folder)
+    ofile = str(preprocess_sen3(sen3_folder, memory_gb=memory_gb))
+    cube = os.path.join(os.path.dirname(sen3_folder), 'cube', product_identifier(sen3_folder) + '.npy')
+    return cube if os.path.isfile(cube) else ofile
+
+
+def update_mosaic(mosaic, scene_tiff, tags=None):
+    """
+    Add a scene to a mosaic (created if missing). Existing mosaic values are kept where they overlap, like when all
+    scenes are merged at once in main.py.
+    """
+    from utils.rasterio_utils import merge_aligned_tiff_files
+
+    if not os.path.isfile(mosaic):
+        shutil.copyfile(scene_tiff, mosaic)
+        return
+    tmp_path = mosaic + '.tmp.tif'
+    merge_aligned_tiff_files([mosaic, scene_tiff], tmp_path, no_data_val=-2, tags=tags)
+    os.replace(tmp_path, mosaic)
+
+
+class Ingestor:
+    """
+    Preprocesses and predicts new products, and updates the daily mosaics
+    Args:
+        work_dir (str): folder to put products and their preprocessing outputs in
+        out_dir (str): folder for the mosaics
+        landing_dir (None, str): folder to watch for new products
+        catalog (bool): poll the product catalog for scenes of the current day
+        workers (int): number of products preprocessed at the same time
+        settle (float): seconds a landing product must be unmodified before it is processed
+        interval (float): seconds between polls
+        memory_gb (None, float): memory budget of the running products (budget_gb of the memory config if None)
+    """
+
+    def __init__(self, work_dir, out_dir, landing_dir=None, catalog=False, workers=2, settle=10.0, interval=60.0,
+                 memory_gb=None):
+        from preprocess import admission, conftools
+
+        self.work_dir = work_dir
+        self.out_dir = out_dir
+        self.landing_dir = landing_dir
+        self.catalog = catalog
+        self.workers = workers
+        self.settle = settle
+        self.interval = interval
+        os.makedirs(work_dir, exist_ok=True)
+        os.makedirs(out_dir, exist_ok=True)
+        self.state = IngestState(os.path.join(work_dir, 'ingest_state.json'))
+        self.running = {}
+        self.waiting = {}
+        self.cfg = conftools.load_directory(admission.CONFIG_PATH.parent)
+        if memory_gb:
+            self.cfg['preprocess']['memory']['budget_gb'] = memory_gb
+        # Passed to the workers, so they plan the same preprocessing mode as the reservation
+        self.memory_gb = self.cfg['preprocess']['memory']['budget_gb']
+        self.estimator = admission.get_estimator(self.cfg)
+        self.budget = admission.MemoryBudget(self.estimator.budget)
+        self.plans = {}
+
+    def poll(self):
+        """
+        Find new products
+        Returns:
+            (dict) identifier -> source for prepare_product
+        """
+        products = {}
+        if self.landing_dir is not None:
+            products.update(find_products(self.landing_dir, self.settle))
+        if self.catalog:
+            from utils.data_download import get_product_identifiers
+            from utils.query_cache import QueryCache
+
+            cache = QueryCache(ttl=datetime.timedelta(seconds=self.interval))
+            try:
+                scenes = get_product_identifiers(datetime.datetime.now(), cache=cache, optimize_coverage=False)
+            except Exception:
+                print('Catalog query failed')
+                traceback.print_exc()
+                scenes = []
+            for scene in scenes:
+                products.setdefault(scene['properties']['title'].replace('.SEN3', ''), scene)
+        return {
+            identifier: source for identifier, source in products.items()
+            if identifier not in self.state and identifier not in self.waiting
+            and identifier not in [running[0] for running in self.running.values()]
+        }
+
+    def reservation(self, identifier, source):
+        """Memory to reserve for a product: its estimated peak, or the whole budget if it can not be estimated"""
+        from preprocess.preprocess import plan_scene
+
+        plan = plan_scene(source, self.cfg)
+        self.plans[identifier] = plan
+        if plan is None:
+            return self.budget.limit or 0
+        print('{}: {} pixels, {} preprocessing, estimated peak {:.1f} GB'.format(
+            identifier, plan.pixels, plan.mode, plan.peak / 2**30))
+        return plan.peak
+
+    def admit(self, pool):
+        """Start waiting products, in order of arrival, while they fit in the memory budget"""
+        for identifier in list(self.waiting):
+            source, reserved = self.waiting[identifier]
+            if not self.budget.try_acquire(reserved):
+                break
+            del self.waiting[identifier]
+            self.running[pool.submit(prepare_product, source, self.work_dir, self.memory_gb)] = (identifier, reserved)
+
+    def finish(self, identifier, ofile, detected):
+        """Predict a preprocessed product and add it to the mosaics of its date"""
+        from predict import model_hash, predict_cube
+        from preprocess.admission import PeakMemory
+
+        with PeakMemory() as peak:
+            data_cube, valid, transform = load_scene(ofile)
+            fsc_tiff, rgb_tiff = predict_cube(data_cube, valid, identifier, transform)
+            del data_cube, valid
+        plan = self.plans.pop(identifier, None)
+        if plan is not None:
+            self.estimator.record(identifier, 'predict', plan.pixels, plan.predict_estimate, peak.peak)
+
+        date = scene_date(identifier) or datetime.date.today()
+        tags = {'model_sha256': model_hash()}
+        mosaics = {}
+        for kind, tiff in (('fsc', fsc_tiff), ('rgb', rgb_tiff)):
+            mosaics[kind] = os.path.join(self.out_dir, '{}_{}.tif'.format(kind, date.strftime('%Y%m%d')))
+            update_mosaic(mosaics[kind], tiff, tags)
+
+        seconds = time.time() - detected
+        self.state.set(identifier, 'done', fsc=fsc_tiff, rgb=rgb_tiff, mosaic=mosaics['fsc'], seconds=seconds)
+        print('Done {} in {:.0f} s'.format(identifier, seconds))
+
+    def run(self, once=False):
+        """
+        Process products as they arrive
+        Args:
+            once (bool): process the products that are present and return
+        """
+        from predict import load_model
+        from preprocess import resources
+
+        load_model()
+        detected = {}
+        initializer, initargs = resources.get_manager().worker_initializer(self.workers)
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=initializer, initargs=initargs) as pool:
+            while True:
+                products = self.poll()
+                if products:
+                    # Estimates from the peaks recorded meanwhile
+                    self.estimator.reload()
+                for identifier, source in products.items():
+                    print('New product {}'.format(identifier))
+                    detected[identifier] = time.time()
+                    self.waiting[identifier] = (source, self.reservation(identifier, source))
+                self.admit(pool)
+
+                if once and len(self.running) == 0:
+                    return
+                if len(self.running) == 0:
+                    time.sleep(self.interval)
+                    continue
+
+                done, _ = wait(list(self.running), timeout=None if once else self.interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    identifier, reserved = self.running.pop(future)
+                    try:
+                        self.finish(identifier, future.result(), detected.pop(identifier))
+                    except Exception as e:
+                        print('Failed {}'.format(identifier))
+                        traceback.print_exc()
+                        self.state.set(identifier, 'failed', error=str(e))
+                    finally:
+                        self.budget.release(reserved)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--landing-dir', default=None, help='Folder to watch for new .SEN3 folders and .zip files')
+    parser.add_argument('--catalog', action='store_true', help='Poll the product catalog for scenes of today')
+    parser.add_argument('--work-dir', default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument('--out-dir', default='.', help='Folder for the daily mosaics')
+    parser.add_argument('--workers', type=int, default=2, help='Products preprocessed at the same time')
+    parser.add_argument('--settle', type=float, default=10.0, help='Seconds a landing product must be unmodified')
+    parser.add_argument('--interval', type=float, default=60.0, help='Seconds between polls')
+    parser.add_argument('--once', action='store_true', help='Process the products present and exit')
+    parser.add_argument('--memory-gb', type=float, default=None, help='Memory budget of the running products')
+    args = parser.parse_args()
+    if args.landing_dir is None and not args.catalog:
+        parser.error('Give --landing-dir and/or --catalog')
+
+    Ingestor(
+        args.work_dir,
+        args.out_dir,
+        args.landing_dir,
+        args.catalog,
+        args.workers,
+        args.settle,
+        args.interval,
+        args.memory_gb,
+    ).run(args.once)
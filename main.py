@@ -1,32 +1,42 @@
-import glob
-import os
-import sys
+import argparse
 import datetime
+import os
 import traceback
 
-from predict import predict
-from preprocess import  convert_sen3
-from utils.data_download import download_sentinel_data, get_product_identifiers
-from utils.output_plot import output_plot
-from utils.rasterio_utils import merge_tiff_files
 
-
-if __name__ == "__main__":
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the snow pipeline (download, preprocessing, prediction, mosaicing) for a date')
+    parser.add_argument(
+        'date',
+        nargs='?',
+        default=None,
+        help='Date to process as YYYYMMDD (default: yesterday). Use DEBUG to process only one scene from yesterday',
+    )
+    args = parser.parse_args(argv)
 
     # Parse selected date
-    debug_flag = False
-    if len(sys.argv) == 2:
-        if sys.argv[1] == 'DEBUG':
-            date = datetime.datetime.now() - datetime.timedelta(days=1)  # Use yesterday as default
-            debug_flag = True
-        else:
-            try:
-                date = datetime.datetime.strptime(sys.argv[1], "%Y%m%d")
-            except ValueError as e:
-                print("Could not parse date")
-                raise e
+    args.debug = False
+    if args.date is None:
+        args.date = datetime.datetime.now() - datetime.timedelta(days=1) #Use yesterday as default
+    elif args.date == 'DEBUG':
+        args.date = datetime.datetime.now() - datetime.timedelta(days=1)  # Use yesterday as default
+        args.debug = True
     else:
-        date = datetime.datetime.now() - datetime.timedelta(days=1) #Use yesterday as default
+        try:
+            args.date = datetime.datetime.strptime(args.date, "%Y%m%d")
+        except ValueError as e:
+            print("Could not parse date")
+            raise e
+    return args
+
+
+def main(date, debug_flag=False):
+    # Heavy modules are imported here (not at module level) to keep CLI help and worker-process spawns fast
+    from predict import model_hash, predict
+    from preprocess import convert_sen3
+    from utils.data_download import download_sentinel_data, get_product_identifiers
+    from utils.output_plot import output_plot
+    from utils.rasterio_utils import merge_aligned_tiff_files
 
     # Find scenes to process
     scenes = get_product_identifiers(date)
@@ -68,10 +78,14 @@ if __name__ == "__main__":
             traceback.print_exc()
 
     # Export tiff
-    rgb_merge = merge_tiff_files(rgb_imgs, 'rgb.tif', no_data_val=-2)
-    fsc_merge = merge_tiff_files(fsc_imgs, 'fsc.tif', no_data_val=-2)
+    tags = {'model_sha256': model_hash()}
+    rgb_merge = merge_aligned_tiff_files(rgb_imgs, 'rgb.tif', no_data_val=-2, tags=tags)
+    fsc_merge = merge_aligned_tiff_files(fsc_imgs, 'fsc.tif', no_data_val=-2, tags=tags)
 
     # Plot images
     output_plot('.', rgb_merge, fsc_merge, 'fsc')
 
 
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.date, args.debug)
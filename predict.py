@@ -1,24 +1,73 @@
 import numpy as np
-import torch
 import os
 
-from utils.data_download import download_file_from_google_drive
 from utils.masking import s3_masking
-from utils.rasterio_utils import to_tiff
-from utils.tiled_prediction import tiled_prediction
-from utils.unet import UNet
 
-#Download trained model
 _model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model.pt')
-if not os.path.isfile(_model_path):
-    download_file_from_google_drive('19b41UQB0ylUIQEeH5I_7UAeyjNl5f31H', _model_path)
-
-#Make tmp-folder
 _tmp_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
-if not os.path.isdir(_tmp_path):
-    os.makedirs(_tmp_path)
 
 has_warned_missing_CUDA = False
+_model = None
+_model_hash = None
+
+
+def init():
+    """
+    Download trained model and make tmp-folder (if they are missing)
+    """
+    if not os.path.isfile(_model_path):
+        from utils.data_download import download_file_from_google_drive
+        download_file_from_google_drive('19b41UQB0ylUIQEeH5I_7UAeyjNl5f31H', _model_path)
+
+    if not os.path.isdir(_tmp_path):
+        os.makedirs(_tmp_path)
+
+
+def load_model():
+    """
+    Load trained model (once) and put it on GPU if available
+    Returns:
+        torch.nn.Module
+    """
+    global has_warned_missing_CUDA, _model
+    if _model is not None:
+        return _model
+
+    import torch
+    from utils.unet import UNet
+
+    init()
+    model = UNet(n_classes=1, in_channels=9, depth=4, use_bn=True, partial_conv=True)
+    model.load_state_dict( torch.load( _model_path , map_location=lambda storage, loc: storage) )
+    try:
+        model.cuda()
+    except:
+        if not has_warned_missing_CUDA:
+            print('Warning, computer is lacking GPU resources. Prediction will be slow')
+            has_warned_missing_CUDA=True
+
+    model.eval()
+    _model = model
+    return _model
+
+def model_hash():
+    """
+    SHA-256 of the model file, used to record which model produced an output
+    Returns:
+        (str) hex digest
+    """
+    global _model_hash
+    if _model_hash is None:
+        import hashlib
+
+        init()
+        sha = hashlib.sha256()
+        with open(_model_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _model_hash = sha.hexdigest()
+    return _model_hash
+
 
 def predict(
     S1_reflectance_an,
@@ -51,10 +100,9 @@ def predict(
     Returns:
         (rbg image, fsc image) - if name is not None, then output is paths to the respective images. Otherwise it is the np.arrays
     """
-    global has_warned_missing_CUDA
+    from preprocess.cube import valid_bits
 
-    name = name.split('/')[-1]
-    data_cube = [
+    bands = [
         S1_reflectance_an,
         S2_reflectance_an,
         S3_reflectance_an,
@@ -65,32 +113,169 @@ def predict(
         S8_BT_in,
         S9_BT_in,
     ]
-    data_cube = [d[:, :, None] for d in data_cube]
-    data_cube = np.concatenate(data_cube,-1)
+    data_cube = np.concatenate([d[:, :, None] for d in bands], -1)
     data_cube[np.isnan(data_cube)] = 0
+    return predict_cube(data_cube, valid_bits(bands), name=name, transform=transform)
 
-    model = UNet(n_classes=1, in_channels=9, depth=4, use_bn=True, partial_conv=True)
-    model.load_state_dict( torch.load( _model_path , map_location=lambda storage, loc: storage) )
-    try:
-        model.cuda()
-    except:
-        if not has_warned_missing_CUDA:
-            print('Warning, computer is lacking GPU resources. Prediction will be slow')
-            has_warned_missing_CUDA=True
 
-    model.eval()
-    fsc = tiled_prediction(data_cube, model, [512, 512], [128, 128]).squeeze()
-    fsc = np.clip(fsc, 0, 100)
+def predict_cube(data_cube, valid=None, name=None, transform=None):
+    """
+    Apply trained model to a H x W x 9 model input cube
+    Args:
+        data_cube (np.array): S1-S6 reflectance and S7-S9 BT bands, missing values set to 0.
+            A read-only np.memmap from preprocess.cube.open_cube is used as is, without copying
+        valid (None, np.array): uint16 bit mask where bit i is set if band i has data (preprocess.cube.valid_bits).
+            If None, pixels where the masking bands are 0 are treated as no data
+        name (None, str): name of product (used for tmp-file generation)
+        transform (rasterio._warp.Affine): geo transform for product
 
-    mask = s3_masking(
-        S8_BT_in,
-        S9_BT_in,
-        S1_reflectance_an,
-        S5_reflectance_an,
-        S7_BT_in,
+    Returns:
+        (rbg image, fsc image) - if name is not None, then output is paths to the respective images. Otherwise it is the np.arrays
+    """
+    from preprocess import resources
+    from utils.tiled_prediction import tiled_prediction
+
+    model = load_model()
+    with resources.stage('predict'):
+        fsc = tiled_prediction(data_cube, model, [512, 512], [128, 128]).squeeze()
+    return _finalize(fsc, data_cube, valid, name, transform)
+
+
+def predict_cubes(scenes, batch_size=8):
+    """
+    Apply trained model to several model input cubes, packing tiles from all of them into full batches
+    Args:
+        scenes (iterable): (name, data_cube, valid, transform) per scene, see predict_cube
+        batch_size (int): number of tiles pr batch
+
+    Returns:
+        generator of (name, fsc image, rgb image) in the order the scenes are completed. The images are paths
+        (written like predict_cube) for scenes with a name
+    """
+    from preprocess import resources
+    from utils.tile_scheduler import TileScheduler
+
+    scheduler = TileScheduler(load_model(), [512, 512], [128, 128], batch_size=batch_size)
+    inputs = {}
+
+    def finalize(finished):
+        for name, fsc in finished:
+            data_cube, valid, transform = inputs.pop(name)
+            yield (name,) + _finalize(fsc.squeeze(), data_cube, valid, name, transform)
+
+    for name, data_cube, valid, transform in scenes:
+        inputs[name] = data_cube, valid, transform
+        with resources.stage('predict'):
+            finished = scheduler.submit(name, data_cube)
+        yield from finalize(finished)
+    with resources.stage('predict'):
+        finished = scheduler.flush()
+    yield from finalize(finished)
+    scheduler.report()
+
+
+def predict_dataset(ds, tiles_per_chunk=2, batch_size=8):
+    """
+    Lazy prediction of a reflectance dataset with dask
+    Args:
+        ds (xarray.Dataset): reflectance dataset, e.g. opened with chunks or returned by preprocessing with
+            persist_output False. Only the chunks needed are read (or computed) when the result is computed
+        tiles_per_chunk (int): patches along each side of a prediction task (chunks of tiles_per_chunk * 256 pixels
+            with a halo of 128 pixels)
+        batch_size (int): number of tiles pr batch
+
+    Returns:
+        (xarray.DataArray) lazy FSC (y, x) as int8 with clouds -1 and no data -2, like the fsc tiffs. It is computed by
+        whatever dask scheduler is configured, and can be written chunk by chunk with write_prediction
+    """
+    import dask.array as da
+    from preprocess.cube import MODEL_BANDS
+    from utils.tiled_prediction import tiled_prediction_dask
+
+    ds = ds[list(MODEL_BANDS)].squeeze(drop=True)
+    if ds.chunks is None or len(ds.chunks) == 0:
+        ds = ds.chunk()
+    bands = [ds[b].data.astype('float32') for b in MODEL_BANDS]
+    valid = da.map_blocks(_block_valid_bits, *bands, dtype='uint16')
+    data_cube = da.stack(bands, -1).rechunk({2: -1})
+    data_cube = da.where(da.isnan(data_cube), np.float32(0), data_cube)
+
+    fsc = tiled_prediction_dask(data_cube, load_model(), [512, 512], [128, 128], 1, tiles_per_chunk, batch_size)
+    # Masking is per pixel, so it is done in the same graph, on the chunks of the prediction
+    data_cube = data_cube.rechunk(fsc.chunks[:2] + (-1,))
+    valid = valid.rechunk(fsc.chunks[:2])
+    fsc = da.blockwise(
+        _mask_block, 'yx', fsc, 'yxc', data_cube, 'yxb', valid, 'yx', dtype='int8', concatenate=True,
     )
+    fsc = ds[MODEL_BANDS[0]].copy(data=fsc).rename('fsc')
+    fsc.attrs = {'model_sha256': model_hash()}
+    fsc.encoding = {}
+    return fsc.rio.write_nodata(-2)
+
+
+def write_prediction(fsc, path, crs=32633):
+    """
+    Write a (lazy) prediction chunk by chunk
+    Args:
+        fsc (xarray.DataArray): output of predict_dataset
+        path (str): .zarr store or GeoTIFF file
+        crs: crs of the grid, if the dataset has none
+    """
+    import threading
+
+    if fsc.rio.crs is None:
+        fsc = fsc.rio.write_crs(crs)
+    if str(path).endswith('.zarr'):
+        fsc.to_dataset().to_zarr(path, mode='w')
+    else:
+        # Chunks are computed in parallel, and written one at a time
+        fsc.rio.to_raster(path, tiled=True, compress='lzw', lock=threading.Lock(), tags=fsc.attrs)
+
+
+def _block_valid_bits(*bands):
+    from preprocess.cube import valid_bits
+
+    return valid_bits(bands)
+
+
+def _mask_block(fsc, data_cube, valid):
+    return _mask_fsc(fsc[:, :, 0], _cloud_mask(data_cube, valid)).astype('int8')
+
+
+def _cloud_mask(data_cube, valid=None):
+    """
+    Cloud mask of a model input cube: 0 = no data, 1 = clouds, 2 = no clouds (see utils.masking.s3_masking)
+    """
+    # Band order S8, S9, S1, S5, S7 of the cube
+    masking_bands = [7, 8, 0, 4, 6]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mask = s3_masking(*[data_cube[:, :, i] for i in masking_bands])
+    if valid is None:
+        no_data = np.any(data_cube[:, :, masking_bands] == 0, -1)
+    else:
+        bits = sum(1 << i for i in masking_bands)
+        no_data = (valid & bits) != bits
+    mask[no_data] = 0
+    return mask
+
+
+def _mask_fsc(fsc, mask):
+    fsc = np.clip(fsc, 0, 100)
     fsc[mask == 1] = -1 #Clouds
     fsc[mask == 0] = -2 #No data
+    return fsc
+
+
+def _finalize(fsc, data_cube, valid, name, transform):
+    """
+    Mask clouds and no data in the model output, make the RGB render, and write both if name is given
+    """
+    from utils.rasterio_utils import to_tiff
+
+    if name is not None:
+        name = name.split('/')[-1]
+    mask = _cloud_mask(data_cube, valid)
+    fsc = _mask_fsc(fsc, mask)
 
     #Make an OK pseudo RGB render
     rgb = np.clip(np.sqrt(data_cube[:, :, [4, 2, 0]]), 0, 1)*100
@@ -100,10 +285,11 @@ def predict(
     # Write to file
     if name is not None:
         fp_fsc = os.path.join(_tmp_path, name + '_fsc.tif')
-        to_tiff(fp_fsc, fsc.astype("int8"), transform, no_data_val=-2)
+        tags = {'model_sha256': model_hash()}
+        to_tiff(fp_fsc, fsc.astype("int8"), transform, no_data_val=-2, tags=tags)
 
         fp_rgb = os.path.join(_tmp_path, name + '_rgb.tif')
-        to_tiff(fp_rgb,rgb.astype("int8"), transform, no_data_val=-2)
+        to_tiff(fp_rgb,rgb.astype("int8"), transform, no_data_val=-2, tags=tags)
 
         return fp_fsc, fp_rgb
     #Or return np.arrays
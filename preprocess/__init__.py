@@ -4,9 +4,31 @@ This package contains code to preprocess .SEN3 files to get arrays with reflecta
 from pathlib import Path
 
 from preprocess.conftools import Config
+from preprocess.cube import open_cube, write_cube
 from preprocess.preprocess import preprocess, read_ofile
 import os
 
+def preprocess_sen3(sen3_file, overwrite=False, memory_gb=None):
+    """
+    Preprocess a sentinel3 product with the default configuration, next to the product
+    Args:
+        sen3_file: path of .SEN3 folder
+        overwrite (bool): redo existing outputs
+        memory_gb (None, float): memory budget that decides between in-memory and out-of-core preprocessing
+            (budget_gb of preprocess.memory.yml if None)
+
+    Returns:
+        Path of reflectance file
+    """
+    sen3_file = Path(sen3_file)
+    cfg = conftools.load_directory(Path(__file__).parent / "config")
+    cfg['workdir'] = sen3_file.parents[0]
+    cfg['tmpdir'] = sen3_file.parents[0]
+    if memory_gb:
+        cfg['preprocess']['memory']['budget_gb'] = memory_gb
+    return preprocess(sen3_file, cfg, overwrite=overwrite)
+
+
 def convert_sen3(sen3_file):
     """
     Convert sentinel3 data to reflectance
@@ -30,11 +52,7 @@ def convert_sen3(sen3_file):
         Affine transform
 
     """
-    sen3_file = Path(sen3_file)
-    cfg = conftools.load_directory(Path(__file__).parent / "config")
-    cfg['workdir'] = sen3_file.parents[0]
-    cfg['tmpdir'] = sen3_file.parents[0]
-    ofile = preprocess(sen3_file, cfg, overwrite=False)
+    ofile = preprocess_sen3(sen3_file)
 
     data_channels, s3_transform = read_ofile(ofile)
 
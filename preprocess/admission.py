@@ -0,0 +1,514 @@
+"""Memory admission control for scenes processed at the same time
+
+The memory a scene needs grows with its output grid, which varies a lot
+between scenes. The peak resident memory of each mode (``fused`` and
+``chunked`` preprocessing, ``predict``) is modelled as
+
+    peak = base + bytes_per_value * pixels * bands
+
+where ``pixels`` is the size of the output grid, computed from the manifest
+footprint with the same area of interest and tiling as the reprojection,
+before anything is read. The initial coefficients come from
+``preprocess.memory.yml``. Every processed scene records its estimated and
+actual peak in a history file, and the coefficients are refitted from it.
+
+Scenes that need a large share of the memory are preprocessed out-of-core
+(step by step through files, with a memory-mapped model input cube), and
+:class:`MemoryBudget` only admits scenes while the sum of their estimates
+stays under the configured budget.
+"""
+import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+import attr
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+CONFIG_PATH = Path(__file__).parent / "config" / "preprocess.memory.yml"
+DEFAULT_HISTORY = Path(__file__).resolve().parents[1] / "cache" / "memory_history.jsonl"
+
+MB = 2**20
+GB = 2**30
+
+# Estimators by memory settings, so the history file is only read again when it changes
+_estimators = {}
+# PeakMemory blocks running in this process
+_active_peaks = set()
+_peaks_lock = threading.Lock()
+
+
+def physical_memory():
+    """Total physical memory in bytes"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def current_rss():
+    """Resident memory of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as fid:
+            return int(fid.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+
+        # Peak instead of current, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _read_hwm():
+    with open("/proc/self/status") as fid:
+        for line in fid:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("No VmHWM in /proc/self/status")
+
+
+class PeakMemory:
+    """Peak resident memory of the process inside a with block
+
+    On Linux the kernel high water mark is reset on entry and read on exit,
+    so short peaks are not missed. Elsewhere the resident memory is sampled
+    by a thread every ``interval`` seconds.
+
+    Both measure the whole process, so a peak is only the peak of a scene if
+    the process handles one scene at a time (like the preprocessing workers
+    of ingest.py). The high water mark is shared by all threads, and
+    resetting it for one block spoils the peak of any other block running at
+    the same time. Blocks that overlap with another block in the same
+    process therefore get no peak.
+
+    Attributes
+    ----------
+    peak : int or None
+        Peak resident memory in bytes, set on exit. None if another block
+        ran in the process at the same time.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = None
+        self._hwm = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._overlapped = False
+
+    def __enter__(self):
+        with _peaks_lock:
+            for other in _active_peaks:
+                other._overlapped = True
+            self._overlapped = bool(_active_peaks)
+            _active_peaks.add(self)
+        try:
+            with open("/proc/self/clear_refs", "w") as fid:
+                fid.write("5")
+            _read_hwm()
+            self._hwm = True
+        except OSError:
+            self.peak = current_rss()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        if self._hwm:
+            self.peak = _read_hwm()
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss())
+        with _peaks_lock:
+            _active_peaks.discard(self)
+            if self._overlapped:
+                _logger.debug("Peak memory not recorded: another measurement ran in the process at the same time")
+                self.peak = None
+        return False
+
+
+@attr.s
+class MemoryModel:
+    """Linear model of the peak memory
+
+    Parameters
+    ----------
+    base : float
+        Bytes independent of the scene size
+    per_value : float
+        Bytes per value (output pixel and band)
+    """
+    base = attr.ib(converter=float)
+    per_value = attr.ib(converter=float)
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(cfg.get("base_mb", 0) * MB, cfg.get("bytes_per_value", 4))
+
+    def estimate(self, values):
+        return self.base + self.per_value * values
+
+    def fit(self, values, peaks, min_records=3):
+        """Model refitted to recorded peaks
+
+        Least squares is used if the records span a range of scene sizes.
+        Otherwise, or if the fit is not physical, the model is scaled to the
+        median ratio of the recorded peaks to its estimates.
+
+        Parameters
+        ----------
+        values : array_like
+            Values (pixels times bands) of the records
+        peaks : array_like
+            Peak memory of the records in bytes
+        min_records : int
+            Keep this model with fewer records
+
+        Returns
+        -------
+        MemoryModel
+        """
+        values = np.asarray(values, dtype="float64")
+        peaks = np.asarray(peaks, dtype="float64")
+        ok = (values > 0) & (peaks > 0)
+        values, peaks = values[ok], peaks[ok]
+        if len(values) < max(min_records, 1):
+            return self
+        if len(values) >= 2 and np.ptp(values) > 0.2 * values.mean():
+            a = np.stack([np.ones_like(values), values], 1)
+            (base, per_value), *_ = np.linalg.lstsq(a, peaks, rcond=None)
+            if base >= 0 and per_value > 0:
+                return MemoryModel(base, per_value)
+        scale = np.median(peaks / self.estimate(values))
+        return MemoryModel(self.base * scale, self.per_value * scale)
+
+
+DEFAULT_MODELS = {
+    "fused": MemoryModel(800 * MB, 12),
+    "chunked": MemoryModel(800 * MB, 4),
+    "predict": MemoryModel(1000 * MB, 16),
+}
+
+
+@attr.s
+class Plan:
+    """How to process a scene
+
+    Parameters
+    ----------
+    pixels : int
+        Output grid size (width x height)
+    mode : str
+        ``fused`` or ``chunked`` preprocessing
+    estimate : float
+        Estimated peak memory of preprocessing in bytes
+    predict_estimate : float
+        Estimated peak memory of prediction in bytes
+    out_of_core : bool
+        The scene is too large for the configured fused pipeline and is
+        preprocessed chunked instead
+    """
+    pixels = attr.ib()
+    mode = attr.ib()
+    estimate = attr.ib()
+    predict_estimate = attr.ib()
+    out_of_core = attr.ib(default=False)
+
+    @property
+    def peak(self):
+        """Memory to reserve for the scene"""
+        return max(self.estimate, self.predict_estimate)
+
+
+def source_footprint(source):
+    """Footprint metadata of a product
+
+    Parameters
+    ----------
+    source : str, Path or dict
+        .SEN3 folder, .zip file or manifest, or catalog feature (GeoJSON) of a product
+
+    Returns
+    -------
+    dict
+        footprint (WKT) and footprint_srs, as in the manifest metadata
+    """
+    if isinstance(source, dict):
+        import shapely.geometry
+
+        return {"footprint": shapely.geometry.shape(source["geometry"]).wkt, "footprint_srs": "EPSG:4326"}
+    from preprocess.manifest import get_xmltree, parse_footprint
+
+    footprint, srs = parse_footprint(get_xmltree(source))
+    return {"footprint": footprint, "footprint_srs": srs}
+
+
+def scene_pixels(source, rcfg):
+    """Output grid size of a product, from its footprint
+
+    Parameters
+    ----------
+    source : str, Path or dict
+        Product, see source_footprint
+    rcfg : Config
+        reproject config
+
+    Returns
+    -------
+    int
+        Width x height of the output grid
+    """
+    from preprocess.preprocess_reproject import extent_shape, footprint_bounds, snap_extent
+
+    bounds = footprint_bounds(source_footprint(source), rcfg.crs)
+    if bounds is None:
+        raise ValueError(f"No usable footprint for {source}")
+    margin = rcfg.get("extent_margin", 0)
+    bounds = (bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+    width, height = extent_shape(snap_extent(bounds, rcfg), rcfg)
+    return width * height
+
+
+class MemoryEstimator:
+    """Peak memory estimates, refined from recorded peaks
+
+    Parameters
+    ----------
+    models : dict
+        MemoryModel per mode
+    bands : int
+        Variables per output pixel while preprocessing
+    budget : float
+        Memory budget in bytes (None for no admission control)
+    out_of_core_fraction : float
+        Share of the budget (or of the physical memory) above which scenes
+        are preprocessed out-of-core
+    safety_factor : float
+        Factor applied to the estimates
+    history : str or Path
+        JSON lines file with the recorded peaks (None to not record)
+    history_size : int
+        Number of most recent records of a mode used for the fit
+    min_records : int
+        Records of a mode needed before its model is refitted
+    """
+
+    def __init__(self, models, bands=16, budget=None, out_of_core_fraction=0.5, safety_factor=1.2,
+                 history=DEFAULT_HISTORY, history_size=200, min_records=3):
+        self.defaults = dict(models)
+        self.models = dict(models)
+        self.bands = bands
+        self.budget = budget
+        self.out_of_core_fraction = out_of_core_fraction
+        self.safety_factor = safety_factor
+        self.history = Path(history) if history is not None else None
+        self.history_size = history_size
+        self.min_records = min_records
+        self._stamp = None
+        self.reload()
+
+    @classmethod
+    def from_config(cls, cfg):
+        budget = cfg.get("budget_gb", None)
+        models = dict(DEFAULT_MODELS)
+        models.update({mode: MemoryModel.from_config(mcfg) for mode, mcfg in (cfg.get("models", None) or {}).items()})
+        return cls(
+            models=models,
+            bands=cfg.get("bands", 16),
+            budget=budget * GB if budget else None,
+            out_of_core_fraction=cfg.get("out_of_core_fraction", 0.5),
+            safety_factor=cfg.get("safety_factor", 1.2),
+            history=cfg.get("history", None) or DEFAULT_HISTORY,
+            history_size=cfg.get("history_size", 200),
+            min_records=cfg.get("min_records", 3),
+        )
+
+    def _bands(self, mode):
+        if mode == "predict":
+            from preprocess.cube import MODEL_BANDS
+
+            return len(MODEL_BANDS)
+        return self.bands
+
+    def _history_stamp(self):
+        try:
+            stat = self.history.stat()
+        except (AttributeError, OSError):
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def refresh(self):
+        """Refit the models if the history file changed since it was read"""
+        if self._history_stamp() != self._stamp:
+            self.reload()
+
+    def reload(self):
+        """Refit the models to the history file"""
+        self._stamp = self._history_stamp()
+        if self._stamp is None:
+            return
+        records = {}
+        with open(self.history) as fid:
+            for line in fid:
+                try:
+                    record = json.loads(line)
+                    records.setdefault(record["mode"], []).append(
+                        (record["pixels"] * self._bands(record["mode"]), record["peak"])
+                    )
+                except (ValueError, KeyError, TypeError):
+                    continue  # Partly written line
+        for mode, default in self.defaults.items():
+            recent = records.get(mode, [])[-self.history_size:]
+            if recent:
+                values, peaks = zip(*recent)
+                self.models[mode] = default.fit(values, peaks, self.min_records)
+                _logger.debug("Memory model %s from %d records: %s", mode, len(recent), self.models[mode])
+
+    def estimate(self, mode, pixels):
+        """Estimated peak memory in bytes of a mode for an output grid size"""
+        return self.safety_factor * self.models[mode].estimate(pixels * self._bands(mode))
+
+    @property
+    def out_of_core_limit(self):
+        """Estimate above which scenes are preprocessed out-of-core"""
+        total = self.budget or physical_memory()
+        return None if total is None else self.out_of_core_fraction * total
+
+    def plan(self, source, cfg):
+        """Choose the preprocessing mode of a product and estimate its memory
+
+        Parameters
+        ----------
+        source : str, Path or dict
+            Product, see source_footprint
+        cfg : Config
+            Config with the preprocess settings
+
+        Returns
+        -------
+        Plan
+        """
+        from preprocess import conftools as ct
+
+        pixels = scene_pixels(source, cfg["preprocess"]["reproject"])
+        fused = cfg["preprocess"].get("pipeline", ct.Config()).get("fused", False)
+        mode = "chunked"
+        if fused:
+            limit = self.out_of_core_limit
+            if limit is None or self.estimate("fused", pixels) <= limit:
+                mode = "fused"
+        return Plan(
+            pixels,
+            mode,
+            self.estimate(mode, pixels),
+            self.estimate("predict", pixels),
+            out_of_core=fused and mode == "chunked",
+        )
+
+    def record(self, identifier, mode, pixels, estimate, peak):
+        """Store the estimated and actual peak memory of a processed scene
+
+        Nothing is stored without a peak (see PeakMemory).
+        """
+        if peak is None:
+            return
+        _logger.info(
+            "%s %s: estimated %.2f GB, peak %.2f GB", identifier, mode, estimate / GB, peak / GB
+        )
+        if self.history is None:
+            return
+        record = dict(
+            time=datetime.datetime.now().isoformat(),
+            identifier=identifier,
+            mode=mode,
+            pixels=int(pixels),
+            estimate=int(estimate),
+            peak=int(peak),
+        )
+        self.history.parent.mkdir(parents=True, exist_ok=True)
+        # A single short append, so concurrent processes do not interleave lines
+        with open(self.history, "a") as fid:
+            fid.write(json.dumps(record) + "\n")
+
+
+class MemoryBudget:
+    """Admission of work while the sum of the reservations stays under a limit
+
+    Work larger than the whole budget is admitted when nothing else runs.
+    Thread safe.
+
+    Parameters
+    ----------
+    limit : float
+        Budget in bytes (None: admit everything)
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, nbytes):
+        return self.limit is None or self.count == 0 or self.used + nbytes <= self.limit
+
+    def try_acquire(self, nbytes):
+        """Reserve memory if it fits in the budget
+
+        Returns
+        -------
+        bool
+            True if the reservation was made
+        """
+        with self._cond:
+            if not self._fits(nbytes):
+                return False
+            self.used += nbytes
+            self.count += 1
+            return True
+
+    def acquire(self, nbytes, timeout=None):
+        """Wait until the memory fits in the budget and reserve it"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fits(nbytes), timeout):
+                return False
+            self.used += nbytes
+            self.count += 1
+            return True
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self.count -= 1
+            self._cond.notify_all()
+
+
+def get_estimator(cfg=None):
+    """Memory estimator from the memory settings of a config, or from preprocess.memory.yml
+
+    Estimators are cached per settings (including the history file), and
+    refitted when the history file has changed.
+    """
+    from preprocess import conftools as ct
+
+    if cfg is not None and "memory" in cfg.get("preprocess", {}):
+        mcfg = cfg["preprocess"]["memory"]
+        key = json.dumps(mcfg, sort_keys=True, cls=ct.ConfigJSONEncoder)
+    else:
+        mcfg, key = None, None
+    estimator = _estimators.get(key)
+    if estimator is None:
+        if mcfg is None:
+            mcfg = ct.load(CONFIG_PATH) if CONFIG_PATH.exists() else {}
+        estimator = _estimators[key] = MemoryEstimator.from_config(mcfg or {})
+    else:
+        estimator.refresh()
+    return estimator
@@ -0,0 +1,155 @@
+"""Memory-mapped model input cubes
+
+The model consumes a H x W x 9 stack of the reflectance (S1-S6) and
+brightness temperature (S7-S9) bands. The cube is stored as a contiguous
+float32 ``.npy`` file with missing values set to 0, so it can be opened with
+``np.load(..., mmap_mode="r")`` and passed to the model without decoding or
+copying. Two sidecar files are written next to it:
+
+``<stem>.valid.npy``
+    uint16 bit mask, bit i is set where band i has data
+``<stem>.json``
+    band names, affine transform and crs
+"""
+import json
+import os
+from pathlib import Path
+
+import attr
+import numpy as np
+
+MODEL_BANDS = (
+    "S1_reflectance_an",
+    "S2_reflectance_an",
+    "S3_reflectance_an",
+    "S4_reflectance_an",
+    "S5_reflectance_an",
+    "S6_reflectance_an",
+    "S7_BT_in",
+    "S8_BT_in",
+    "S9_BT_in",
+)
+
+
+@attr.s
+class Cube:
+    """Model input cube
+
+    Parameters
+    ----------
+    data : np.ndarray
+        H x W x 9 float32 array (np.memmap when opened from file)
+    valid : np.ndarray
+        H x W uint16 bit mask of bands with data
+    transform : affine.Affine
+        Geotransform
+    crs : str
+        Crs of the grid
+    bands : tuple
+        Band names
+    """
+    data = attr.ib()
+    valid = attr.ib()
+    transform = attr.ib()
+    crs = attr.ib(default=None)
+    bands = attr.ib(default=MODEL_BANDS, converter=tuple)
+
+    def band(self, name):
+        return self.data[:, :, self.bands.index(name)]
+
+    def band_valid(self, *names):
+        """True where all the named bands have data"""
+        bits = sum(1 << self.bands.index(n) for n in names)
+        return (self.valid & bits) == bits
+
+
+def cube_paths(path):
+    """Paths of the cube, validity mask and sidecar for a cube path (with or without suffix)"""
+    path = Path(path)
+    stem = path.name[:-len(".npy")] if path.name.endswith(".npy") else path.name
+    return (
+        path.with_name(stem + ".npy"),
+        path.with_name(stem + ".valid.npy"),
+        path.with_name(stem + ".json"),
+    )
+
+
+def valid_bits(arrays):
+    """uint16 bit mask with bit i set where arrays[i] is finite"""
+    valid = np.zeros(np.shape(arrays[0]), dtype="uint16")
+    for i, arr in enumerate(arrays):
+        valid |= np.isfinite(arr).astype("uint16") << i
+    return valid
+
+
+def write_cube(ds, path, bands=MODEL_BANDS):
+    """Write the model input bands of a reflectance dataset as a cube
+
+    Bands are written one at a time into the memory-mapped output, so the
+    full stack is never held in memory twice.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Reflectance dataset (dimensions band, y, x)
+    path : Path
+        Cube path, the sidecar files are written next to it
+    bands : tuple
+        Bands to stack
+
+    Returns
+    -------
+    Path
+        Path of the cube
+    """
+    import rioxarray  # noqa
+
+    cube_path, valid_path, meta_path = cube_paths(path)
+    cube_path.parent.mkdir(parents=True, exist_ok=True)
+    height, width = ds.sizes["y"], ds.sizes["x"]
+
+    tmp = cube_path.with_name(f"{cube_path.stem}.{os.getpid()}.tmp.npy")
+    data = np.lib.format.open_memmap(tmp, mode="w+", dtype="float32", shape=(height, width, len(bands)))
+    valid = np.zeros((height, width), dtype="uint16")
+    for i, band in enumerate(bands):
+        arr = np.asarray(ds[band].values, dtype="float32").reshape(height, width)
+        finite = np.isfinite(arr)
+        valid |= finite.astype("uint16") << i
+        data[:, :, i] = np.where(finite, arr, 0)
+    data.flush()
+    del data
+
+    np.save(valid_path, valid)
+    crs = ds.rio.crs
+    meta = {
+        "bands": list(bands),
+        "shape": [height, width, len(bands)],
+        "dtype": "float32",
+        "transform": list(ds.rio.transform())[:6],
+        "crs": crs.to_string() if crs is not None else None,
+    }
+    with open(meta_path, "w") as fid:
+        json.dump(meta, fid)
+    os.replace(tmp, cube_path)
+    return cube_path
+
+
+def open_cube(path):
+    """Open a cube without reading it (zero-copy, read-only memmap)
+
+    Returns
+    -------
+    Cube
+    """
+    from affine import Affine
+
+    cube_path, valid_path, meta_path = cube_paths(path)
+    with open(meta_path) as fid:
+        meta = json.load(fid)
+    return Cube(
+        data=np.load(cube_path, mmap_mode="r"),
+        valid=np.load(valid_path, mmap_mode="r"),
+        transform=Affine(*meta["transform"]),
+        crs=meta["crs"],
+        bands=meta["bands"],
+    )
@@ -1,25 +1,28 @@
+from contextlib import ExitStack
+import importlib
 import logging
 from pathlib import Path
 import tempfile
 
 import click
-import numpy as np
-import xarray as xr
 
 from preprocess import conftools as ct
-from preprocess.preprocess_reflectance import reflectance
-from preprocess.preprocess_reproject import reproject
-from preprocess.preprocess_s3import import s3import
 
 _logger = logging.getLogger(__name__)
 
+# Steps are given as "module:function" and imported when run, to keep importing this package cheap
 STEPS = {
-    "s3import": s3import,
-    "reproject": reproject,
-    "reflectance": reflectance,
+    "s3import": "preprocess.preprocess_s3import:s3import",
+    "reproject": "preprocess.preprocess_reproject:reproject",
+    "reflectance": "preprocess.preprocess_reflectance:reflectance",
 }
 
 
+def get_step(sname):
+    modname, funcname = STEPS[sname].split(":")
+    return getattr(importlib.import_module(modname), funcname)
+
+
 def setup_config():
     cfg = ct.load_directory(Path(__file__).parent / "config")
     cfg = cfg.preprocess
@@ -29,28 +32,216 @@ def setup_config():
     return cfg
 
 
-def read_ofile(fpath):
-    bands = [
-        "S1_reflectance_an",
-        "S2_reflectance_an",
-        "S3_reflectance_an",
-        "S4_reflectance_an",
-        "S5_reflectance_an",
-        "S6_reflectance_an",
-        "S7_BT_in",
-        "S8_BT_in",
-        "S9_BT_in"
-    ]
-    with xr.open_dataset(fpath) as ds:
+def output_suffix(cfg):
+    """File suffix of the step outputs for the configured format (netcdf or zarr)"""
+    fmt = cfg["preprocess"].get("pipeline", ct.Config()).get("format", "netcdf")
+    return ".zarr" if fmt == "zarr" else ".nc"
+
+
+def zarr_settings(cfg):
+    return dict(cfg["preprocess"].get("pipeline", ct.Config()).get("zarr", ct.Config()))
+
+
+def encoding_settings(cfg):
+    pcfg = cfg["preprocess"].get("pipeline", ct.Config())
+    settings = dict(float_dtype=pcfg.get("dtype", None))
+    settings.update(pcfg.get("encoding", ct.Config()))
+    return settings
+
+
+def set_step_defaults(scfg, cfg):
+    """Pass the pipeline wide output settings to a step config"""
+    pcfg = cfg["preprocess"].get("pipeline", ct.Config())
+    scfg.setdefault("zarr", zarr_settings(cfg))
+    scfg.setdefault("encoding", encoding_settings(cfg))
+    scfg.setdefault("dtype", pcfg.get("dtype", None))
+    return scfg
+
+
+def read_ofile(fpath, window=None):
+    """Read the model input bands and geotransform
+
+    Parameters
+    ----------
+    fpath : Path or xr.Dataset
+        Reflectance file (NetCDF or Zarr) or dataset
+    window : tuple
+        Optional (row slice, column slice) to read. Zarr stores are opened
+        with their own chunks, so only the chunks overlapping the window
+        are read.
+
+    Returns
+    -------
+    tuple
+        List of 2D arrays and the affine transform
+    """
+    from preprocess.cube import MODEL_BANDS as bands
+    import xarray as xr
+    import rioxarray  # noqa
+    from preprocess import xrtools as xrt
+
+    def read(ds):
+        if window is not None:
+            ds = ds.isel(y=window[0], x=window[1])
         return [ds[b].values.squeeze() for b in bands], ds.rio.transform()
 
+    if isinstance(fpath, xr.Dataset):
+        return read(fpath)
+    with xrt.open_dataset(fpath) as ds:
+        return read(ds)
+
+
+def cube_path(cfg, stem):
+    return cfg.workdir / "cube" / f"{stem}.npy"
+
+
+def _write_cube(ds, cfg, stem, overwrite=False, force=False):
+    """Write the model input cube if enabled in the pipeline config (or ``force``)
+
+    ``ds`` is the reflectance dataset or the path of the reflectance file.
+    """
+    from preprocess import xrtools as xrt
+    from preprocess.cube import write_cube
+
+    if not (force or cfg["preprocess"].get("pipeline", ct.Config()).get("cube", False)):
+        return None
+    path = cube_path(cfg, stem)
+    if not overwrite and path.exists():
+        return path
+    if isinstance(ds, (str, Path)):
+        with xrt.open_dataset(ds) as rds:
+            write_cube(rds, path)
+    else:
+        write_cube(ds, path)
+    _logger.info("Written %s", path)
+    return path
+
+
+def _write_intermediate(sname, ds, groups, cfg, stem):
+    from preprocess import xrtools as xrt
+
+    ofile = cfg.workdir / sname / f"{stem}{output_suffix(cfg)}"
+    ofile.parent.mkdir(parents=True, exist_ok=True)
+    _logger.info("Write intermediate %s", ofile)
+    xrt.save_dataset(xrt.encode_dataset(ds, **encoding_settings(cfg)), ofile, groups, **zarr_settings(cfg))
+
+
+def preprocess_fused(ifile, cfg, overwrite=False):
+    """Run all preprocessing steps in memory
+
+    The steps pass lazy (dask backed) datasets to each other, so no
+    intermediate files are written unless ``persist_intermediates`` is set
+    in the pipeline config.
+
+    Parameters
+    ----------
+    ifile : Path
+        Unzipped .SEN3 folder or zip file
+    cfg : Config
+        Config with workdir, tmpdir and preprocess settings
+    overwrite : bool
+        Recompute even if the output file exists
+
+    Returns
+    -------
+    Path or xr.Dataset
+        Path to the reflectance file, or the reflectance dataset if
+        ``persist_output`` is False in the pipeline config
+    """
+    from preprocess import xrtools as xrt
+    from preprocess.preprocess_reflectance import reflectance_dataset
+    from preprocess.preprocess_reproject import reproject_dataset
+    from preprocess.preprocess_s3import import s3import_datasets
+
+    pcfg = cfg["preprocess"].get("pipeline", ct.Config())
+    persist_output = pcfg.get("persist_output", True)
+    persist_intermediates = pcfg.get("persist_intermediates", False)
+
+    ofile = cfg.workdir / "reflectance" / f"{ifile.stem}{output_suffix(cfg)}"
+    if persist_output and not overwrite and ofile.exists():
+        _logger.info("%s exists. Skip", ofile)
+        _write_cube(ofile, cfg, ifile.stem)
+        return ofile
+
+    tmpdir = cfg.tmpdir / ifile.stem
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    chunk_size = cfg["preprocess"]["reproject"].get("chunk_size", 1000)
+    with ExitStack() as stack:
+        tdir = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=tmpdir, prefix="fused")))
+
+        _logger.info("s3import")
+        ids, groups = s3import_datasets(
+            stack, ifile, tdir, cfg["preprocess"]["s3import"],
+            chunks=dict(rows=chunk_size, columns=chunk_size),
+        )
+        if persist_intermediates:
+            _write_intermediate("s3import", ids, groups, cfg, ifile.stem)
+
+        _logger.info("reproject")
+        dtype = pcfg.get("dtype", None)
+        ids = xrt.cast_floats(reproject_dataset(ids, groups, cfg["preprocess"]["reproject"]), dtype)
+        if persist_intermediates:
+            _write_intermediate("reproject", ids, None, cfg, ifile.stem)
+
+        _logger.info("reflectance")
+        ods = xrt.cast_floats(reflectance_dataset(ids, cfg["preprocess"]["reflectance"]), dtype)
+
+        # Compute while the source files are open
+        ods = ods.compute()
+
+    _write_cube(ods, cfg, ifile.stem, overwrite)
+    if not persist_output:
+        return ods
+    ofile.parent.mkdir(parents=True, exist_ok=True)
+    xrt.save_dataset(xrt.encode_dataset(ods, **encoding_settings(cfg)), ofile, **zarr_settings(cfg))
+    _logger.info("Written %s", ofile)
+    return ofile
+
+
+def plan_scene(ifile, cfg):
+    """Memory plan of a scene (see preprocess.admission), or None if it can not be estimated"""
+    from preprocess import admission
+
+    try:
+        return admission.get_estimator(cfg).plan(ifile, cfg)
+    except Exception as e:
+        _logger.warning("No memory estimate for %s: %s", ifile, e)
+        return None
+
 
 def preprocess(ifile, cfg, overwrite=False):
+    """Preprocess a scene within the CPU budget of the preprocess stage
+
+    Scenes estimated to need too much memory for the fused pipeline are
+    preprocessed step by step (out-of-core), and also written as a
+    memory-mapped model input cube. The peak memory is recorded to refine
+    the estimates.
+    """
+    from preprocess import admission, resources
+
+    ofile = cfg.workdir / "reflectance" / f"{ifile.stem}{output_suffix(cfg)}"
+    exists = not overwrite and ofile.exists()
+    plan = plan_scene(ifile, cfg)
+    out_of_core = plan is not None and plan.out_of_core
+    with resources.stage("preprocess"), admission.PeakMemory() as peak:
+        result = _preprocess(ifile, cfg, overwrite, out_of_core)
+    if plan is not None and not exists:
+        admission.get_estimator(cfg).record(ifile.stem, plan.mode, plan.pixels, plan.estimate, peak.peak)
+    return result
+
+
+def _preprocess(ifile, cfg, overwrite=False, out_of_core=False):
+    pcfg = cfg["preprocess"].get("pipeline", ct.Config())
+    if pcfg.get("fused", False) and not out_of_core:
+        return preprocess_fused(ifile, cfg, overwrite)
+    if pcfg.get("fused", False):
+        _logger.info("%s is too large to preprocess in memory, preprocessing out-of-core", ifile.stem)
+
     tmpdir = cfg.tmpdir / ifile.stem
     tmpdir.mkdir(parents=True, exist_ok=True)
-    for sname, func in STEPS.items():
+    for sname in STEPS:
         _logger.info(sname)
-        ofile = cfg.workdir / sname / f"{ifile.stem}.nc"
+        ofile = cfg.workdir / sname / f"{ifile.stem}{output_suffix(cfg)}"
         if not overwrite and ofile.exists():
             _logger.info("%s exists. Skip", ofile)
             ifile = ofile
@@ -58,9 +249,11 @@ def preprocess(ifile, cfg, overwrite=False):
         ofile.parent.mkdir(parents=True, exist_ok=True)
         _logger.debug(ofile)
         with tempfile.TemporaryDirectory(dir=tmpdir, prefix=sname) as tdir:
-            ifile = func(ofile, ifile, Path(tdir), cfg['preprocess'][sname])
+            scfg = set_step_defaults(cfg['preprocess'][sname], cfg)
+            ifile = get_step(sname)(ofile, ifile, Path(tdir), scfg)
 
     ofile = ifile
+    _write_cube(ofile, cfg, ofile.stem, overwrite, force=out_of_core)
     return ofile
 
 
@@ -1,5 +1,6 @@
 
 import datetime
+import functools
 import logging
 from pathlib import Path
 
@@ -7,12 +8,10 @@ import numpy as np
 import yaml
 import xarray as xr
 
-from preprocess.misc import function_with_exitstack
 from preprocess import xrtools as xrt
 
 _logger = logging.getLogger(__name__)
 
-DOY_TO_SUN_DISTANCE = yaml.load((Path(__file__).parent / "doy_to_sundist.yml").open("r"), Loader = yaml.FullLoader)
 
 ESUNS = {
   "S1_radiance_an": 1837.39,
@@ -24,57 +23,153 @@ ESUNS = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def get_doy_to_sun_distance():
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with (Path(__file__).parent / "doy_to_sundist.yml").open("r") as fid:
+        return yaml.load(fid, Loader=loader)
+
+
 def get_solar_distance(date):
     doy = date.timetuple().tm_yday
-    return DOY_TO_SUN_DISTANCE[doy]
+    return get_doy_to_sun_distance()[doy]
 
 
 def get_esun(bandname):
     return ESUNS[bandname]
 
 
-def convert_rad2refl(data, esun, solar_zenith, solar_dist):
-    d2 = solar_dist**2
-    refl = (np.pi * data * d2) / (esun * xr.ufuncs.cos(solar_zenith))
-    #  refl = (np.pi * data * d2) / (esun * np.cos(np.pi*solar_zenith/180.0))
-    refl = xr.where(xr.ufuncs.fabs(solar_zenith-90) < 1e-3, np.inf, refl)
-    return refl
+def solar_factor(solar_zenith, solar_dist):
+    """Factor converting radiance times 1/esun to reflectance
+
+    Parameters
+    ----------
+    solar_zenith : xr.DataArray
+        Solar zenith angle in degrees
+    solar_dist : float
+        Sun-earth distance in AU
 
+    Returns
+    -------
+    xr.DataArray
+        pi * d^2 / cos(solar_zenith), inf where the sun is at the horizon
+    """
+    factor = (np.pi * solar_dist**2) / np.cos(np.deg2rad(solar_zenith))
+    return factor.where(~(np.fabs(solar_zenith - 90) < 1e-3), np.inf)
 
-@function_with_exitstack()
-def calculate_reflectance(stack, ofile, ifile, cfg):
-    ids = stack.enter_context(xr.open_dataset(ifile, cache=False))
 
+def convert_rad2refl(data, esun, solar_zenith, solar_dist):
+    """Convert one radiance band, solar_zenith in degrees"""
+    return data * solar_factor(solar_zenith, solar_dist) / esun
+
+
+def convert_bands(ids, varnames, factor):
+    """Convert radiance bands to reflectance in one stacked operation
+
+    Parameters
+    ----------
+    ids : xr.Dataset
+        Dataset with the radiance variables
+    varnames : list
+        Radiance variables, with solar irradiance in ESUNS
+    factor : xr.DataArray
+        Solar geometry factor from solar_factor
+
+    Returns
+    -------
+    dict
+        Reflectance xr.DataArray by radiance variable name
+    """
+    stacked = xr.Variable.concat(
+        [ids[v].variable for v in varnames], dim="radiance_band"
+    )
+    esun = xr.Variable("radiance_band", np.array([get_esun(v) for v in varnames], dtype=stacked.dtype))
+    refl = stacked * (factor.variable / esun)
+    return {
+        v: xr.DataArray(refl[i], coords=ids[v].coords, attrs=ids[v].attrs)
+        for i, v in enumerate(varnames)
+    }
+
+
+def convert_variables(ids, cfg, encode=True):
+    """Convert radiance variables to reflectance
+
+    The solar geometry factor is computed once, and all radiance bands are
+    converted as one stacked (lazy) array.
+
+    Parameters
+    ----------
+    ids : xr.Dataset
+        Reprojected dataset with radiances and solar zenith angles
+    cfg : Config
+        reflectance config
+    encode : bool
+        Set uint16 encoding on the reflectance variables
+
+    Yields
+    ------
+    tuple
+        Output variable name and xr.DataArray. Variables without solar
+        irradiance are passed through unchanged.
+    """
     date = datetime.date.fromisoformat(ids.source_meta.attrs["date"])
-    solar_dist = get_solar_distance(date)
-    solar_zenith = xr.ufuncs.deg2rad(ids[cfg.solar_zenith_band])
+    factor = solar_factor(ids[cfg.solar_zenith_band], get_solar_distance(date))
+
+    varnames = [v for v in ids.data_vars if v in ESUNS]
+    _logger.info("Convert variables: %s", varnames)
+    converted = convert_bands(ids, varnames, factor) if varnames else {}
 
     for varname in ids.data_vars:
-        try:
-            esun = get_esun(varname)
-        except KeyError as ke:
+        if varname not in converted:
             _logger.info("Skip variable: %s", varname)
-            ods = ids[varname].to_dataset(name=varname)
-        else:
-            _logger.info("Convert variable: %s", varname)
-            oda = convert_rad2refl(ids[varname], esun, solar_zenith, solar_dist)
+            yield varname, ids[varname]
+            continue
+        oda = converted[varname]
+        if encode:
             oda = xrt.auto_encoding(oda)
-            ods = oda.to_dataset(name=varname.replace("radiance", "reflectance"))
+        yield varname.replace("radiance", "reflectance"), oda
 
-        ods.to_netcdf(ofile, "a")
 
+def create_dataset(ids):
+    ods = xr.Dataset(attrs=ids.attrs)
+    ods.attrs["title"] = "Reflectance Sentinel-3"
+    xrt.append_history(ods, "NR S3Reflectance"),
+    ods["source_meta"] = ids.source_meta
+    return ods
 
-def reflectance(ofile, ifile, tmpdir, cfg):
-    tfile = tmpdir / ofile.name
-    with xr.open_dataset(ifile) as ids:
-        ods = xr.Dataset(attrs=ids.attrs)
-        ods.attrs["title"] = "Reflectance Sentinel-3"
-        xrt.append_history(ods, "NR S3Reflectance"),
-        ods["source_meta"] = ids.source_meta
-        ods.to_netcdf(tfile)
 
-    calculate_reflectance(tfile, ifile, cfg)
+def reflectance_dataset(ids, cfg, encode=False):
+    """Convert a reprojected dataset to reflectance
+
+    Parameters
+    ----------
+    ids : xr.Dataset
+        Reprojected dataset
+    cfg : Config
+        reflectance config
+    encode : bool
+        Set uint16 encoding on the reflectance variables
+
+    Returns
+    -------
+    xr.Dataset
+        The (lazy) reflectance dataset
+    """
+    ods = create_dataset(ids)
+    for varname, oda in convert_variables(ids, cfg, encode):
+        ods[varname] = oda
+    return ods
 
-    tfile.rename(ofile)
+
+def reflectance(ofile, ifile, tmpdir, cfg):
+    tfile = tmpdir / ofile.name
+    chunk_size = cfg.get("chunk_size", 1000)
+    with xrt.open_dataset(ifile, chunks=dict(x=chunk_size, y=chunk_size), cache=False) as ids:
+        # All bands are computed in parallel by dask and written at once
+        ods = xrt.cast_floats(reflectance_dataset(ids, cfg), cfg.get("dtype", None))
+        ods = xrt.encode_dataset(ods, **cfg.get("encoding", {}))
+        xrt.write_dataset(ods, tfile, **cfg.get("zarr", {}))
+
+    xrt.replace_path(tfile, ofile)
     _logger.debug("Written %s", ofile)
     return ofile
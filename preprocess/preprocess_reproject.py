@@ -1,22 +1,29 @@
 #! /usr/bin/env python
 
+import functools
+import json
 import logging
-import multiprocessing as mp
+from pathlib import Path
 import warnings
 
 import attr
-import netCDF4
 import numpy as np
 import pyproj
 from pyresample.geometry import SwathDefinition, AreaDefinition
 from pyresample.bilinear.xarr import XArrayBilinearResampler
 from scipy.interpolate import LinearNDInterpolator
+from scipy.spatial import Delaunay, cKDTree
 import shapely
 import shapely.ops
+import shapely.wkt
 import xarray as xr
 import rioxarray  # noqa
 
+from preprocess import resources
 from preprocess import xrtools as xrt
+from preprocess.misc import function_with_exitstack
+from preprocess.resampling_cache import ResamplingCache, lut_key
+from preprocess.tiling import TileGrid
 
 warnings.filterwarnings("ignore", ".*divide by zero.*")
 warnings.filterwarnings("ignore", ".*invalid value encountered.*")
@@ -32,9 +39,7 @@ class LinearResampler:
     tgtdef = attr.ib()
 
     def resample(self, da):
-        trans = pyproj.transformer.Transformer.from_crs(
-            "EPSG:4326", self.tgtdef.crs, always_xy=True
-        )
+        trans = get_transformer("EPSG:4326", self.tgtdef.crs)
         lats = self.srcdef.lats.values.ravel()
         lons = self.srcdef.lons.values.ravel()
         data = np.ma.masked_invalid(da.values)
@@ -62,59 +67,434 @@ class LinearResampler:
         return da
 
 
-def get_netcdf_contents(ifile):
-    _logger.info("Fetching ncfile contents")
-    contents = {}
-    with netCDF4.Dataset(ifile) as ds:
-        for gname, grp in ds.groups.items():
-            for vname in grp.variables.keys():
-                contents.setdefault(gname, []).append(vname)
-            _logger.debug(contents[gname])
-    return contents
+@attr.s
+class TiePointResampler:
+    """Resampler for tie-point grids which are regular in image space
+
+    The fractional tie-point (row, column) of every target pixel is found
+    once, by inverting the bilinear mapping from image to target
+    coordinates with Newton iterations started at the nearest tie point.
+    All variables are then interpolated bilinearly in image space, which
+    is separable and vectorized over variables.
+
+    Where the swath edge is concave in the target crs, the triangulation of
+    the projected tie points (LinearResampler) also covers pixels outside the
+    grid. These are interpolated linearly in the triangles of the outer
+    ``edge_rings`` rows and columns of tie points, so the same pixels are
+    valid as with LinearResampler.
+    """
+    srcdef = attr.ib()
+    tgtdef = attr.ib()
+    iterations = attr.ib(default=8)
+    edge_rings = attr.ib(default=2)
+    _mapping = attr.ib(default=None, init=False, repr=False)
+    _edge = attr.ib(default=None, init=False, repr=False)
+
+    def index_mapping(self):
+        """Fractional tie-point row and column of each target pixel (NaN outside the grid)"""
+        if self._mapping is not None:
+            return self._mapping
+
+        trans = get_transformer("EPSG:4326", self.tgtdef.crs)
+        sx, sy = trans.transform(
+            np.asarray(self.srcdef.lons, dtype="float64"),
+            np.asarray(self.srcdef.lats, dtype="float64"),
+        )
+        nrows, ncols = sx.shape
+        tx, ty = self.tgtdef.get_proj_coords()
+        tx, ty = tx.ravel(), ty.ravel()
+
+        # Start at the nearest tie point
+        valid = np.isfinite(sx) & np.isfinite(sy)
+        vrows, vcols = np.nonzero(valid)
+        _, idx = cKDTree(np.column_stack((sx[valid], sy[valid]))).query(np.column_stack((tx, ty)))
+        row, col = vrows[idx].astype("float64"), vcols[idx].astype("float64")
+
+        for _ in range(self.iterations):
+            i = np.clip(np.floor(row), 0, nrows - 2).astype("int64")
+            j = np.clip(np.floor(col), 0, ncols - 2).astype("int64")
+            fr, fc = row - i, col - j
+            x00, x01, x10, x11 = sx[i, j], sx[i, j + 1], sx[i + 1, j], sx[i + 1, j + 1]
+            y00, y01, y10, y11 = sy[i, j], sy[i, j + 1], sy[i + 1, j], sy[i + 1, j + 1]
+
+            ex = (1 - fr) * ((1 - fc) * x00 + fc * x01) + fr * ((1 - fc) * x10 + fc * x11) - tx
+            ey = (1 - fr) * ((1 - fc) * y00 + fc * y01) + fr * ((1 - fc) * y10 + fc * y11) - ty
+            dxdr = (1 - fc) * (x10 - x00) + fc * (x11 - x01)
+            dxdc = (1 - fr) * (x01 - x00) + fr * (x11 - x10)
+            dydr = (1 - fc) * (y10 - y00) + fc * (y11 - y01)
+            dydc = (1 - fr) * (y01 - y00) + fr * (y11 - y10)
+            det = dxdr * dydc - dxdc * dydr
+            with np.errstate(divide="ignore", invalid="ignore"):
+                drow = (dydc * ex - dxdc * ey) / det
+                dcol = (dxdr * ey - dydr * ex) / det
+            row, col = row - drow, col - dcol
+            if not np.nanmax(np.abs(drow) + np.abs(dcol), initial=0) > 1e-6:
+                break
+
+        eps = 1e-6
+        outside = ~(
+            (row >= -eps) & (row <= nrows - 1 + eps) & (col >= -eps) & (col <= ncols - 1 + eps)
+        )
+        row[outside] = np.nan
+        col[outside] = np.nan
+        self._edge = self._edge_weights(sx, sy, tx, ty, np.flatnonzero(outside))
+        self._mapping = (row.reshape(self.tgtdef.shape), col.reshape(self.tgtdef.shape))
+        return self._mapping
+
+    def _edge_weights(self, sx, sy, tx, ty, pixels):
+        """Tie points and barycentric weights of the pixels outside the grid but inside its convex hull
+
+        Triangles of the full triangulation with all corners in the outer
+        rings are also triangles of the triangulation of the rings, and
+        these are the triangles outside the grid.
+        """
+        n = self.edge_rings
+        ring = np.zeros(sx.shape, dtype=bool)
+        ring[:n] = ring[-n:] = True
+        ring[:, :n] = ring[:, -n:] = True
+        points = np.flatnonzero(ring & np.isfinite(sx) & np.isfinite(sy))
+        px, py = sx.flat[points], sy.flat[points]
+        pixels = pixels[
+            (tx[pixels] >= px.min()) & (tx[pixels] <= px.max()) & (ty[pixels] >= py.min()) & (ty[pixels] <= py.max())
+        ]
+        if len(pixels) == 0:
+            return pixels, np.zeros((0, 3), dtype="int64"), np.zeros((0, 3))
+        tri = Delaunay(np.column_stack((px, py)))
+        xy = np.column_stack((tx[pixels], ty[pixels]))
+        simplex = tri.find_simplex(xy)
+        hull = simplex >= 0
+        pixels, xy, simplex = pixels[hull], xy[hull], simplex[hull]
+        trans = tri.transform[simplex]
+        bary = np.einsum("nij,nj->ni", trans[:, :2], xy - trans[:, 2])
+        weights = np.column_stack((bary, 1 - bary.sum(axis=1)))
+        return pixels, points[tri.simplices[simplex]], weights
 
+    def resample(self, da):
+        """Resample a (y, x) or (band, y, x) xr.DataArray"""
+        row, col = self.index_mapping()
+        inside = np.isfinite(row)
+        row, col = np.where(inside, row, 0), np.where(inside, col, 0)
+        nrows, ncols = da.shape[-2:]
+        i = np.clip(np.floor(row), 0, nrows - 2).astype("int64")
+        j = np.clip(np.floor(col), 0, ncols - 2).astype("int64")
+        fr, fc = row - i, col - j
+
+        data = np.ma.masked_invalid(da.values).filled(np.nan)
+        top = (1 - fc) * data[..., i, j] + fc * data[..., i, j + 1]
+        bottom = (1 - fc) * data[..., i + 1, j] + fc * data[..., i + 1, j + 1]
+        odata = np.where(inside, (1 - fr) * top + fr * bottom, np.nan)
+        pixels, points, weights = self._edge
+        if len(pixels):
+            flat = data.reshape(data.shape[:-2] + (-1,))
+            odata = odata.reshape(odata.shape[:-2] + (-1,))
+            odata[..., pixels] = (flat[..., points] * weights).sum(axis=-1)
+            odata = odata.reshape(odata.shape[:-1] + self.tgtdef.shape)
 
-def get_extent(ifile, contents, cfg):
-    extents = []
-    for grp, vars in contents.items():
-        _logger.debug(grp)
-        latvar = [v for v in vars if "latitude" in v][0]
-        lonvar = [v for v in vars if "longitude" in v][0]
+        coord_x, coord_y = self.tgtdef.get_proj_vectors()
+        dims = da.dims[:-2] + ("y", "x")
+        coords = {d: da.coords[d] for d in da.dims[:-2] if d in da.coords}
+        coords.update(y=coord_y, x=coord_x)
+        return xr.DataArray(odata, coords=coords, dims=dims, attrs=da.attrs)
 
-        with xr.open_dataset(ifile, group=grp) as ids:
-            lats, lons = ids[latvar], ids[lonvar]
-            srcres = list(map(int, ids.resolution.strip("[]").split()))
 
-        # Ignore extent of solar* bands and other bands with very unequal resolution
-        if max(srcres) / min(srcres) > 4:
-            continue
+def get_netcdf_contents(ifile):
+    _logger.info("Fetching ncfile contents")
+    contents = xrt.list_groups(ifile)
+    for gname, vnames in contents.items():
+        _logger.debug(vnames)
+    return contents
 
-        trans = pyproj.transformer.Transformer.from_crs("EPSG:4326", cfg.crs, always_xy=True)
-
-        xarr, yarr = trans.transform(lons.values, lats.values)
-        xarr, yarr = np.ma.masked_invalid(xarr), np.ma.masked_invalid(yarr)
-        extents.append(shapely.geometry.box(
-            xarr.min(),
-            yarr.min(),
-            xarr.max(),
-            yarr.max()
-        ))
-        _logger.debug(extents[-1].bounds)
-
-    extent = shapely.ops.unary_union(extents).bounds
-    extent = np.concatenate(
-        (np.floor(np.array(extent[:2]) / cfg.resolution)*cfg.resolution,
-         np.ceil(np.array(extent[2:]) / cfg.resolution)*cfg.resolution)
-    )
-    extent += (-cfg.resolution, -cfg.resolution, cfg.resolution, cfg.resolution)
+
+def open_groups(stack, ifile, contents, chunks=None):
+    return {
+        grp: stack.enter_context(xrt.open_dataset(ifile, group=grp, chunks=chunks))
+        for grp in contents
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(src_crs, dst_crs):
+    """Cached pyproj Transformer (always_xy), shared by all groups and scenes"""
+    return pyproj.transformer.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def geolocation_vars(ids):
+    vars = list(ids.data_vars)
+    latvar = [v for v in vars if "latitude" in v][0]
+    lonvar = [v for v in vars if "longitude" in v][0]
+    return latvar, lonvar
+
+
+def swath_bounds(ids, crs, stride=None):
+    """Bounds of a swath in the target crs
+
+    Parameters
+    ----------
+    ids : xr.Dataset
+        Swath dataset of a group
+    crs : str or int
+        Target crs
+    stride : int
+        Only transform every stride'th row and column, plus all edge pixels.
+        If None, all pixels are transformed.
+
+    Returns
+    -------
+    tuple
+        (xmin, ymin, xmax, ymax)
+    """
+    latvar, lonvar = geolocation_vars(ids)
+    lats, lons = ids[latvar], ids[lonvar]
+    if stride is None:
+        lats, lons = lats.values.ravel(), lons.values.ravel()
+    else:
+        # The extremes are normally on the swath edges, which are always included
+        nrows, ncols = lats.shape
+        rows = np.unique(np.r_[0:nrows:stride, nrows - 1])
+        cols = np.unique(np.r_[0:ncols:stride, ncols - 1])
+        lats = np.concatenate([
+            lats[rows, :].values.ravel(), lats[:, cols].values.ravel()
+        ])
+        lons = np.concatenate([
+            lons[rows, :].values.ravel(), lons[:, cols].values.ravel()
+        ])
+
+    xarr, yarr = get_transformer("EPSG:4326", crs).transform(lons, lats)
+    xarr, yarr = np.ma.masked_invalid(xarr), np.ma.masked_invalid(yarr)
+    return xarr.min(), yarr.min(), xarr.max(), yarr.max()
+
+
+def footprint_bounds(meta, crs, max_segment=0.05):
+    """Bounds of the manifest footprint in the target crs
+
+    Parameters
+    ----------
+    meta : dict
+        Source metadata with footprint (WKT) and footprint_srs
+    crs : str or int
+        Target crs
+    max_segment : float
+        The footprint is densified to segments shorter than this (degrees)
+        before it is transformed
+
+    Returns
+    -------
+    tuple
+        (xmin, ymin, xmax, ymax), or None if there is no usable footprint
+    """
+    try:
+        footprint = shapely.wkt.loads(meta["footprint"])
+        srs = meta.get("footprint_srs", "EPSG:4326")
+    except (KeyError, TypeError, shapely.errors.ShapelyError):
+        return None
+    if footprint.is_empty:
+        return None
+    footprint = shapely.segmentize(footprint, max_segment)
+    polygons = getattr(footprint, "geoms", [footprint])
+    coords = np.concatenate([np.asarray(p.exterior.coords) for p in polygons], 0)
+    xarr, yarr = get_transformer(srs, crs).transform(coords[:, 0], coords[:, 1])
+    if not (np.isfinite(xarr).all() and np.isfinite(yarr).all()):
+        return None
+    return xarr.min(), yarr.min(), xarr.max(), yarr.max()
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@functools.lru_cache(maxsize=None)
+def load_aoi(path, crs, margin=0.0, simplify=0.0):
+    """Area of interest from a GeoJSON file (all features merged) in the target crs
+
+    Parameters
+    ----------
+    path : str
+        GeoJSON file, relative paths are relative to the repository root
+    crs : str or int
+        Target crs
+    margin : float
+        Buffer added around the area (crs units)
+    simplify : float
+        Simplification tolerance (crs units)
+
+    Returns
+    -------
+    shapely geometry
+    """
+    path = ROOT / path
+    with open(path) as f:
+        geojson = json.load(f)
+    features = geojson["features"] if geojson.get("type") == "FeatureCollection" else [geojson]
+    aoi = shapely.ops.unary_union([shapely.geometry.shape(f.get("geometry", f)) for f in features])
+    aoi = shapely.ops.transform(get_transformer("EPSG:4326", crs).transform, aoi)
+    if simplify:
+        aoi = aoi.simplify(simplify)
+    if margin:
+        aoi = aoi.buffer(margin)
+    shapely.prepare(aoi)
+    return aoi
+
+
+def get_aoi(cfg):
+    """Area of interest with margin from the ``aoi`` config, or None if disabled"""
+    acfg = cfg.get("aoi", None)
+    if not acfg or not acfg.get("enabled", True):
+        return None
+    return load_aoi(acfg.file, cfg.crs, acfg.get("margin", 0.0), cfg.resolution)
+
+
+def clip_groups(groups, cfg):
+    """Clip swaths to the rows and columns covering the area of interest
+
+    The area includes the configured margin, so that pixels near the edge of
+    the area get enough context in the prediction. The covered rows and
+    columns are found from a strided subsample of the geolocation.
+
+    Parameters
+    ----------
+    groups : dict
+        Swath datasets by group name
+    cfg : Config
+        reproject config
+
+    Returns
+    -------
+    dict
+        Clipped swath datasets by group name
+    """
+    aoi = get_aoi(cfg)
+    if aoi is None:
+        return groups
+    stride = cfg.get("extent_stride", 16)
+    trans = get_transformer("EPSG:4326", cfg.crs)
+
+    clipped = {}
+    for grp, ids in groups.items():
+        latvar, lonvar = geolocation_vars(ids)
+        nrows, ncols = ids[latvar].shape
+        # Finer sampling for small (tie-point) grids
+        step = max(1, min(stride, nrows // 8, ncols // 8))
+        lats = ids[latvar][::step, ::step].values
+        lons = ids[lonvar][::step, ::step].values
+        xarr, yarr = trans.transform(lons, lats)
+        inside = shapely.contains_xy(aoi, np.nan_to_num(xarr, nan=np.inf), np.nan_to_num(yarr, nan=np.inf))
+        if not inside.any():
+            raise Exception(f"Swath {grp} does not overlap the area of interest")
+        rows, cols = np.nonzero(inside)
+        # Include one sample spacing (and one tie point) around the covered samples
+        row0 = max(0, (rows.min() - 1) * step - 1)
+        row1 = min(nrows, (rows.max() + 1) * step + 2)
+        col0 = max(0, (cols.min() - 1) * step - 1)
+        col1 = min(ncols, (cols.max() + 1) * step + 2)
+        _logger.debug("Clip %s to rows %d:%d, columns %d:%d", grp, row0, row1, col0, col1)
+        clipped[grp] = ids.isel(rows=slice(row0, row1), columns=slice(col0, col1))
+    return clipped
+
+
+def snap_extent(bounds, cfg):
+    """Output extent for source bounds (in the target crs)
+
+    The bounds are limited to the area of interest, if enabled, and snapped to
+    whole tiles of the TileGrid, or to the resolution if tiling is disabled.
+
+    Returns
+    -------
+    np.ndarray
+        (xmin, ymin, xmax, ymax)
+    """
+    aoi = get_aoi(cfg)
+    if aoi is not None:
+        area = shapely.geometry.box(*bounds).intersection(aoi)
+        if area.is_empty:
+            raise Exception("Scene does not overlap the area of interest")
+        bounds = area.bounds
+    _logger.debug(bounds)
+
+    grid = TileGrid.from_config(cfg)
+    if grid is not None:
+        # Whole tiles of the fixed grid, so all scenes share one pixel lattice
+        bounds = np.array(bounds) + (-cfg.resolution, -cfg.resolution, cfg.resolution, cfg.resolution)
+        extent = grid.snap(bounds)
+    else:
+        extent = np.concatenate(
+            (np.floor(np.array(bounds[:2]) / cfg.resolution)*cfg.resolution,
+             np.ceil(np.array(bounds[2:]) / cfg.resolution)*cfg.resolution)
+        )
+        extent += (-cfg.resolution, -cfg.resolution, cfg.resolution, cfg.resolution)
 
     if pyproj.CRS(cfg.crs).is_geographic:
         extent = np.clip(extent, (-180, -90, -180, -90), (180, 90, 180, 90))
+    return extent
 
+
+def extent_shape(extent, cfg):
+    """Width and height in pixels of an extent"""
     width = int(np.rint((extent[2] - extent[0]) * 1.0 / cfg.resolution))
     height = int(np.rint((extent[3] - extent[1]) * 1.0 / cfg.resolution))
+    return width, height
+
+
+def get_extent(groups, cfg, meta=None):
+    """Compute the output extent, snapped to the resolution, and set cfg.extent
+
+    The method is set by ``extent_method`` in the config:
+
+    footprint
+        Manifest footprint from ``meta`` (falls back to strided)
+    strided
+        Strided subsample of the geolocation arrays
+    full
+        All pixels of the geolocation arrays
+
+    The fast methods add ``extent_margin`` (in crs units). With
+    ``extent_check`` the full extent is also computed, and included if it is
+    not covered by the fast extent.
+
+    If ``aoi`` is enabled the extent is limited to the part of the area of
+    interest (with margin) covered by the scene. If ``tiling`` is enabled the extent is snapped to whole tiles of the
+    fixed TileGrid, and the covered tiles are stored in cfg.tiles.
+    """
+    method = cfg.get("extent_method", "footprint")
+    margin = cfg.get("extent_margin", 0)
+    stride = cfg.get("extent_stride", 16)
+
+    # Ignore extent of solar* bands and other bands with very unequal resolution
+    swaths = {}
+    for grp, ids in groups.items():
+        srcres = list(map(int, ids.resolution.strip("[]").split()))
+        if max(srcres) / min(srcres) <= 4:
+            swaths[grp] = ids
+
+    bounds = None
+    if method == "footprint" and meta is not None:
+        bounds = footprint_bounds(meta, cfg.crs)
+        if bounds is None:
+            _logger.warning("No usable footprint, using strided extent")
+    if bounds is None and method in ("footprint", "strided"):
+        extents = [shapely.geometry.box(*swath_bounds(ids, cfg.crs, stride)) for ids in swaths.values()]
+        bounds = shapely.ops.unary_union(extents).bounds
+    if bounds is None:
+        extents = [shapely.geometry.box(*swath_bounds(ids, cfg.crs)) for ids in swaths.values()]
+        bounds = shapely.ops.unary_union(extents).bounds
+    else:
+        bounds = (bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+        if cfg.get("extent_check", False):
+            full = shapely.ops.unary_union(
+                [shapely.geometry.box(*swath_bounds(ids, cfg.crs)) for ids in swaths.values()]
+            )
+            tolerance = 0.01 * cfg.resolution
+            if not shapely.geometry.box(*bounds).buffer(tolerance, join_style=2).contains(full):
+                _logger.warning("Extent %s does not cover swath %s", bounds, full.bounds)
+                bounds = shapely.ops.unary_union([shapely.geometry.box(*bounds), full]).bounds
+    extent = snap_extent(bounds, cfg)
+    grid = TileGrid.from_config(cfg)
+    if grid is not None:
+        cfg.tiles = grid.tiles(extent)
+
+    width, height = extent_shape(extent, cfg)
     _logger.debug("w, h: %d, %d", width, height)
 
-    if width*height > 1e8:
+    max_pixels = cfg.get("max_pixels", 1e8)
+    if max_pixels and width*height > max_pixels:
         raise Exception(f"Output dimension is too large: {height}x{width}")
     cfg.extent = extent
     return extent
@@ -141,77 +521,218 @@ def create_areadef(extent, cfg, tileno=0):
         projection=cfg.crs,
         shape=(height, width),
         area_extent=extent,
-        nprocs=cfg.get("nprocs", mp.cpu_count())
+        nprocs=cfg.get("nprocs", None) or resources.threads("preprocess")
     )
 
 
-def get_resampler(ifile, grp, vars, cfg):
-    with xr.open_dataset(ifile, group=grp) as ds:
-        ds = ds.rename_dims(rows="y", columns="x")
-        lat = ds[[v for v in vars if "latitude" in v][0]]
-        lon = ds[[v for v in vars if "longitude" in v][0]]
-        srcdef = SwathDefinition(lats=lat, lons=lon)
-        srcres = list(map(int, ds.resolution.strip("[]").split()))
+def get_resampler(ids, cfg, grp=None, meta=None):
+    """Create the resampler for a group and compute (or load) its neighbour info
+
+    Parameters
+    ----------
+    ids : xr.Dataset
+        Swath dataset of the group
+    cfg : Config
+        reproject config, with extent set by get_extent
+    grp : str
+        Group name, used with ``meta`` to look up cached resampling tables
+    meta : dict
+        Source metadata with relative orbit and product identifier
+
+    Returns
+    -------
+    LinearResampler, TiePointResampler or XArrayBilinearResampler
+    """
+    ds = ids.rename_dims(rows="y", columns="x")
+    vars = list(ds.data_vars)
+    lat = ds[[v for v in vars if "latitude" in v][0]].load()
+    lon = ds[[v for v in vars if "longitude" in v][0]].load()
+    srcdef = SwathDefinition(lats=lat, lons=lon)
+    srcres = list(map(int, ds.resolution.strip("[]").split()))
 
     areadef = create_areadef(cfg.extent, cfg)
     if max(srcres) > 4*min(srcres):
-        return LinearResampler(srcdef, areadef)
-    resampler = XArrayBilinearResampler(srcdef, areadef, 10*max(srcres))
+        if cfg.get("tiepoint_interpolation", "bilinear") == "delaunay":
+            return LinearResampler(srcdef, areadef)
+        return TiePointResampler(srcdef, areadef)
+    radius = 10*max(srcres)
+    resampler = XArrayBilinearResampler(srcdef, areadef, radius)
+
+    cache = ResamplingCache.from_config(cfg)
+    key = None
+    if cache is not None and meta is not None:
+        key = lut_key(meta, grp, areadef, lat.shape, radius=radius)
+    if key is None:
+        resampler.get_bil_info()
+    else:
+        cache.prepare(resampler, key, lat.values, lon.values)
     return resampler
 
 
-def reproject_group(ofile, ifile, grp, vars, cfg):
+def resample_variables(resampler, ids, variables):
+    """Resample variables of a group
+
+    Variables are stacked into one (band, y, x) array and resampled in a
+    single pass, using the neighbour info computed by get_resampler (or the
+    tie-point index mapping). LinearResampler resamples each variable.
+
+    Parameters
+    ----------
+    resampler : LinearResampler, TiePointResampler or XArrayBilinearResampler
+        Resampler from get_resampler
+    ids : xr.Dataset
+        Swath dataset with dimensions y and x
+    variables : list
+        Names of the variables to resample
+
+    Returns
+    -------
+    dict
+        Resampled (lazy) xr.DataArray by variable name
+    """
+    arrays = {}
+    for var in variables:
+        ida = ids[var]
+        if ida.units == "degrees":
+            ida = ida.where(ida <= 360)
+        arrays[var] = ida
+
+    if isinstance(resampler, LinearResampler):
+        return {var: resampler.resample(ida) for var, ida in arrays.items()}
+
+    stacked = xr.concat(
+        [ida.drop_vars(list(ida.coords)) for ida in arrays.values()],
+        dim=xr.Variable("band", variables),
+        combine_attrs="drop",
+    )
+    if isinstance(resampler, XArrayBilinearResampler):
+        ostacked = resampler.get_sample_from_bil_info(stacked)
+    else:
+        ostacked = resampler.resample(stacked)
+    return {var: ostacked.sel(band=var, drop=True) for var in variables}
+
+
+def reproject_group(ids, grp, cfg, encode=True, meta=None):
+    """Reproject all variables of a group
+
+    Parameters
+    ----------
+    ids : xr.Dataset
+        Swath dataset of the group (dimensions rows and columns)
+    grp : str
+        Group name
+    cfg : Config
+        reproject config, with extent set by get_extent
+    encode : bool
+        Set uint16 encoding on the output (requires computing min/max)
+    meta : dict
+        Source metadata, enables the resampling table cache
+
+    Yields
+    ------
+    tuple
+        Variable name and the (lazy) reprojected xr.DataArray
+    """
     _logger.info("Reproject group")
     dims = ("latitude", "longitude") if pyproj.CRS(cfg.crs).is_geographic else ("y", "x")
-    chunk_size = cfg.get("chunk_size", 1000)
 
-    resampler = get_resampler(ifile, grp, vars, cfg)
+    resampler = get_resampler(ids, cfg, grp, meta)
+    ids = ids.rename_dims(rows="y", columns="x")
 
-    for var in vars:
+    variables = []
+    for var in ids.data_vars:
         print(var)
         if "latitude" in var or "longitude" in var:
             _logger.debug("Skipping: %s", var)
             continue
-        chunks = dict(rows=chunk_size, columns=chunk_size)
-        with xr.open_dataset(ifile, group=grp, chunks=chunks) as ids:
-            ids = ids.rename_dims(rows="y", columns="x")
-            _logger.info("Reproject %s / %s", grp, var)
-
-            ida = ids[var]
-            if ida.units == "degrees":
-                ida = ida.where(ida <= 360)
-
-            oda = resampler.resample(ida)
-            oda = oda.rename(y=dims[0], x=dims[1])
-            oda = oda.rename(var)
-            oda.attrs.update(ids[var].attrs)
-            # oda = xrt.write_crs_cf(oda, crs=cfg.crs)
+        variables.append(var)
+
+    _logger.info("Reproject %s / %s", grp, variables)
+    for var, oda in resample_variables(resampler, ids, variables).items():
+        oda = oda.rename(y=dims[0], x=dims[1])
+        oda = oda.rename(var)
+        oda.attrs.update(ids[var].attrs)
+        # oda = xrt.write_crs_cf(oda, crs=cfg.crs)
+        if encode:
             oda = xrt.auto_encoding(oda, dtype="uint16")
-            oda = oda.expand_dims(band=1)
+        oda = oda.expand_dims(band=1)
+        yield var, oda
 
-            ods = oda.to_dataset(name=var)
-            ods.to_netcdf(ofile, "a")
-
-        _logger.info("Completed reprojecting %s / %s", grp, var)
     _logger.info("Completed reprojecting %s", grp)
 
 
-def reproject(ofile, ifile, tmpdir, cfg):
+def create_dataset(ids):
+    ods = xr.Dataset(attrs=ids.attrs)
+    ods.attrs["title"] = "Resampled Sentinel-3"
+    xrt.append_history(ods, "NR S3Resample")
+    ods["source_meta"] = ids.source_meta
+    return ods
+
+
+def reproject_dataset(ids, groups, cfg, encode=False):
+    """Reproject all groups to a common grid
+
+    Parameters
+    ----------
+    ids : xr.Dataset
+        Dataset with global attributes and source_meta
+    groups : dict
+        Swath datasets by group name
+    cfg : Config
+        reproject config
+    encode : bool
+        Set uint16 encoding on the output variables
+
+    Returns
+    -------
+    xr.Dataset
+        The (lazy) reprojected dataset
+    """
+    ods = create_dataset(ids)
+    meta = ids.source_meta.attrs
+    groups = clip_groups(groups, cfg)
+    get_extent(groups, cfg, meta)
+    set_tile_attrs(ods, cfg)
+    for grp, gds in groups.items():
+        for var, oda in reproject_group(gds, grp, cfg, encode, meta):
+            ods[var] = oda
+    return ods
+
+
+def set_tile_attrs(ods, cfg):
+    """Record the tiling grid and covered tiles in the dataset attributes"""
+    grid = TileGrid.from_config(cfg)
+    if grid is None:
+        return ods
+    txs, tys = grid.tile_range(cfg.extent)
+    ods.attrs["tile_size"] = grid.tile_size
+    ods.attrs["tile_origin"] = list(grid.origin)
+    ods.attrs["tile_x_range"] = [txs[0], txs[-1]]
+    ods.attrs["tile_y_range"] = [tys[0], tys[-1]]
+    return ods
+
+
+@function_with_exitstack(idx=0)
+def reproject(stack, ofile, ifile, tmpdir, cfg):
     _logger.info("Reproject %s", ifile)
+    chunk_size = cfg.get("chunk_size", 1000)
     tfile = tmpdir / ofile.name
-    with xr.open_dataset(ifile) as ids:
-        ods = xr.Dataset(attrs=ids.attrs)
-        ods.attrs["title"] = "Resampled Sentinel-3"
-        xrt.append_history(ods, "NR S3Resample")
-        ods["source_meta"] = ids.source_meta
-        ods.to_netcdf(tfile)
-
     contents = get_netcdf_contents(ifile)
-    get_extent(ifile, contents, cfg)
-    for grp, vars in contents.items():
-        reproject_group(tfile, ifile, grp, vars, cfg)
-
-    tfile.rename(ofile)
+    groups = open_groups(stack, ifile, contents, chunks=dict(rows=chunk_size, columns=chunk_size))
+    groups = clip_groups(groups, cfg)
+    zarr_kwargs = cfg.get("zarr", {})
+    with xrt.open_dataset(ifile) as ids:
+        meta = dict(ids.source_meta.attrs)
+        get_extent(groups, cfg, meta)
+        xrt.write_dataset(set_tile_attrs(create_dataset(ids), cfg), tfile, **zarr_kwargs)
+
+    for grp, gds in groups.items():
+        # Write all variables of the group at once
+        gds = xr.Dataset(dict(reproject_group(gds, grp, cfg, encode=False, meta=meta)))
+        gds = xrt.encode_dataset(xrt.cast_floats(gds, cfg.get("dtype", None)), **cfg.get("encoding", {}))
+        xrt.write_dataset(gds, tfile, "a", **zarr_kwargs)
+
+    xrt.replace_path(tfile, ofile)
     _logger.info("Written %s", ofile)
     _logger.info("Reproject complete")
     return ofile
@@ -12,31 +12,55 @@ from preprocess.misc import function_with_exitstack
 _logger = logging.getLogger(__name__)
 
 
-@function_with_exitstack()
-def s3import(stack, ofile, ifile, tmpdir, cfg):
-    def _extract_files(tmpdir, zf, products):
-        for ncfmt, bfmt in products.items():
-            for ncf in fnmatch.filter(zf.namelist(), f"*/{ncfmt}"):
-                if (tmpdir / ncf).exists():
-                    continue
-                _logger.debug("Extract %s", ncf)
-                zf.extract(ncf, str(tmpdir))
-
-    def _import_products(ofile, safedir, products, correction_factors):
-        for ncfmt, bfmts in products.items():
-            for ncf in sorted(safedir.rglob(ncfmt)):
-                _logger.debug("Read %s", ncf.name)
-                ds = stack.enter_context(xr.open_dataset(ncf))
-                group = "{rows}x{columns}".format(**ds.dims)
-                ods = xr.Dataset()
-                ods.attrs.update(ds.attrs)
-                for bfmt in bfmts:
-                    for varname in fnmatch.filter(ds.variables, bfmt):
-                        cf = correction_factors.get(varname, 1)
-                        ods[varname] = ds[varname] * cf
-                        ods[varname].attrs = ds[varname].attrs
-                ods.to_netcdf(ofile, "a", group=group)
+def _extract_files(tmpdir, zf, products):
+    for ncfmt, bfmt in products.items():
+        for ncf in fnmatch.filter(zf.namelist(), f"*/{ncfmt}"):
+            if (tmpdir / ncf).exists():
+                continue
+            _logger.debug("Extract %s", ncf)
+            zf.extract(ncf, str(tmpdir))
+
+
+def _open_products(stack, safedir, products, correction_factors, chunks=None):
+    groups = {}
+    for ncfmt, bfmts in products.items():
+        for ncf in sorted(safedir.rglob(ncfmt)):
+            _logger.debug("Read %s", ncf.name)
+            ds = stack.enter_context(xr.open_dataset(ncf, chunks=chunks))
+            group = "{rows}x{columns}".format(**ds.sizes)
+            ods = groups.setdefault(group, xr.Dataset())
+            ods.attrs.update(ds.attrs)
+            for bfmt in bfmts:
+                for varname in fnmatch.filter(ds.variables, bfmt):
+                    cf = correction_factors.get(varname, 1)
+                    ods[varname] = ds[varname] * cf
+                    ods[varname].attrs = ds[varname].attrs
+    return groups
+
+
+def s3import_datasets(stack, ifile, tmpdir, cfg, chunks=None):
+    """Open the bands of a Sentinel-3 product lazily
 
+    Parameters
+    ----------
+    stack : contextlib.ExitStack
+        Stack keeping the product files open. The returned datasets are
+        valid until the stack is closed.
+    ifile : Path
+        Unzipped .SEN3 folder or zip file
+    tmpdir : Path
+        Folder to extract zip files into
+    cfg : Config
+        s3import config
+    chunks : dict, optional
+        Dask chunks to open the files with
+
+    Returns
+    -------
+    tuple
+        Dataset with global attributes and source metadata, and a dict with
+        one Dataset per grid ("<rows>x<columns>")
+    """
     filemeta = manifest.parse(ifile)
 
     sensor = filemeta.instrumentshortname.lower()
@@ -60,9 +84,17 @@ def s3import(stack, ofile, ifile, tmpdir, cfg):
         source="ESA SciHub",
         history="NR S3Import"
     )
-    tfile = tmpdir / ofile.name
-    ds.to_netcdf(tfile)
+    groups = _open_products(stack, safedir, products, correction_factors, chunks)
+    return ds, groups
+
 
-    _import_products(tfile, safedir, products, correction_factors)
-    tfile.rename(ofile)
+@function_with_exitstack()
+def s3import(stack, ofile, ifile, tmpdir, cfg):
+    ds, groups = s3import_datasets(stack, ifile, tmpdir, cfg)
+    tfile = tmpdir / ofile.name
+    zarr_kwargs = cfg.get("zarr", {})
+    xrt.write_dataset(ds, tfile, **zarr_kwargs)
+    for group, gds in groups.items():
+        xrt.write_dataset(gds, tfile, "a", group=group, **zarr_kwargs)
+    xrt.replace_path(tfile, ofile)
     return ofile
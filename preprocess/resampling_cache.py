@@ -0,0 +1,215 @@
+"""Cache of swath-to-grid resampling look-up tables
+
+Sentinel-3 repeats its ground track every 27 days, so scenes from the same
+relative orbit and along-track frame have (almost) the same geolocation. The
+bilinear neighbour search and weights are therefore stored on disk, keyed by
+relative orbit, frame, group and target grid, and reused for later scenes.
+
+A strided subsample of the swath latitudes and longitudes is stored with each
+table. On a cache hit the geolocation of the new scene is compared to it, and
+the table is recomputed if it has drifted more than the configured tolerance.
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parents[1] / "cache" / "resampling_luts"
+
+EARTH_RADIUS = 6371000.0
+
+
+def lut_key(meta, grp, areadef, shape, **kwargs):
+    """Key identifying a resampling look-up table
+
+    Parameters
+    ----------
+    meta : dict
+        Source metadata (attributes of source_meta)
+    grp : str
+        Group name
+    areadef : AreaDefinition
+        Target grid
+    shape : tuple
+        Shape of the swath
+    **kwargs
+        Additional resampler settings
+
+    Returns
+    -------
+    str
+        Key used as folder name, or None if the orbit is unknown
+    """
+    try:
+        relorbit = int(meta["relativeorbitnumber"])
+        frame = meta["identifier"].split("_")[13]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+    target = {
+        "crs": areadef.crs.to_wkt(),
+        "extent": [float(v) for v in areadef.area_extent],
+        "shape": list(areadef.shape),
+        "swath": list(shape),
+        "kwargs": {k: str(v) for k, v in sorted(kwargs.items())},
+    }
+    digest = hashlib.sha1(json.dumps(target, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"R{relorbit:03d}_F{frame}_{grp}_{digest[:16]}"
+
+
+def geolocation_drift(lat0, lon0, lat1, lon1):
+    """Largest distance in meters between two sets of positions
+
+    Uses an equirectangular approximation, which is accurate for the small
+    distances of interest.
+    """
+    lat0, lon0, lat1, lon1 = (np.asarray(v, dtype="float64") for v in (lat0, lon0, lat1, lon1))
+    # Pixels without geolocation in both scenes are ignored, pixels valid in only one count as drift
+    if (np.isnan(lat0) != np.isnan(lat1)).any():
+        return np.inf
+    dlat = np.deg2rad(lat1 - lat0)
+    dlon = np.deg2rad((lon1 - lon0 + 180) % 360 - 180) * np.cos(np.deg2rad(lat0))
+    dist = EARTH_RADIUS * np.hypot(dlat, dlon)
+    return float(np.nanmax(dist)) if np.isfinite(dist).any() else 0.0
+
+
+class ResamplingCache:
+    """On-disk store of bilinear resampling look-up tables
+
+    Parameters
+    ----------
+    cache_dir : Path
+        Folder to store the tables in
+    max_drift : float
+        Largest geolocation difference (meters) for a table to be reused
+    stride : int
+        Stride of the stored geolocation subsample
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_drift=50.0, stride=16):
+        self.cache_dir = Path(cache_dir)
+        self.max_drift = max_drift
+        self.stride = stride
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Create cache from the ``lut_cache`` section of the reproject config
+
+        Returns None if the cache is disabled.
+        """
+        lcfg = cfg.get("lut_cache", None)
+        if not lcfg or not lcfg.get("enabled", True):
+            return None
+        return cls(
+            cache_dir=lcfg.get("dir", None) or DEFAULT_CACHE_DIR,
+            max_drift=lcfg.get("max_drift", 50.0),
+            stride=lcfg.get("stride", 16),
+        )
+
+    def _path(self, key):
+        return self.cache_dir / key
+
+    def _subsample(self, lat, lon):
+        s = self.stride
+        return (
+            np.asarray(lat)[::s, ::s].astype("float32"),
+            np.asarray(lon)[::s, ::s].astype("float32"),
+        )
+
+    def load(self, resampler, key, lat, lon):
+        """Initialize resampler from the cache
+
+        Returns
+        -------
+        bool
+            True if a valid table was found and loaded
+        """
+        path = self._path(key)
+        try:
+            with np.load(path / "geolocation.npz") as npz:
+                lat0, lon0 = npz["lat"], npz["lon"]
+                valid_output_indices = npz["valid_output_indices"]
+        except (OSError, KeyError, ValueError):
+            return False
+
+        lat1, lon1 = self._subsample(lat, lon)
+        if lat0.shape != lat1.shape:
+            _logger.info("LUT %s: swath shape changed", key)
+            return False
+        drift = geolocation_drift(lat0, lon0, lat1, lon1)
+        if drift > self.max_drift:
+            _logger.info("LUT %s: geolocation drift %.1f m > %.1f m", key, drift, self.max_drift)
+            return False
+
+        try:
+            resampler.load_resampling_info(str(path / "lut.zarr"))
+        except (IOError, KeyError) as e:
+            _logger.warning("LUT %s could not be read: %s", key, e)
+            return False
+        # Read once into memory instead of from the store for every variable
+        for name in ("bilinear_s", "bilinear_t", "slices_x", "slices_y", "mask_slices",
+                     "out_coords_x", "out_coords_y"):
+            setattr(resampler, name, np.asarray(getattr(resampler, name)))
+        resampler._valid_output_indices = valid_output_indices
+        _logger.info("LUT %s: loaded (drift %.1f m)", key, drift)
+        return True
+
+    def save(self, resampler, key, lat, lon):
+        """Store the look-up table of a resampler with computed bilinear info"""
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+        tmp_path.mkdir(parents=True)
+        try:
+            resampler.save_resampling_info(str(tmp_path / "lut.zarr"))
+            lat0, lon0 = self._subsample(lat, lon)
+            valid_output_indices = getattr(resampler, "_valid_output_indices", None)
+            if valid_output_indices is None:
+                valid_output_indices = np.ones(resampler._target_geo_def.size, dtype="bool")
+            np.savez_compressed(
+                tmp_path / "geolocation.npz",
+                lat=lat0,
+                lon=lon0,
+                valid_output_indices=np.asarray(valid_output_indices),
+            )
+            if path.exists():
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        _logger.info("LUT %s: saved", key)
+
+    def prepare(self, resampler, key, lat, lon):
+        """Load the resampler look-up table from the cache, or compute and store it
+
+        Parameters
+        ----------
+        resampler : XArrayBilinearResampler
+            Resampler to initialize
+        key : str
+            Key from lut_key
+        lat, lon : array_like
+            Swath geolocation
+
+        Returns
+        -------
+        bool
+            True on a cache hit
+        """
+        if self.load(resampler, key, lat, lon):
+            return True
+        resampler.get_bil_info()
+        if resampler.bilinear_s is None:
+            return False
+        try:
+            self.save(resampler, key, lat, lon)
+        except OSError as e:
+            _logger.warning("LUT %s could not be stored: %s", key, e)
+        return False
@@ -0,0 +1,229 @@
+"""CPU budget shared by all stages of the pipeline
+
+Every library has its own idea of how many threads to use: pyresample
+(``nprocs``), dask (the threaded scheduler pool), GDAL/rasterio
+(``num_threads``, ``GDAL_NUM_THREADS``), BLAS/OpenMP and torch (intra-op
+threads). They all default to every core, so stages that run at the same time
+oversubscribe the machine.
+
+The budget is configured once in ``preprocess.resources.yml``. Each stage gets
+a share of the cores, which is applied to all libraries with
+:meth:`ResourceManager.stage` (or read with :meth:`ResourceManager.threads`).
+Worker processes started through :meth:`ResourceManager.worker_initializer`
+divide the budget between them, and with ``pin_workers`` are pinned to
+disjoint core sets grouped by NUMA node.
+"""
+from contextlib import ExitStack, contextmanager
+import glob
+import logging
+import os
+from pathlib import Path
+import sys
+
+_logger = logging.getLogger(__name__)
+
+CONFIG_PATH = Path(__file__).parent / "config" / "preprocess.resources.yml"
+
+# Read by OpenMP/BLAS libraries (and numexpr) when they are loaded
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+_manager = None
+
+
+def available_cpus():
+    """Cores the process may run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """Cores of each NUMA node (a single node if the topology is unknown)
+
+    Returns
+    -------
+    list
+        List of core lists
+    """
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as fid:
+            nodes.append(_parse_cpulist(fid.read()))
+    available = set(available_cpus())
+    nodes = [[c for c in node if c in available] for node in nodes]
+    nodes = [node for node in nodes if node]
+    return nodes or [sorted(available)]
+
+
+def core_sets(n_workers, cpus=None):
+    """Split cores into disjoint sets for worker processes
+
+    Cores are taken node by node, so a worker only spans NUMA nodes when it
+    has more cores than a node. With more workers than cores, cores are
+    shared round-robin.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of workers
+    cpus : int
+        Number of cores to use (all available if None)
+
+    Returns
+    -------
+    list
+        One list of cores per worker
+    """
+    cores = [c for node in numa_nodes() for c in node]
+    if cpus is not None:
+        cores = cores[:max(1, cpus)]
+    if n_workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(n_workers)]
+    sets = []
+    start = 0
+    for i in range(n_workers):
+        # Spread the remainder over the first workers
+        size = len(cores) // n_workers + (i < len(cores) % n_workers)
+        sets.append(cores[start:start + size])
+        start += size
+    return sets
+
+
+class ResourceManager:
+    """Thread budget per stage
+
+    Parameters
+    ----------
+    cpus : int
+        Cores the pipeline may use (all available if None)
+    stages : dict
+        Share of the cores per stage name, stages not listed get all cores
+    pin_workers : bool
+        Pin worker processes to disjoint core sets
+    """
+
+    def __init__(self, cpus=None, stages=None, pin_workers=False):
+        self.cpus = min(cpus or len(available_cpus()), len(available_cpus()))
+        self.stages = dict(stages or {})
+        self.pin_workers = pin_workers
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            cpus=cfg.get("cpus", None),
+            stages=cfg.get("stages", None),
+            pin_workers=cfg.get("pin_workers", False),
+        )
+
+    def threads(self, stage):
+        """Number of threads a stage may use"""
+        return max(1, int(round(self.stages.get(stage, 1.0) * self.cpus)))
+
+    @contextmanager
+    def stage(self, stage):
+        """Limit dask, BLAS/OpenMP, GDAL and torch to the budget of a stage
+
+        Torch is only limited if it is already imported, it is not imported
+        here. The previous torch setting is restored on exit.
+        """
+        import dask
+        from threadpoolctl import threadpool_limits
+
+        n = self.threads(stage)
+        with ExitStack() as stack:
+            stack.enter_context(dask.config.set(num_workers=n))
+            # Limits the already loaded BLAS/OpenMP libraries, their environment variables are only read at load time
+            stack.enter_context(threadpool_limits(limits=n))
+            if "rasterio" in sys.modules:
+                import rasterio
+                stack.enter_context(rasterio.Env(GDAL_NUM_THREADS=n))
+            if "torch" in sys.modules:
+                torch = sys.modules["torch"]
+                previous = torch.get_num_threads()
+                torch.set_num_threads(n)
+                stack.callback(torch.set_num_threads, previous)
+            _logger.debug("Stage %s: %d threads", stage, n)
+            yield n
+
+    def worker_initializer(self, n_workers):
+        """Initializer and arguments for worker processes of a pool
+
+        Each worker claims an index from a shared counter and gets an equal
+        part of the cores as its budget. If ``pin_workers`` is set, it is also
+        pinned to its own core set.
+
+        Returns
+        -------
+        tuple
+            (initializer, initargs) for ProcessPoolExecutor or multiprocessing.Pool
+        """
+        import multiprocessing as mp
+
+        counter = mp.Value("i", 0)
+        return _init_worker, (counter, n_workers, self.cpus, self.stages, self.pin_workers)
+
+
+def _init_worker(counter, n_workers, cpus, stages, pin_workers):
+    global _manager
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if pin_workers:
+        cores = core_sets(n_workers, cpus)[index % n_workers]
+        try:
+            os.sched_setaffinity(0, cores)
+            _logger.debug("Worker %d pinned to cores %s", index, cores)
+        except (AttributeError, OSError) as e:
+            _logger.warning("Could not pin worker %d to cores %s: %s", index, cores, e)
+        cpus = len(cores)
+    else:
+        cpus = max(1, cpus // n_workers)
+    # Each stage gets its share of the cores of the worker
+    _manager = ResourceManager(cpus, stages)
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(_manager.threads("preprocess"))
+
+
+def get_manager():
+    """Resource manager of the process, from preprocess.resources.yml unless set with configure"""
+    global _manager
+    if _manager is None:
+        from preprocess import conftools as ct
+
+        cfg = ct.load(CONFIG_PATH) if CONFIG_PATH.exists() else {}
+        _manager = ResourceManager.from_config(cfg or {})
+    return _manager
+
+
+def configure(cfg):
+    """Set the resource manager of the process from a resources config"""
+    global _manager
+    _manager = ResourceManager.from_config(cfg)
+    return _manager
+
+
+def threads(stage):
+    """Number of threads a stage may use"""
+    return get_manager().threads(stage)
+
+
+def stage(name):
+    """Context limiting all libraries to the budget of a stage"""
+    return get_manager().stage(name)
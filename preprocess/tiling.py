@@ -0,0 +1,100 @@
+"""Fixed tiling grid for reprojected output
+
+All scenes are reprojected to one pixel lattice, split into square tiles
+addressed by (tile_x, tile_y). Tile (0, 0) has its upper left corner at the
+grid origin, tile_x increases eastwards and tile_y southwards. Since scene
+extents are whole tiles, outputs can be mosaicked by copying blocks, and
+results can be cached or skipped per tile.
+"""
+import attr
+import numpy as np
+
+
+@attr.s(frozen=True)
+class TileGrid:
+    """Tiling grid
+
+    Parameters
+    ----------
+    crs : int or str
+        Grid crs
+    resolution : float
+        Pixel size in crs units
+    tile_size : int
+        Tile width and height in pixels
+    origin : tuple
+        Upper left corner (x, y) of tile (0, 0)
+    """
+    crs = attr.ib(default=32633)
+    resolution = attr.ib(default=500)
+    tile_size = attr.ib(default=128)
+    origin = attr.ib(default=(0, 10000000), converter=tuple)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Create grid from the reproject config, or None if tiling is disabled"""
+        tcfg = cfg.get("tiling", None)
+        if not tcfg or not tcfg.get("enabled", True):
+            return None
+        return cls(
+            crs=cfg.crs,
+            resolution=cfg.resolution,
+            tile_size=tcfg.get("tile_size", 128),
+            origin=tcfg.get("origin", (0, 10000000)),
+        )
+
+    @property
+    def tile_extent(self):
+        """Tile width and height in crs units"""
+        return self.tile_size * self.resolution
+
+    def tile_index(self, x, y):
+        """Tile containing the point (x, y)"""
+        tx = int(np.floor((x - self.origin[0]) / self.tile_extent))
+        ty = int(np.floor((self.origin[1] - y) / self.tile_extent))
+        return tx, ty
+
+    def tile_bounds(self, tx, ty):
+        """Bounds (xmin, ymin, xmax, ymax) of a tile"""
+        xmin = self.origin[0] + tx * self.tile_extent
+        ymax = self.origin[1] - ty * self.tile_extent
+        return xmin, ymax - self.tile_extent, xmin + self.tile_extent, ymax
+
+    def tile_range(self, bounds):
+        """Range of tiles overlapping bounds
+
+        Returns
+        -------
+        tuple
+            (range of tile_x, range of tile_y)
+        """
+        xmin, ymin, xmax, ymax = bounds
+        eps = 1e-6 * self.resolution
+        tx0, ty0 = self.tile_index(xmin + eps, ymax - eps)
+        tx1, ty1 = self.tile_index(xmax - eps, ymin + eps)
+        return range(tx0, tx1 + 1), range(ty0, ty1 + 1)
+
+    def tiles(self, bounds):
+        """List of (tile_x, tile_y) overlapping bounds"""
+        txs, tys = self.tile_range(bounds)
+        return [(tx, ty) for ty in tys for tx in txs]
+
+    def snap(self, bounds):
+        """Smallest extent made of whole tiles covering bounds
+
+        Returns
+        -------
+        np.array
+            (xmin, ymin, xmax, ymax)
+        """
+        txs, tys = self.tile_range(bounds)
+        xmin, _, _, ymax = self.tile_bounds(txs[0], tys[0])
+        _, ymin, xmax, _ = self.tile_bounds(txs[-1], tys[-1])
+        return np.array([xmin, ymin, xmax, ymax], dtype="float")
+
+    def window(self, extent, tx, ty):
+        """Row and column slices of a tile in an array covering a snapped extent"""
+        xmin, _, _, ymax = self.tile_bounds(tx, ty)
+        row = int(round((extent[3] - ymax) / self.resolution))
+        col = int(round((xmin - extent[0]) / self.resolution))
+        return slice(row, row + self.tile_size), slice(col, col + self.tile_size)
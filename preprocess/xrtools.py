@@ -3,7 +3,9 @@
 from contextlib import suppress, contextmanager
 import datetime
 import logging
+import os
 from pathlib import Path
+import shutil
 
 import numpy as np
 import pyproj
@@ -24,21 +26,231 @@ def to_netcdf(ds, path, temp_suffix=".tmp"):
     return path
 
 
-def auto_encoding(da, dtype="uint16", zlib=True, complevel=4, clear_encoding=True, **kwargs):
+ZARR_SUFFIX = ".zarr"
+
+# Storage encoding (NetCDF compression and layout, Zarr chunks and codecs) read from the source, which is stale after
+# rechunking or conversion. Dropped before writing, while dtype, scaling and fill values are kept.
+STALE_ENCODING_KEYS = (
+    "zlib", "complevel", "shuffle", "fletcher32", "contiguous", "chunksizes",
+    "compression", "szip_coding", "szip_pixels_per_block", "quantize_mode",
+    "significant_digits", "blosc_shuffle", "source", "original_shape",
+    "preferred_chunks", "chunks", "compressor", "compressors", "filters",
+)
+
+
+def is_zarr(path):
+    return Path(path).suffix == ZARR_SUFFIX
+
+
+def open_dataset(path, group=None, chunks=None, **kwargs):
+    """Open a NetCDF file or Zarr store (chosen by the path suffix)
+
+    Zarr stores are opened with their own chunks unless ``chunks`` is
+    given, so that windowed reads only touch the chunks they need. Packed
+    variables written with a float32 ``float_dtype`` (see auto_encoding) are
+    decoded to float32, like from NetCDF.
+    """
+    if is_zarr(path):
+        kwargs.pop("cache", None)  # Not supported (or needed) by the Zarr backend
+        kwargs.setdefault("consolidated", False)
+        ds = xr.open_zarr(
+            path, group=group, chunks={} if chunks is None else chunks, decode_cf=False, **kwargs
+        )
+        return xr.decode_cf(float32_scaling(ds))
+    return xr.open_dataset(path, group=group, chunks=chunks, **kwargs)
+
+
+def float32_scaling(ds):
+    """Restore float32 scale_factor and add_offset attributes
+
+    Zarr stores attributes as JSON, so the float32 scaling written by
+    auto_encoding is read back as Python floats, which decode to float64.
+    Scaling attributes that are exact float32 values are converted back.
+    """
+    for da in ds.variables.values():
+        names = [k for k in ("scale_factor", "add_offset") if k in da.attrs]
+        if not names or not np.issubdtype(da.dtype, np.integer):
+            continue
+        values = [da.attrs[k] for k in names]
+        if all(np.ndim(v) == 0 and float(np.float32(v)) == float(v) for v in values):
+            da.attrs.update({k: np.float32(v) for k, v in zip(names, values)})
+    return ds
+
+
+def list_groups(path):
+    """Names of the variables in each group of a NetCDF file or Zarr store"""
+    contents = {}
+    if is_zarr(path):
+        import zarr
+
+        root = zarr.open_group(str(path), mode="r")
+        for gname, grp in root.groups():
+            contents[gname] = list(grp.array_keys())
+        return contents
+
+    import netCDF4
+
+    with netCDF4.Dataset(path) as ds:
+        for gname, grp in ds.groups.items():
+            contents[gname] = list(grp.variables.keys())
+    return contents
+
+
+def zarr_compressor_encoding(compressor="lz4", clevel=5, shuffle="bitshuffle"):
+    """Encoding entry for a Blosc compressor (None for no compression)"""
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        if compressor is None:
+            return {"compressors": None}
+        from zarr.codecs import BloscCodec
+
+        return {"compressors": (BloscCodec(cname=compressor, clevel=clevel, shuffle=shuffle),)}
+
+    if compressor is None:
+        return {"compressor": None}
+    from numcodecs import Blosc
+
+    shuffle = {"noshuffle": Blosc.NOSHUFFLE, "shuffle": Blosc.SHUFFLE, "bitshuffle": Blosc.BITSHUFFLE}[shuffle]
+    return {"compressor": Blosc(cname=compressor, clevel=clevel, shuffle=shuffle)}
+
+
+def zarr_prepare(ds, compressor="lz4", clevel=5, shuffle="bitshuffle", chunk_size=512):
+    """Rechunk a dataset and convert its encoding for writing to Zarr
+
+    Spatial dimensions get chunks of ``chunk_size``, other dimensions one
+    chunk per index. The storage encoding of the source (NetCDF or Zarr) is
+    dropped, while dtype, scaling and fill values are kept.
+    """
+    spatial = ("x", "y", "rows", "columns", "latitude", "longitude")
+    chunks = {d: (chunk_size if d in spatial else 1) for d in ds.dims}
+    ds = ds.chunk(chunks)
+    compression = zarr_compressor_encoding(compressor, clevel, shuffle)
+    for da in ds.variables.values():
+        for key in STALE_ENCODING_KEYS:
+            da.encoding.pop(key, None)
+        if da.ndim > 0:
+            da.encoding.update(compression)
+    return ds
+
+
+def write_dataset(ds, path, mode="w", group=None, **zarr_kwargs):
+    """Write a dataset to a NetCDF file or Zarr store (chosen by the path suffix)
+
+    Zarr stores are written chunk by chunk, with the chunks computed and
+    written concurrently by dask.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Dataset to write
+    path : Path
+        Output path
+    mode : str
+        "w" to create, "a" to add variables or groups
+    group : str
+        Group to write to
+    **zarr_kwargs
+        Passed to zarr_prepare (compressor, clevel, shuffle, chunk_size)
+    """
+    if is_zarr(path):
+        zarr_prepare(ds, **zarr_kwargs).to_zarr(path, mode=mode, group=group, consolidated=False)
+    else:
+        ds.to_netcdf(path, mode, group=group)
+    return path
+
+
+def replace_path(src, dst):
+    """Move a file or Zarr store, replacing dst"""
+    src, dst = Path(src), Path(dst)
+    if dst.is_dir():
+        shutil.rmtree(dst)
+    os.replace(src, dst)
+    return dst
+
+
+def save_dataset(ds, path, groups=None, temp_name=".tmp", **zarr_kwargs):
+    """Write a dataset and its groups to a temporary path and move it in place"""
+    path = Path(path)
+    tmpf = path.with_name(path.stem + temp_name + path.suffix)
+    write_dataset(ds, tmpf, **zarr_kwargs)
+    for group, gds in (groups or {}).items():
+        write_dataset(gds, tmpf, "a", group=group, **zarr_kwargs)
+    return replace_path(tmpf, path)
+
+
+# Physical value ranges by variable name pattern, used instead of data statistics with ranges="physical"
+PHYSICAL_RANGES = (
+    ("reflectance", (0.0, 2.0)),
+    ("radiance", (0.0, 1000.0)),
+    ("_BT_", (150.0, 350.0)),
+    ("zenith", (0.0, 180.0)),
+    ("azimuth", (-180.0, 360.0)),
+)
+
+
+def physical_range(name):
+    """Known (min, max) for a variable name, or None"""
+    for pattern, vrange in PHYSICAL_RANGES:
+        if pattern in name:
+            return vrange
+    return None
+
+
+def data_ranges(das):
+    """Min and max of several DataArrays, computed in one pass
+
+    All reductions are computed with a single dask.compute call, so a
+    shared upstream graph is only evaluated once.
+
+    Returns
+    -------
+    list
+        (min, max) tuples as floats
+    """
+    import dask
+
+    stats = dask.compute(*[(da.min(), da.max()) for da in das])
+    return [(float(vmin), float(vmax)) for vmin, vmax in stats]
+
+
+def auto_encoding(
+    da, dtype="uint16", zlib=True, complevel=4, clear_encoding=True, data_range=None, float_dtype=None, **kwargs
+):
+    """Set scale/offset encoding packing the values of da into an integer dtype
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Variable to encode (encoding is set in place)
+    dtype : str
+        Integer dtype, its max value is used as fill value
+    data_range : tuple
+        (min, max) to scale to. Computed from the data (in one pass) if None
+    float_dtype : str
+        Store scale_factor and add_offset with this dtype, so the variable
+        is decoded to it (e.g. float32 instead of float64)
+    """
     if clear_encoding:
         da.encoding = {}
     dtype_max = np.iinfo(dtype).max
     dtype_min = np.iinfo(dtype).min
-    data_max = float(da.max())
-    data_min = float(da.min())
+    if data_range is None:
+        data_range = data_ranges([da])[0]
+    data_min, data_max = data_range
     fill_value = dtype_max
     n_vals = dtype_max - dtype_min - 1
-    if data_max != data_min:
+    if data_max != data_min and np.isfinite(data_max - data_min):
         scale = (data_max - data_min)/(n_vals)
         offset = data_min - dtype_min/scale
     else:
         scale = 1
         offset = 0
+    if float_dtype is not None:
+        ftype = np.dtype(float_dtype).type
+        # Round the scale up, so the max value does not map to the fill value
+        scale = ftype(scale) if ftype(scale) >= scale else np.nextafter(ftype(scale), ftype(np.inf))
+        offset = ftype(offset)
     da.encoding.update({
         "dtype": dtype,
         "scale_factor": scale,
@@ -53,6 +265,53 @@ def auto_encoding(da, dtype="uint16", zlib=True, complevel=4, clear_encoding=Tru
     return da
 
 
+def encode_dataset(ds, dtype="uint16", ranges="data", float_dtype=None, **kwargs):
+    """Set auto_encoding on all floating point variables without encoding
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Dataset to encode
+    dtype : str
+        Integer dtype
+    ranges : str
+        "data" to scale to the data min/max (computed for all variables in
+        one pass), or "physical" to use PHYSICAL_RANGES where the variable
+        type is known. Values are then clipped to the range.
+    float_dtype : str
+        Dtype the variables are decoded to, see auto_encoding
+    """
+    names = [
+        name for name, da in ds.data_vars.items()
+        if np.issubdtype(da.dtype, np.floating) and "dtype" not in da.encoding
+    ]
+    vranges = {}
+    if ranges == "physical":
+        for name in names:
+            vrange = physical_range(name)
+            if vrange is not None:
+                vranges[name] = vrange
+                attrs = ds[name].attrs
+                ds[name] = ds[name].clip(*vrange)
+                ds[name].attrs.update(attrs)
+    missing = [name for name in names if name not in vranges]
+    if missing:
+        vranges.update(zip(missing, data_ranges([ds[name] for name in missing])))
+    for name in names:
+        auto_encoding(ds[name], dtype=dtype, data_range=vranges[name], float_dtype=float_dtype, **kwargs)
+    return ds
+
+
+def cast_floats(ds, dtype="float32"):
+    """Cast floating point variables to dtype (the dtype policy for in-memory data)"""
+    if dtype is None:
+        return ds
+    for name, da in ds.data_vars.items():
+        if np.issubdtype(da.dtype, np.floating) and da.dtype != dtype:
+            ds[name] = da.astype(dtype)
+    return ds
+
+
 def set_global_cf_attrs(
     ds,
     title,
@@ -0,0 +1,206 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Sensing start in product identifiers, e.g. S3A_SL_1_RBT____20210401T090000_...
+_date_pattern = re.compile(r'_(\d{8})T\d{6}_')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Rerun the model (prediction and mosaicing) over already preprocessed scenes, without downloading '
+                    'or preprocessing'
+    )
+    parser.add_argument('start', help='First date to process as YYYYMMDD')
+    parser.add_argument('end', nargs='?', default=None, help='Last date to process as YYYYMMDD (default: start)')
+    parser.add_argument(
+        '--work-dir',
+        default=os.path.dirname(os.path.abspath(__file__)),
+        help='Folder with the downloaded .SAFE folders and their preprocessing outputs (default: repository folder)',
+    )
+    parser.add_argument('--out-dir', default='.', help='Folder for the mosaics and their records (default: .)')
+    parser.add_argument('--batch-scenes', type=int, default=4, help='Number of scenes read ahead of the model')
+    parser.add_argument('--batch-size', type=int, default=8, help='Number of tiles pr model batch')
+    parser.add_argument('--plot', action='store_true', help='Also make the output plot of each mosaic')
+    args = parser.parse_args(argv)
+
+    try:
+        args.start = datetime.datetime.strptime(args.start, "%Y%m%d")
+        args.end = datetime.datetime.strptime(args.end, "%Y%m%d") if args.end is not None else args.start
+    except ValueError as e:
+        print("Could not parse date")
+        raise e
+    return args
+
+
+def scene_date(identifier):
+    """
+    Sensing date of a product
+    Args:
+        identifier (str): product identifier
+
+    Returns:
+        (datetime.date) or None if the identifier has no sensing time
+    """
+    match = _date_pattern.search(identifier)
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+
+
+def find_cached_scenes(work_dir, start, end):
+    """
+    Find preprocessed scenes (model input cubes or reflectance files) sensed between two dates
+    Args:
+        work_dir (str): folder with .SAFE folders as written by main.py
+        start (datetime.date): first date
+        end (datetime.date): last date
+
+    Returns:
+        (dict) date -> {identifier: path}. A cube is used over a reflectance file of the same product.
+    """
+    from preprocess.cube import cube_paths
+
+    candidates = []
+    for ext in ('nc', 'zarr'):
+        candidates += glob.glob(os.path.join(work_dir, '*.SAFE', 'reflectance', '*.' + ext))
+    candidates += [
+        p for p in glob.glob(os.path.join(work_dir, '*.SAFE', 'cube', '*.npy'))
+        if not p.endswith('.valid.npy') and os.path.isfile(str(cube_paths(p)[2]))
+    ]
+
+    scenes = {}
+    for path in sorted(candidates):
+        identifier = os.path.splitext(os.path.basename(path))[0]
+        date = scene_date(identifier)
+        if date is None or not start <= date <= end:
+            continue
+        day = scenes.setdefault(date, {})
+        if identifier not in day or path.endswith('.npy'):
+            day[identifier] = path
+    return scenes
+
+
+def load_scene(path):
+    """
+    Load the model input of a preprocessed scene
+    Args:
+        path (str): cube (.npy) or reflectance file
+
+    Returns:
+        (data cube, validity bit mask, transform)
+    """
+    import numpy as np
+    from preprocess import open_cube, read_ofile
+    from preprocess.cube import valid_bits
+
+    if path.endswith('.npy'):
+        cube = open_cube(path)
+        return cube.data, cube.valid, cube.transform
+
+    bands, transform = read_ofile(path)
+    data_cube = np.concatenate([d[:, :, None] for d in bands], -1).astype('float32')
+    data_cube[np.isnan(data_cube)] = 0
+    return data_cube, valid_bits(bands), transform
+
+
+def reinfer_date(date, scenes, out_dir, batch_scenes=4, batch_size=8, plot=False):
+    """
+    Predict all scenes of a date with the current model and mosaic the outputs
+    Args:
+        date (datetime.date): date
+        scenes (dict): identifier -> path of preprocessed scene
+        out_dir (str): folder for the mosaics
+        batch_scenes (int): number of scenes read ahead of the model
+        batch_size (int): number of tiles pr model batch
+        plot (bool): make the output plot
+
+    Returns:
+        (dict) record of the outputs and the model that produced them
+    """
+    from predict import model_hash, predict_cubes
+    from utils.rasterio_utils import merge_aligned_tiff_files
+
+    identifiers = sorted(scenes)
+    record = {
+        'date': date.strftime('%Y%m%d'),
+        'model_sha256': model_hash(),
+        'scenes': {},
+    }
+    rgb_imgs = []
+    fsc_imgs = []
+
+    def load_scenes():
+        # Scenes are read in a background thread, so the model does not wait for I/O
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = [pool.submit(load_scene, scenes[i]) for i in identifiers[:batch_scenes]]
+            for i, identifier in enumerate(identifiers):
+                print('{}/{} {}'.format(i, len(identifiers), identifier))
+                future = pending.pop(0)
+                if i + batch_scenes < len(identifiers):
+                    pending.append(pool.submit(load_scene, scenes[identifiers[i + batch_scenes]]))
+                try:
+                    result = future.result()
+                except Exception:
+                    print('Failed {}/{} {}'.format(i, len(identifiers), identifier))
+                    traceback.print_exc()
+                    continue
+                yield (identifier,) + result
+
+    # Tiles from all scenes of the date are packed into full batches
+    try:
+        for identifier, fsc_tiff, rgb_tiff in predict_cubes(load_scenes(), batch_size):
+            rgb_imgs.append(rgb_tiff)
+            fsc_imgs.append(fsc_tiff)
+            record['scenes'][identifier] = {'input': scenes[identifier], 'fsc': fsc_tiff, 'rgb': rgb_tiff}
+    except:
+        print('Prediction failed for {}'.format(record['date']))
+        traceback.print_exc()
+
+    if len(fsc_imgs) == 0:
+        print('No scenes could be predicted for {}'.format(record['date']))
+        return record
+
+    tags = {'model_sha256': record['model_sha256']}
+    record['rgb'] = os.path.join(out_dir, 'rgb_{}.tif'.format(record['date']))
+    record['fsc'] = os.path.join(out_dir, 'fsc_{}.tif'.format(record['date']))
+    rgb_merge = merge_aligned_tiff_files(rgb_imgs, record['rgb'], no_data_val=-2, tags=tags)
+    fsc_merge = merge_aligned_tiff_files(fsc_imgs, record['fsc'], no_data_val=-2, tags=tags)
+
+    if plot:
+        from utils.output_plot import output_plot
+        output_plot(out_dir, rgb_merge, fsc_merge, 'fsc_{}'.format(record['date']))
+
+    with open(os.path.join(out_dir, 'fsc_{}.json'.format(record['date'])), 'w') as f:
+        json.dump(record, f, indent=2)
+    return record
+
+
+def main(start, end, work_dir, out_dir='.', batch_scenes=4, batch_size=8, plot=False):
+    # Heavy modules are imported here (not at module level) to keep CLI help fast
+    from predict import load_model, model_hash
+
+    scenes = find_cached_scenes(work_dir, start.date(), end.date())
+    if len(scenes) == 0:
+        print('Could not find any preprocessed scenes from {} to {} in {}'.format(start.date(), end.date(), work_dir))
+        return []
+
+    os.makedirs(out_dir, exist_ok=True)
+    load_model()
+    print('Model {}'.format(model_hash()))
+
+    records = []
+    for date in sorted(scenes):
+        print('Processing {} scenes from {}'.format(len(scenes[date]), date))
+        records.append(reinfer_date(date, scenes[date], out_dir, batch_scenes, batch_size, plot))
+    return records
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.start, args.end, args.work_dir, args.out_dir, args.batch_scenes, args.batch_size, args.plot)
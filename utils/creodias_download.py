@@ -11,18 +11,40 @@ from tqdm import tqdm
 
 DIRNAME = os.path.dirname(os.path.abspath(__file__))
 
-try:
-    with open(os.path.join(DIRNAME,'..','creodias_credentials.txt')) as f:
-        lines = f.readlines()
-        user, password = lines[0:2]
-        user = user.strip('\n').strip('\b')
-        password = password.strip('\n').strip('\b')
-except:
-    raise Exception('Could not read login-credentials for creodias.eu. These should be stored in "creodias_credentials.txt". See README.md for more instructions.')
+# Endpoints can be overridden with environment variables or configure(), i.e. to use utils.fake_creodias
+FINDER_URL = os.environ.get("CREODIAS_FINDER_URL", "http://finder.creodias.eu")
+DOWNLOAD_URL = os.environ.get("CREODIAS_DOWNLOAD_URL", "https://zipper.creodias.eu/download")
+TOKEN_URL = os.environ.get(
+    "CREODIAS_TOKEN_URL", "https://auth.creodias.eu/auth/realms/DIAS/protocol/openid-connect/token"
+)
+
 
+def configure(finder_url=None, download_url=None, token_url=None):
+    """Set the Finder, download and token endpoints"""
+    global FINDER_URL, API_URL, DOWNLOAD_URL, TOKEN_URL
+    if finder_url is not None:
+        FINDER_URL = finder_url.rstrip("/")
+        API_URL = _api_url(FINDER_URL)
+    if download_url is not None:
+        DOWNLOAD_URL = download_url.rstrip("/")
+    if token_url is not None:
+        TOKEN_URL = token_url
 
-DOWNLOAD_URL = "https://zipper.creodias.eu/download"
-TOKEN_URL = "https://auth.creodias.eu/auth/realms/DIAS/protocol/openid-connect/token"
+
+def _get_credentials():
+    """Read credentials from the CREODIAS_USERNAME/CREODIAS_PASSWORD environment variables or
+    creodias_credentials.txt"""
+    if "CREODIAS_USERNAME" in os.environ:
+        return os.environ["CREODIAS_USERNAME"], os.environ.get("CREODIAS_PASSWORD", "")
+    try:
+        with open(os.path.join(DIRNAME,'..','creodias_credentials.txt')) as f:
+            lines = f.readlines()
+            user, password = lines[0:2]
+            user = user.strip('\n').strip('\b')
+            password = password.strip('\n').strip('\b')
+    except:
+        raise Exception('Could not read login-credentials for creodias.eu. These should be stored in "creodias_credentials.txt". See README.md for more instructions.')
+    return user, password
 
 
 def _get_token(username, password):
@@ -53,7 +75,7 @@ def download(uid,  outfile, show_progress=True):
     outfile:
         Path where incomplete downloads are stored
     """
-    token = _get_token(user, password)
+    token = _get_token(*_get_credentials())
     url = f"{DOWNLOAD_URL}/{uid}?token={token}"
     _download_raw_data(url, outfile, show_progress)
 
@@ -89,10 +111,13 @@ from shapely.geometry import shape
 
 import re
 
-API_URL = (
-    "http://finder.creodias.eu/resto/api/collections/{collection}"
-    "/search.json?maxRecords=1000"
-)
+
+
+def _api_url(finder_url):
+    return finder_url + "/resto/api/collections/{collection}/search.json?maxRecords=1000"
+
+
+API_URL = _api_url(FINDER_URL)
 ONLINE_STATUS_CODES = "34|37|0"
 
 
@@ -102,6 +127,8 @@ def query(
     end_date=None,
     geometry=None,
     status=ONLINE_STATUS_CODES,
+    cache=None,
+    max_workers=4,
     **kwargs,
 ):
     """Query the EOData Finder API
@@ -118,6 +145,10 @@ def query(
         area of interest as well-known text string
     status : str
         allowed online/offline statuses (|-separated for OR)
+    cache : utils.query_cache.QueryCache, optional
+        cache to read results from and store results in
+    max_workers : int
+        number of result pages to fetch concurrently
     **kwargs
         Additional arguments can be used to specify other query parameters,
         e.g. productType=L1GT
@@ -137,14 +168,59 @@ def query(
         **kwargs,
     )
 
+    if cache is not None:
+        cache_end_date = _add_time(_parse_date(end_date)) if end_date is not None else None
+        cache_key = cache.key(
+            collection,
+            _parse_date(start_date) if start_date is not None else None,
+            cache_end_date,
+            _parse_geometry(geometry) if geometry is not None else None,
+            status,
+            endpoint=FINDER_URL,
+            params=kwargs,
+        )
+        query_response = cache.get(cache_key, cache_end_date)
+        if query_response is not None:
+            return query_response
+
+    query_response = _fetch_pages(query_url, max_workers)
+
+    if cache is not None:
+        cache.put(cache_key, query_response)
+    return query_response
+
+
+def _get_json(url):
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+def _fetch_pages(query_url, max_workers):
+    """Fetch all result pages of a query. The total number of results is requested with the first
+    page (Finder only counts them on request), and the pages after it are fetched concurrently"""
+    data = _get_json(f"{query_url}&exactCount=1")
+    pages = [data]
+
+    next_url = _get_next_page(data["properties"]["links"])
+    n_total = data["properties"].get("totalResults")
+    n_per_page = data["properties"].get("itemsPerPage") or len(data["features"])
+    if next_url and n_total and n_per_page:
+        n_pages = -(-n_total // n_per_page)
+        page_urls = [f"{query_url}&page={page}" for page in range(2, n_pages + 1)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages.extend(executor.map(_get_json, page_urls))
+    else:
+        # Number of pages is unknown, follow the links
+        while next_url:
+            data = _get_json(next_url)
+            pages.append(data)
+            next_url = _get_next_page(data["properties"]["links"])
+
     query_response = {}
-    while query_url:
-        response = requests.get(query_url)
-        response.raise_for_status()
-        data = response.json()
+    for data in pages:
         for feature in data["features"]:
             query_response[feature["id"]] = feature
-        query_url = _get_next_page(data["properties"]["links"])
     return query_response
 
 
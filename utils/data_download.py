@@ -9,11 +9,32 @@ import datetime
 import shapely.wkt
 
 from utils.creodias_download import download, query
+from utils.product_catalog import ProductCatalog
+from utils.query_cache import QueryCache
+from utils.scene_pruning import prune_scenes
+from utils.scene_selection import select_scenes
 
 DIRNAME = os.path.dirname(os.path.abspath(__file__))
 
 
-def get_product_identifiers(date):
+def get_product_identifiers(
+    date, cache=None, catalog=None, optimize_coverage=True, target_coverage=0.98, prune=True, prune_kwargs=None
+):
+    """
+    Find S3A SLSTR morning scenes covering Norway and Sweden
+    Args:
+        date (datetime.datetime): date to find scenes for
+        cache (utils.query_cache.QueryCache, None): cache for catalog queries (a default on-disk cache is used if None)
+        catalog (utils.product_catalog.ProductCatalog, None): local product catalog to register the scenes in
+            (the default on-disk catalog is used if None)
+        optimize_coverage (bool): only keep a minimal set of scenes covering the AOI (see utils.scene_selection)
+        target_coverage (float): fraction of the coverage of all candidate scenes the selected scenes should reach
+        prune (bool): drop scenes that are too cloudy or have too little sun before download (see utils.scene_pruning)
+        prune_kwargs (dict, None): thresholds passed on to utils.scene_pruning.prune_scenes
+
+    Returns:
+        list of scenes (Finder API features)
+    """
     date = date.date()
     footprint = geojson_to_wkt(read_geojson(os.path.join(DIRNAME, 'norway_sweden.json')))
 
@@ -22,31 +43,54 @@ def get_product_identifiers(date):
         start_date=date,
         end_date=date+ datetime.timedelta(days=1),
         geometry=footprint,
+        cache=cache if cache is not None else QueryCache(),
+    )
+
+    catalog = catalog if catalog is not None else ProductCatalog()
+    catalog.add_products(scenes.values())
+
+    aoi = shapely.wkt.loads(footprint)
+
+    #Require some overlap. Limiting to the day uses the start time index, so the cost does not grow with the catalog
+    day_start = datetime.datetime.combine(date, datetime.time())
+    candidates = catalog.query(
+        aoi,
+        start_time=day_start,
+        end_time=day_start + datetime.timedelta(days=1),
+        min_overlap=.10,
+        product_type='SL_1_RBT___',
+        ids=scenes.keys(),
     )
 
     selected_scenes = []
-    for scene in scenes.values():
+    for scene, overlap in candidates:
         id = scene['properties']['title']
 
         #Only S3A SLSTR level 1
         if 'S3A_SL_1_RBT___' not in id:
             continue
-        poly1 = shapely.wkt.loads(footprint)
-        poly2 = shapely.wkt.loads(geojson_to_wkt(scene))
-        intersection = poly1.intersection(poly2)
-
-        #Require some overlap
-        if intersection.area/poly1.area < .10:
-            continue
         hour_of_day = int(id.split('_')[7].split('T')[1][:2])
 
         #Limit to morning passes
         if not( 7 <= hour_of_day <= 12):
             continue
-        selected_scenes.append(scene)
-
-
-    return selected_scenes
+        selected_scenes.append((scene, overlap))
+
+    usefulness = None
+    if prune:
+        selected_scenes, pruned, usefulness = prune_scenes(selected_scenes, **(prune_kwargs or {}))
+        for scene, overlap in pruned:
+            print('Pruned {} (usefulness {:.2f})'.format(
+                scene['properties']['title'], usefulness.get(scene['id'], 0)))
+
+    if optimize_coverage:
+        selected_scenes, report = select_scenes(
+            selected_scenes, aoi, target_coverage=target_coverage, weights=usefulness
+        )
+        print(report)
+        return selected_scenes
+
+    return [scene for scene, overlap in selected_scenes]
 def download_sentinel_data(  scene, output_location):
     """
     Download and unzip a tile with satelite data.
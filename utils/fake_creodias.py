@@ -0,0 +1,413 @@
+"""
+Local stand-in for the creodias Finder, download (zipper) and token APIs.
+
+Serves synthetic Sentinel-3 SLSTR L1 RBT products over Norway, so the full main.py pipeline can be run and load-tested
+without network access or credentials. Bandwidth and latency of the service can be controlled.
+
+Usage:
+    python -m utils.fake_creodias --port 8765 --bandwidth 20e6 --latency 0.1
+
+and run the pipeline with the environment variables printed at startup, i.e.
+
+    CREODIAS_FINDER_URL=http://127.0.0.1:8765 \\
+    CREODIAS_DOWNLOAD_URL=http://127.0.0.1:8765/download \\
+    CREODIAS_TOKEN_URL=http://127.0.0.1:8765/token \\
+    CREODIAS_USERNAME=fake python main.py 20210401
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import numpy as np
+
+ESUNS = [1837.39, 1525.94, 956.17, 365.9, 248.33, 78.33]
+
+_MANIFEST_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" xmlns:sentinel-safe="http://www.esa.int/safe/sentinel/1.1"
+ xmlns:sentinel3="http://www.esa.int/safe/sentinel/sentinel-3/1.0"
+ xmlns:slstr="http://www.esa.int/safe/sentinel/sentinel-3/slstr/1.0" xmlns:gml="http://www.opengis.net/gml">
+<metadataSection>
+<metadataObject ID="acquisitionPeriod"><metadataWrap><xmlData><sentinel-safe:acquisitionPeriod>
+<sentinel-safe:startTime>{start}</sentinel-safe:startTime>
+<sentinel-safe:stopTime>{stop}</sentinel-safe:stopTime>
+</sentinel-safe:acquisitionPeriod></xmlData></metadataWrap></metadataObject>
+<metadataObject ID="platform"><metadataWrap><xmlData><sentinel-safe:platform>
+<sentinel-safe:nssdcIdentifier>2016-011A</sentinel-safe:nssdcIdentifier>
+<sentinel-safe:familyName>SENTINEL-3</sentinel-safe:familyName>
+<sentinel-safe:number>A</sentinel-safe:number>
+<sentinel-safe:instrument>
+<sentinel-safe:familyName abbreviation="SLSTR">Sea and Land Surface Temperature Radiometer</sentinel-safe:familyName>
+</sentinel-safe:instrument>
+</sentinel-safe:platform></xmlData></metadataWrap></metadataObject>
+<metadataObject ID="generalProductInformation"><metadataWrap><xmlData><sentinel3:generalProductInformation>
+<sentinel3:productName>{name}</sentinel3:productName>
+<sentinel3:productType>SL_1_RBT___</sentinel3:productType>
+<sentinel3:timeliness>{timeliness}</sentinel3:timeliness>
+</sentinel3:generalProductInformation></xmlData></metadataWrap></metadataObject>
+<metadataObject ID="measurementOrbitReference"><metadataWrap><xmlData><sentinel-safe:orbitReference>
+<sentinel-safe:orbitNumber groundTrackDirection="descending" type="start">{orbit}</sentinel-safe:orbitNumber>
+<sentinel-safe:relativeOrbitNumber groundTrackDirection="descending" type="start">{relorbit}</sentinel-safe:relativeOrbitNumber>
+<sentinel-safe:passNumber groundTrackDirection="descending" type="start">{passnumber}</sentinel-safe:passNumber>
+<sentinel-safe:relativePassNumber groundTrackDirection="descending" type="start">{relpass}</sentinel-safe:relativePassNumber>
+</sentinel-safe:orbitReference></xmlData></metadataWrap></metadataObject>
+<metadataObject ID="measurementFrameSet"><metadataWrap><xmlData><sentinel-safe:frameSet><sentinel-safe:footPrint
+ srsName="http://www.opengis.net/def/crs/EPSG/0/4326"><gml:posList>{poslist}</gml:posList></sentinel-safe:footPrint>
+</sentinel-safe:frameSet></xmlData></metadataWrap></metadataObject>
+</metadataSection>
+</xfdu:XFDU>
+"""
+
+
+class SyntheticProducts:
+    """
+    Deterministic set of synthetic SLSTR products
+    Args:
+        cache_dir (str): folder to store generated product zip files in
+        products_per_day (int): number of morning passes per day
+        shape_an (tuple): (rows, columns) of the 500 m grid. The 1 km grid is half of this. The default footprints
+            cover 13-17% of the Norway/Sweden AOI each, over the 10% data_download.get_product_identifiers requires.
+        spacing (float): ground distance between pixels of the 500 m grid in meters. The default gives realistic
+            geolocation, and the default scene preprocesses with a peak of about 1 GB (2 GB while the resampling tables
+            of a new orbit are built). Larger values give larger footprints (2000 covers a full SLSTR swath width with
+            the default grid size, but needs several GB of memory to preprocess).
+    """
+
+    def __init__(self, cache_dir, products_per_day=3, shape_an=(900, 700), spacing=500):
+        self.cache_dir = cache_dir
+        self.products_per_day = products_per_day
+        self.shape_an = shape_an
+        self.scale = spacing / 500
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def products(self, day):
+        """Products sensed on a date as (uid, meta) pairs"""
+        out = []
+        for i in range(self.products_per_day):
+            # Consecutive dumps of the same descending pass, moving south-west along track over Norway and Sweden
+            start = datetime.datetime.combine(day, datetime.time(9, 0)) + datetime.timedelta(minutes=3 * i)
+            stop = start + datetime.timedelta(minutes=3)
+            orbit = 20000 + (day - datetime.date(2020, 1, 1)).days * 14
+            relorbit = orbit % 385 + 1
+            name = 'S3A_SL_1_RBT____{}_{}_{}_0180_{:03d}_{:03d}_{:04d}_LN2_O_NT_004.SEN3'.format(
+                start.strftime('%Y%m%dT%H%M%S'),
+                stop.strftime('%Y%m%dT%H%M%S'),
+                (stop + datetime.timedelta(hours=2)).strftime('%Y%m%dT%H%M%S'),
+                orbit // 385 % 1000,
+                relorbit,
+                1800 + 180 * i,
+            )
+            center = (68 - 3 * i, 18 - i)
+            out.append(('{:08d}-{:04d}'.format(int(day.strftime('%Y%m%d')), i), {
+                'name': name,
+                'start': start,
+                'stop': stop,
+                'orbit': orbit,
+                'relorbit': relorbit,
+                'center': center,
+            }))
+        return out
+
+    def find(self, uid):
+        day = datetime.datetime.strptime(uid.split('-')[0], '%Y%m%d').date()
+        return dict(self.products(day))[uid]
+
+    def geolocation(self, meta, shape, resolution):
+        """Latitude and longitude of a grid with (along track, across track) resolution in meters"""
+        rows, cols = shape
+        lat0, lon0 = meta['center']
+        r, c = np.meshgrid(
+            (np.arange(rows) - rows / 2) * resolution[0] * self.scale,
+            (np.arange(cols) - cols / 2) * resolution[1] * self.scale,
+            indexing='ij',
+        )
+        lat = lat0 - r / 111e3
+        lon = lon0 + c / 111e3 / np.cos(np.radians(lat))
+        return lat, lon
+
+    def footprint(self, meta):
+        lat, lon = self.geolocation(meta, self.shape_an, (500, 500))
+        corners = [(0, 0), (0, -1), (-1, -1), (-1, 0), (0, 0)]
+        return [[float(lon[i, j]), float(lat[i, j])] for i, j in corners]
+
+    def feature(self, uid, meta):
+        return {
+            'type': 'Feature',
+            'id': uid,
+            'geometry': {'type': 'Polygon', 'coordinates': [self.footprint(meta)]},
+            'properties': {
+                'title': meta['name'],
+                'startDate': meta['start'].isoformat() + 'Z',
+                'completionDate': meta['stop'].isoformat() + 'Z',
+                'status': 0,
+                'cloudCover': None,
+            },
+        }
+
+    def zip_path(self, uid):
+        """Path to the product zip file, generated on first request"""
+        path = os.path.join(self.cache_dir, uid + '.zip')
+        with self._lock:
+            if not os.path.isfile(path):
+                self._write_zip(path, self.find(uid))
+        return path
+
+    def _write_zip(self, path, meta):
+        import xarray as xr
+
+        rng = np.random.default_rng([meta['orbit'], meta['start'].minute])
+        shape_an = self.shape_an
+        shape_in = (shape_an[0] // 2, shape_an[1] // 2)
+        shape_tn = (shape_in[0], shape_in[1] // 16 + 2)  # Tie points every 16 km across track
+
+        lat_tn, lon_tn = self.geolocation(meta, shape_tn, (1000, 16000))
+        sza = 50 + 10 * (lat_tn - meta['center'][0]) / 5
+        cos_sza = np.cos(np.radians(np.clip(sza, 0, 89)))
+        cos_sza_an = np.repeat(np.repeat(cos_sza[:, :1], shape_an[0] // shape_tn[0], 0), shape_an[1], 1)
+
+        def dataset(resolution, **variables):
+            ds = xr.Dataset({
+                var: (('rows', 'columns'), data.astype('float32'), {'units': units})
+                for var, (data, units) in variables.items()
+            })
+            ds.attrs['resolution'] = resolution
+            return ds
+
+        files = {}
+        for band, esun in enumerate(ESUNS, 1):
+            refl = rng.uniform(0.05, 0.9, shape_an)
+            var = 'S{}_radiance_an'.format(band)
+            files[var + '.nc'] = dataset(
+                '[ 500 500 ]', **{var: (refl * esun * cos_sza_an / np.pi, 'mW.m-2.sr-1.nm-1')})
+        for band in (7, 8, 9):
+            var = 'S{}_BT_in'.format(band)
+            files[var + '.nc'] = dataset('[ 1000 1000 ]', **{var: (rng.uniform(245, 290, shape_in), 'K')})
+
+        lat_an, lon_an = self.geolocation(meta, shape_an, (500, 500))
+        lat_in, lon_in = self.geolocation(meta, shape_in, (1000, 1000))
+        sat_zenith = np.abs(np.linspace(-55, 55, shape_tn[1]))[None].repeat(shape_tn[0], 0)
+        files['geodetic_an.nc'] = dataset(
+            '[ 500 500 ]', latitude_an=(lat_an, 'degrees_north'), longitude_an=(lon_an, 'degrees_east'))
+        files['geodetic_in.nc'] = dataset(
+            '[ 1000 1000 ]', latitude_in=(lat_in, 'degrees_north'), longitude_in=(lon_in, 'degrees_east'))
+        files['geodetic_tx.nc'] = dataset(
+            '[ 16000 1000 ]', latitude_tx=(lat_tn, 'degrees_north'), longitude_tx=(lon_tn, 'degrees_east'))
+        files['geometry_tn.nc'] = dataset(
+            '[ 16000 1000 ]',
+            solar_zenith_tn=(sza, 'degrees'),
+            solar_azimuth_tn=(np.full(shape_tn, 160.0), 'degrees'),
+            sat_zenith_tn=(sat_zenith, 'degrees'),
+            sat_azimuth_tn=(np.full(shape_tn, 100.0), 'degrees'),
+        )
+
+        manifest = _MANIFEST_TEMPLATE.format(
+            start=meta['start'].isoformat() + '.000000Z',
+            stop=meta['stop'].isoformat() + '.000000Z',
+            name=meta['name'],
+            timeliness='NT',
+            orbit=meta['orbit'],
+            relorbit=meta['relorbit'],
+            passnumber=2 * meta['orbit'],
+            relpass=2 * meta['relorbit'],
+            poslist=' '.join('{} {}'.format(lat, lon) for lon, lat in self.footprint(meta)),
+        )
+
+        tmp_path = path + '.tmp'
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tdir, zipfile.ZipFile(tmp_path, 'w') as zf:
+            zf.writestr(meta['name'] + '/xfdumanifest.xml', manifest)
+            for fname, ds in files.items():
+                ds.to_netcdf(os.path.join(tdir, fname))
+                zf.write(os.path.join(tdir, fname), meta['name'] + '/' + fname)
+        os.replace(tmp_path, path)
+
+
+def make_handler(products, bandwidth=None, latency=0.0, page_size=None):
+    """
+    Make a request handler class for the fake service
+    Args:
+        products (SyntheticProducts): products to serve
+        bandwidth (float, None): maximum download rate in bytes per second per connection (unlimited if None)
+        latency (float): seconds to wait before answering each request
+        page_size (int, None): override maxRecords of search requests (to exercise pagination)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, obj, status=200):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            time.sleep(latency)
+            length = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(length)
+            if self.path.startswith('/token'):
+                self._send_json({'access_token': 'fake-token', 'expires_in': 600})
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def do_GET(self):
+            time.sleep(latency)
+            url = urlparse(self.path)
+            match = re.match(r'/resto/api/collections/([^/]+)/search.json', url.path)
+            if match:
+                return self._search(url)
+            if url.path.startswith('/download/'):
+                return self._download(url.path.split('/')[-1])
+            self._send_json({'error': 'not found'}, 404)
+
+        def _search(self, url):
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            start = datetime.datetime.fromisoformat(params['startDate']).date()
+            end = datetime.datetime.fromisoformat(params.get('completionDate', params['startDate'])).date()
+            per_page = page_size or int(params.get('maxRecords', 1000))
+            page = int(params.get('page', 1))
+
+            features = []
+            day = start
+            while day <= end:
+                features.extend(products.feature(uid, meta) for uid, meta in products.products(day))
+                day += datetime.timedelta(days=1)
+
+            page_features = features[(page - 1) * per_page:page * per_page]
+            links = []
+            if page * per_page < len(features):
+                query = urlencode(dict(params, page=page + 1))
+                links.append({'rel': 'next', 'href': 'http://{}:{}{}?{}'.format(
+                    *self.server.server_address, url.path, query)})
+            self._send_json({
+                'type': 'FeatureCollection',
+                'properties': {
+                    # Like Finder, only counted on request
+                    'totalResults': len(features) if params.get('exactCount') in ('1', 'true') else None,
+                    'itemsPerPage': per_page,
+                    'links': links,
+                },
+                'features': page_features,
+            })
+
+        def _download(self, uid):
+            try:
+                path = products.zip_path(uid)
+            except (KeyError, ValueError):
+                return self._send_json({'error': 'not found'}, 404)
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+
+            range_header = self.headers.get('Range')
+            match = re.match(r'bytes=(\d*)-(\d*)', range_header or '')
+            if match:
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = int(match.group(2)) if match.group(2) else size - 1
+                else:
+                    start = size - int(match.group(2))
+                end = min(end, size - 1)
+                if start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            chunk_size = int(bandwidth / 10) if bandwidth else 2 ** 20
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    t0 = time.time()
+                    chunk = f.read(min(chunk_size, remaining))
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    if bandwidth:
+                        time.sleep(max(0.0, len(chunk) / bandwidth - (time.time() - t0)))
+
+    return Handler
+
+
+def serve(host='127.0.0.1', port=8765, cache_dir=None, bandwidth=None, latency=0.0, page_size=None, **kwargs):
+    """
+    Start the fake service in a background thread
+    Args:
+        host (str): interface to listen on
+        port (int): port to listen on (0 to pick a free port)
+        cache_dir (str, None): folder for generated products (a temporary folder if None)
+        bandwidth (float, None): maximum download rate in bytes per second per connection
+        latency (float): seconds to wait before answering each request
+        page_size (int, None): number of search results per page
+        **kwargs: passed on to SyntheticProducts
+
+    Returns:
+        (server, dict with environment variables pointing utils.creodias_download to the service)
+    """
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='fake_creodias_')
+    products = SyntheticProducts(cache_dir, **kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(products, bandwidth, latency, page_size))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = 'http://{}:{}'.format(*server.server_address)
+    env = {
+        'CREODIAS_FINDER_URL': url,
+        'CREODIAS_DOWNLOAD_URL': url + '/download',
+        'CREODIAS_TOKEN_URL': url + '/token',
+        'CREODIAS_USERNAME': 'fake',
+        'CREODIAS_PASSWORD': 'fake',
+    }
+    return server, env
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-dir', default=None, help='Folder for generated products')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Bytes per second per connection')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each request')
+    parser.add_argument('--page-size', type=int, default=None, help='Search results per page')
+    parser.add_argument('--products-per-day', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=900, help='Rows of the 500 m grid')
+    parser.add_argument('--columns', type=int, default=700, help='Columns of the 500 m grid')
+    parser.add_argument('--spacing', type=float, default=500, help='Ground spacing of the 500 m grid in meters')
+    args = parser.parse_args()
+
+    server, env = serve(
+        args.host,
+        args.port,
+        args.cache_dir,
+        args.bandwidth,
+        args.latency,
+        args.page_size,
+        products_per_day=args.products_per_day,
+        shape_an=(args.rows, args.columns),
+        spacing=args.spacing,
+    )
+    for k, v in env.items():
+        print('export {}={}'.format(k, v))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
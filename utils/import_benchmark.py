@@ -0,0 +1,65 @@
+"""
+Benchmark of startup cost: import time of the main modules and of the main.py CLI help, each measured in a fresh
+interpreter.
+
+Usage:
+    python -m utils.import_benchmark [module ...]
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = [
+    'main',
+    'predict',
+    'preprocess',
+    'preprocess.preprocess_reflectance',
+    'utils.creodias_download',
+    'utils.data_download',
+]
+
+
+def time_import(module, repeat=3):
+    """
+    Measure the time to import a module in a fresh interpreter
+    Args:
+        module (str): module to import
+        repeat (int): number of measurements
+
+    Returns:
+        (float) best time in seconds
+    """
+    code = 'import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)'.format(module)
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def time_cli_help(repeat=3):
+    """
+    Measure the wall time of 'python main.py --help' (including interpreter startup)
+    """
+    code = (
+        'import subprocess, sys, time; t = time.perf_counter(); '
+        'subprocess.run([sys.executable, "main.py", "--help"], check=True, capture_output=True); '
+        'print(time.perf_counter() - t)'
+    )
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip()))
+    return min(times)
+
+
+if __name__ == '__main__':
+    modules = sys.argv[1:] or MODULES
+    for module in modules:
+        try:
+            print('{:40s} {:8.3f} s'.format('import ' + module, time_import(module)))
+        except subprocess.CalledProcessError as e:
+            print('{:40s} failed: {}'.format('import ' + module, e.stderr.strip().splitlines()[-1]))
+    print('{:40s} {:8.3f} s'.format('main.py --help', time_cli_help()))
@@ -1,11 +1,12 @@
 from utils.color_output_products import fsc_to_color
-import matplotlib
-matplotlib.use('Agg') #for headless servers
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 
 def output_plot( path, rgb_merge, fsc_merge, name):
+    import matplotlib
+    matplotlib.use('Agg') #for headless servers
+    import matplotlib.pyplot as plt
+
     rgb_merge = rgb_merge.astype('float')
     rgb_merge[rgb_merge == -2] = np.nan
     fsc_merge = fsc_to_color(fsc_merge.squeeze(), export=False)
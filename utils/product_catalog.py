@@ -0,0 +1,246 @@
+"""
+Local catalog of Sentinel-3 products seen in Finder queries.
+
+Footprints are stored in an SQLite database with an R-tree index on their bounding boxes. Spatial queries first filter on
+the R-tree and acquisition time in SQL and then test the candidates exactly against a prepared AOI geometry, so questions
+like "which scenes cover polygon X between dates A and B" are answered without network calls.
+"""
+import datetime
+import json
+import os
+import sqlite3
+
+import shapely.wkb
+from shapely.geometry import shape
+from shapely.prepared import prep
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CATALOG_PATH = os.path.join(DIRNAME, '..', 'cache', 'product_catalog.sqlite')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    rid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE NOT NULL,
+    title TEXT NOT NULL,
+    product_type TEXT,
+    platform TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    relative_orbit INTEGER,
+    frame INTEGER,
+    timeliness TEXT,
+    cloud_cover REAL,
+    footprint BLOB NOT NULL,
+    feature TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_start_time ON products (start_time);
+CREATE VIRTUAL TABLE IF NOT EXISTS products_rtree USING rtree(rid, minx, maxx, miny, maxy);
+"""
+
+
+def parse_product_title(title):
+    """
+    Parse the fields of a Sentinel-3 product name, i.e.
+    S3A_SL_1_RBT____20200101T093012_20200101T093312_20200101T113516_0179_053_193_1980_LN2_O_NT_004.SEN3
+
+    Args:
+        title (str): product name
+
+    Returns:
+        dict with platform, product_type, start_time, end_time, creation_time (datetime.datetime), duration,
+        cycle, relative_orbit, frame (int), centre, timeliness and baseline (str)
+    """
+    fields = title.replace('.SEN3', '').split('_')
+
+    def to_datetime(s):
+        return datetime.datetime.strptime(s, '%Y%m%dT%H%M%S')
+
+    return {
+        'platform': fields[0],
+        'product_type': title[4:15],
+        'start_time': to_datetime(fields[7]),
+        'end_time': to_datetime(fields[8]),
+        'creation_time': to_datetime(fields[9]),
+        'duration': int(fields[10]),
+        'cycle': int(fields[11]),
+        'relative_orbit': int(fields[12]),
+        'frame': int(fields[13]),
+        'centre': fields[14],
+        'timeliness': fields[16],
+        'baseline': fields[17],
+    }
+
+
+def load_aoi(path, feature_number=0):
+    """
+    Read an AOI polygon from a GeoJSON file
+    Args:
+        path (str): path to GeoJSON file
+        feature_number (int, None): feature to use from a FeatureCollection (all features are merged if None)
+
+    Returns:
+        shapely geometry
+    """
+    with open(path) as f:
+        geojson = json.load(f)
+    if geojson.get('type') != 'FeatureCollection':
+        return shape(geojson.get('geometry', geojson))
+    features = geojson['features']
+    if feature_number is not None:
+        return shape(features[feature_number]['geometry'])
+    geom = shape(features[0]['geometry'])
+    for feature in features[1:]:
+        geom = geom.union(shape(feature['geometry']))
+    return geom
+
+
+class ProductCatalog:
+    """
+    SQLite catalog of products with footprint, acquisition time, orbit and timeliness.
+
+    Args:
+        path (str): path of SQLite database (use ':memory:' for a temporary catalog)
+    """
+
+    def __init__(self, path=DEFAULT_CATALOG_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.executescript(_SCHEMA)
+        self._footprints = {}
+        self._prepared_aois = {}
+
+    def close(self):
+        self._con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_products(self, features):
+        """
+        Insert or update products from Finder API features
+        Args:
+            features (iterable of dict): features as returned by creodias_download.query
+        """
+        rows = []
+        for feature in features:
+            title = feature['properties']['title']
+            footprint = shape(feature['geometry'])
+            try:
+                meta = parse_product_title(title)
+            except (IndexError, ValueError):
+                meta = {}
+            rows.append((
+                feature['id'],
+                title,
+                meta.get('product_type'),
+                meta.get('platform'),
+                meta['start_time'].isoformat() if meta else feature['properties'].get('startDate'),
+                meta['end_time'].isoformat() if meta else feature['properties'].get('completionDate'),
+                meta.get('relative_orbit'),
+                meta.get('frame'),
+                meta.get('timeliness'),
+                feature['properties'].get('cloudCover'),
+                footprint.wkb,
+                json.dumps(feature),
+                footprint.bounds,
+            ))
+
+        with self._con:
+            for row in rows:
+                self._con.execute(
+                    """INSERT INTO products (id, title, product_type, platform, start_time, end_time, relative_orbit,
+                                             frame, timeliness, cloud_cover, footprint, feature)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(id) DO UPDATE SET cloud_cover=excluded.cloud_cover, feature=excluded.feature""",
+                    row[:-1],
+                )
+                rid = self._con.execute('SELECT rid FROM products WHERE id = ?', (row[0],)).fetchone()[0]
+                minx, miny, maxx, maxy = row[-1]
+                self._con.execute(
+                    'INSERT OR REPLACE INTO products_rtree (rid, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)',
+                    (rid, minx, maxx, miny, maxy),
+                )
+
+    def __len__(self):
+        return self._con.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+    def _footprint(self, rid, wkb):
+        try:
+            return self._footprints[rid]
+        except KeyError:
+            self._footprints[rid] = shapely.wkb.loads(wkb)
+            return self._footprints[rid]
+
+    def _prepared(self, aoi):
+        key = aoi.wkb
+        if key not in self._prepared_aois:
+            self._prepared_aois[key] = prep(aoi)
+        return self._prepared_aois[key]
+
+    def query(self, aoi, start_time=None, end_time=None, min_overlap=0.0, product_type=None, ids=None):
+        """
+        Find products intersecting an AOI within a time interval
+        Args:
+            aoi (shapely geometry): area of interest (lon/lat)
+            start_time (datetime.datetime, None): earliest sensing start time
+            end_time (datetime.datetime, None): latest sensing start time
+            min_overlap (float): minimum fraction of the AOI area covered by the product footprint
+            product_type (str, None): only include products of this type, i.e. 'SL_1_RBT___'
+            ids (iterable of str, None): only include products with these ids
+
+        Returns:
+            list of (feature, overlap fraction) sorted by sensing start time
+        """
+        minx, miny, maxx, maxy = aoi.bounds
+        sql = ["""SELECT p.rid, p.footprint, p.feature FROM products p
+                  JOIN products_rtree r ON p.rid = r.rid
+                  WHERE r.maxx >= ? AND r.minx <= ? AND r.maxy >= ? AND r.miny <= ?"""]
+        params = [minx, maxx, miny, maxy]
+        if start_time is not None:
+            sql.append('AND p.start_time >= ?')
+            params.append(start_time.isoformat())
+        if end_time is not None:
+            sql.append('AND p.start_time < ?')
+            params.append(end_time.isoformat())
+        if product_type is not None:
+            sql.append('AND p.product_type = ?')
+            params.append(product_type)
+        if ids is not None:
+            # Filtered in SQL, so only the features of these products are decoded
+            sql.append('AND p.id IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(list(ids)))
+        sql.append('ORDER BY p.start_time')
+
+        prepared_aoi = self._prepared(aoi)
+        aoi_area = aoi.area
+
+        result = []
+        for rid, wkb, feature in self._con.execute(' '.join(sql), params):
+            footprint = self._footprint(rid, wkb)
+            if not prepared_aoi.intersects(footprint):
+                continue
+            overlap = 1.0 if prepared_aoi.within(footprint) else aoi.intersection(footprint).area / aoi_area
+            if overlap < min_overlap:
+                continue
+            result.append((json.loads(feature), overlap))
+        return result
+
+    def query_many(self, aois, start_time=None, end_time=None, **kwargs):
+        """
+        Run ProductCatalog.query for several AOIs
+        Args:
+            aois (dict[str, shapely geometry]): areas of interest by name
+            start_time (datetime.datetime, None): earliest sensing start time
+            end_time (datetime.datetime, None): latest sensing start time
+            **kwargs: passed on to ProductCatalog.query
+
+        Returns:
+            dict[str, list] with query results by AOI name
+        """
+        return {name: self.query(aoi, start_time, end_time, **kwargs) for name, aoi in aois.items()}
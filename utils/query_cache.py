@@ -0,0 +1,137 @@
+"""
+On-disk cache for EOData Finder queries.
+
+Query results for acquisition dates far enough back in time never change, so they are stored permanently once they were
+fetched after those dates had become final. Other results (also those fetched while their dates were still recent, which
+may be partial) are re-fetched when they are older than a time-to-live. In offline mode only the cache is used, which makes
+it possible to replay backfills and tests without access to the API.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CACHE_DIR = os.path.join(DIRNAME, '..', 'cache', 'finder_queries')
+
+
+class OfflineCacheMiss(RuntimeError):
+    """Raised when a query is not in the cache and the cache is in offline mode"""
+
+
+class QueryCache:
+    """
+    Persistent cache of Finder query results, stored as one JSON file per query.
+
+    Args:
+        cache_dir (str): Folder to store cached queries in
+        ttl (datetime.timedelta): How long results for recent dates are considered valid
+        immutable_after (datetime.timedelta): Results fetched more than this long after the end of the query are never
+            re-fetched
+        offline (bool): Only read from the cache, raise OfflineCacheMiss for uncached queries.
+            Defaults to the CREODIAS_OFFLINE environment variable.
+    """
+
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        ttl=datetime.timedelta(hours=3),
+        immutable_after=datetime.timedelta(days=7),
+        offline=None,
+    ):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.immutable_after = immutable_after
+        if offline is None:
+            offline = os.environ.get('CREODIAS_OFFLINE', '0').lower() in ('1', 'true', 'yes')
+        self.offline = offline
+
+    @staticmethod
+    def key(collection, start_date, end_date, geometry, status, endpoint=None, params=None):
+        """
+        Make a cache key from the query parameters
+        Args:
+            collection (str): the data collection
+            start_date (datetime.datetime, None): parsed start date
+            end_date (datetime.datetime, None): parsed end date (with time added)
+            geometry (str, None): area of interest as WKT
+            status (str, None): allowed online/offline statuses
+            endpoint (str, None): Finder API url
+            params (dict, None): additional query parameters
+
+        Returns:
+            (str) hex digest identifying the query
+        """
+        request = {
+            'collection': collection,
+            'start_date': start_date.isoformat() if start_date is not None else None,
+            'end_date': end_date.isoformat() if end_date is not None else None,
+            'geometry': geometry,
+            'status': status,
+            'endpoint': endpoint,
+            'kwargs': {k: str(v) for k, v in sorted((params or {}).items())},
+        }
+        return hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def is_immutable(self, end_date, fetched):
+        """
+        Results fetched at least immutable_after after the end of the query are considered final. Results fetched
+        earlier may miss products that were published later.
+        """
+        if end_date is None:
+            return False
+        if end_date.tzinfo is None:
+            end_date = end_date.replace(tzinfo=datetime.timezone.utc)
+        return fetched >= end_date + self.immutable_after
+
+    def get(self, key, end_date=None):
+        """
+        Get cached query results
+        Args:
+            key (str): cache key from QueryCache.key
+            end_date (datetime.datetime, None): end date of query (used to decide if the results are final or the TTL
+                applies)
+
+        Returns:
+            dict[string, dict] with products, or None if the query is not cached or has expired
+        """
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            if self.offline:
+                raise OfflineCacheMiss('Query {} is not cached and the cache is in offline mode'.format(key))
+            return None
+
+        if self.offline:
+            return entry['products']
+
+        fetched = datetime.datetime.fromisoformat(entry['fetched'])
+        if self.is_immutable(end_date, fetched):
+            return entry['products']
+        if datetime.datetime.now(datetime.timezone.utc) - fetched > self.ttl:
+            return None
+        return entry['products']
+
+    def put(self, key, products):
+        """
+        Store query results in the cache
+        Args:
+            key (str): cache key from QueryCache.key
+            products (dict[string, dict]): products returned by the query
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            'fetched': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'products': products,
+        }
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
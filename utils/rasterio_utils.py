@@ -9,17 +9,18 @@ from rasterio.warp import reproject
 
 
 def crop_to_transform(src_img, src_transform, dst_transform, shape, src_crs=32633, dst_crs=32633, order=0):
+        from preprocess import resources
 
         return reproject(src_img.astype('float'), np.zeros(shape),
                   src_transform=src_transform,
                   dst_transform=dst_transform,
                   src_crs=CRS.from_epsg(src_crs),
                   dst_crs=CRS.from_epsg(dst_crs),
-                  num_threads=4,
+                  num_threads=resources.threads('mosaic'),
                   resampling=Resampling.nearest if order==0 else Resampling.bilinear)
 
 
-def to_tiff(filepath, data, transform, no_data_val=None, crs=32633):
+def to_tiff(filepath, data, transform, no_data_val=None, crs=32633, tags=None):
     """
     Writes data to a tiff-file
     Args:
@@ -28,6 +29,7 @@ def to_tiff(filepath, data, transform, no_data_val=None, crs=32633):
         transform:
         no_data_val:
         crs:
+        tags (None, dict): metadata tags to store in the file
 
     """
     if len(data.shape) == 2:
@@ -48,15 +50,18 @@ def to_tiff(filepath, data, transform, no_data_val=None, crs=32633):
         nodata=no_data_val,
     ) as out_file:
         [out_file.write(data[:, :, i], 1 + i) for i in range(data.shape[2])]
+        if tags:
+            out_file.update_tags(**tags)
 
 
-def merge_tiff_files(in_files, out_file, no_data_val=None):
+def merge_tiff_files(in_files, out_file, no_data_val=None, tags=None):
     """
     Merge files into one
     Args:
         in_files: list of file paths of files to merge
         out_file: path of out file
         no_data_val:
+        tags (None, dict): metadata tags to store in the out file
 
     Returns:
         merged image
@@ -85,5 +90,103 @@ def merge_tiff_files(in_files, out_file, no_data_val=None):
             **out_meta,
         ) as dest:
             dest.write(mosaic)
+            if tags:
+                dest.update_tags(**tags)
+
+    return np.moveaxis(mosaic, 0, -1)
+
+
+def is_aligned(in_files):
+    """
+    Check if open rasters share crs, resolution and pixel lattice (as outputs on the fixed tiling grid do)
+    Args:
+        in_files: list of open rasterio datasets
+
+    Returns:
+        (bool)
+    """
+    ref = in_files[0]
+    res_x, res_y = ref.transform.a, ref.transform.e
+    for f in in_files:
+        t = f.transform
+        if f.crs != ref.crs or f.count != ref.count or f.dtypes != ref.dtypes:
+            return False
+        if (t.a, t.e, t.b, t.d) != (res_x, res_y, ref.transform.b, ref.transform.d):
+            return False
+        offset_x = (t.c - ref.transform.c) / res_x
+        offset_y = (t.f - ref.transform.f) / res_y
+        if abs(offset_x - round(offset_x)) > 1e-6 or abs(offset_y - round(offset_y)) > 1e-6:
+            return False
+    return True
+
+
+def merge_aligned_tiff_files(in_files, out_file, no_data_val=None, tags=None):
+    """
+    Merge files on a common pixel lattice by copying blocks at integer offsets (no resampling). The first valid value
+    is kept where files overlap, like merge_tiff_files. Falls back to merge_tiff_files for files that are not aligned.
+    Args:
+        in_files: list of file paths of files to merge
+        out_file: path of out file
+        no_data_val:
+        tags (None, dict): metadata tags to store in the out file
+
+    Returns:
+        merged image
+
+    """
+    srcs = [rasterio.open(p) for p in in_files]
+    try:
+        if not is_aligned(srcs):
+            print('Files are not on a common pixel lattice, merging with resampling')
+            return merge_tiff_files(in_files, out_file, no_data_val, tags)
+
+        ref = srcs[0]
+        res_x, res_y = ref.transform.a, -ref.transform.e
+        left = min(f.bounds.left for f in srcs)
+        top = max(f.bounds.top for f in srcs)
+        right = max(f.bounds.right for f in srcs)
+        bottom = min(f.bounds.bottom for f in srcs)
+        width = int(round((right - left) / res_x))
+        height = int(round((top - bottom) / res_y))
+        out_trans = rasterio.transform.from_origin(left, top, res_x, res_y)
+
+        fill = no_data_val if no_data_val is not None else 0
+        mosaic = np.full((ref.count, height, width), fill, dtype=ref.dtypes[0])
+        for f in srcs:
+            row = int(round((top - f.bounds.top) / res_y))
+            col = int(round((f.bounds.left - left) / res_x))
+            block = mosaic[:, row:row + f.height, col:col + f.width]
+            data = f.read()
+            src_nodata = f.nodata if f.nodata is not None else no_data_val
+            if no_data_val is None:
+                block[...] = data
+                continue
+            empty = block == no_data_val
+            if src_nodata is not None:
+                empty &= data != src_nodata
+            block[empty] = data[empty]
+        out_meta = ref.meta.copy()
+    finally:
+        [f.close() for f in srcs]
+
+    out_meta.update(
+        {
+            "driver": "GTiff",
+            "height": height,
+            "width": width,
+            "transform": out_trans,
+            "nodata": no_data_val,
+        }
+    )
+
+    if out_file is not None:
+        with rasterio.open(
+            out_file,
+            "w",
+            **out_meta,
+        ) as dest:
+            dest.write(mosaic)
+            if tags:
+                dest.update_tags(**tags)
 
     return np.moveaxis(mosaic, 0, -1)
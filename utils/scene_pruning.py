@@ -0,0 +1,152 @@
+"""
+Pruning of scenes that are not worth downloading.
+
+Scenes that are almost entirely cloudy, or acquired in polar night or with very low sun, give no usable snow cover
+estimates. Before download each scene gets a usefulness score: the fraction of its footprint where the sun is high enough,
+computed analytically from the sensing time, times the clear fraction from the catalog cloud cover. Scenes below the
+thresholds are dropped, and the score can be used to deprioritize the rest.
+"""
+import numpy as np
+from shapely.geometry import Point, shape
+from shapely.prepared import prep
+
+from utils.product_catalog import parse_product_title
+
+MAX_SOLAR_ZENITH = 85.0  # Degrees. Reflectances are unreliable with lower sun
+MAX_CLOUD_COVER = 95.0  # Percent
+MIN_SUNLIT_FRACTION = 0.05
+MIN_USEFULNESS = 0.02
+
+
+def solar_zenith(lat, lon, time):
+    """
+    Solar zenith angle from the NOAA general solar position equations (accurate to a fraction of a degree)
+    Args:
+        lat (np.array): latitudes in degrees
+        lon (np.array): longitudes in degrees
+        time (datetime.datetime): UTC time
+
+    Returns:
+        np.array with solar zenith angles in degrees
+    """
+    lat = np.radians(np.asarray(lat, dtype='float'))
+    lon = np.asarray(lon, dtype='float')
+
+    doy = time.timetuple().tm_yday
+    hour = time.hour + time.minute / 60 + time.second / 3600
+    gamma = 2 * np.pi / 365 * (doy - 1 + (hour - 12) / 24)
+
+    eqtime = 229.18 * (
+        0.000075
+        + 0.001868 * np.cos(gamma)
+        - 0.032077 * np.sin(gamma)
+        - 0.014615 * np.cos(2 * gamma)
+        - 0.040849 * np.sin(2 * gamma)
+    )
+    decl = (
+        0.006918
+        - 0.399912 * np.cos(gamma)
+        + 0.070257 * np.sin(gamma)
+        - 0.006758 * np.cos(2 * gamma)
+        + 0.000907 * np.sin(2 * gamma)
+        - 0.002697 * np.cos(3 * gamma)
+        + 0.00148 * np.sin(3 * gamma)
+    )
+
+    true_solar_time = hour * 60 + eqtime + 4 * lon  # Minutes
+    hour_angle = np.radians(true_solar_time / 4 - 180)
+
+    cos_zenith = np.sin(lat) * np.sin(decl) + np.cos(lat) * np.cos(decl) * np.cos(hour_angle)
+    return np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+
+
+def sample_footprint(footprint, n=20):
+    """
+    Sample points inside a footprint on a regular lon/lat grid (the polygon vertices are always included)
+    Args:
+        footprint (shapely geometry): footprint polygon
+        n (int): number of grid points along each axis of the bounding box
+
+    Returns:
+        (lats, lons) as np.arrays
+    """
+    minx, miny, maxx, maxy = footprint.bounds
+    lons, lats = np.meshgrid(np.linspace(minx, maxx, n), np.linspace(miny, maxy, n))
+    lons, lats = lons.ravel(), lats.ravel()
+
+    prepared = prep(footprint)
+    inside = np.array([prepared.contains(Point(x, y)) for x, y in zip(lons, lats)], dtype='bool')
+
+    polygons = getattr(footprint, 'geoms', [footprint])
+    vertices = np.concatenate([np.array(p.exterior.coords) for p in polygons], 0)
+    return (
+        np.concatenate([lats[inside], vertices[:, 1]]),
+        np.concatenate([lons[inside], vertices[:, 0]]),
+    )
+
+
+def scene_usefulness(scene, max_solar_zenith=MAX_SOLAR_ZENITH):
+    """
+    Estimate how useful a scene is before downloading it
+    Args:
+        scene (dict): Finder API feature
+        max_solar_zenith (float): highest solar zenith angle (degrees) considered usable
+
+    Returns:
+        dict with sunlit_fraction, cloud_cover (None if unknown) and usefulness (0-1)
+    """
+    meta = parse_product_title(scene['properties']['title'])
+    sensing_time = meta['start_time'] + (meta['end_time'] - meta['start_time']) / 2
+
+    lats, lons = sample_footprint(shape(scene['geometry']))
+    sza = solar_zenith(lats, lons, sensing_time)
+    sunlit_fraction = float(np.mean(sza <= max_solar_zenith))
+
+    cloud_cover = scene['properties'].get('cloudCover')
+    clear_fraction = 1.0 if cloud_cover is None else 1 - float(cloud_cover) / 100
+
+    return {
+        'sunlit_fraction': sunlit_fraction,
+        'cloud_cover': cloud_cover,
+        'usefulness': sunlit_fraction * clear_fraction,
+    }
+
+
+def prune_scenes(
+    scenes,
+    max_solar_zenith=MAX_SOLAR_ZENITH,
+    max_cloud_cover=MAX_CLOUD_COVER,
+    min_sunlit_fraction=MIN_SUNLIT_FRACTION,
+    min_usefulness=MIN_USEFULNESS,
+):
+    """
+    Drop scenes that are too cloudy or have too little sun
+    Args:
+        scenes (list of (feature, ...)): scenes as tuples with the Finder API feature first
+        max_solar_zenith (float): highest solar zenith angle (degrees) considered usable
+        max_cloud_cover (float): drop scenes with catalog cloud cover (percent) above this
+        min_sunlit_fraction (float): drop scenes where a smaller fraction of the footprint has usable sun
+        min_usefulness (float): drop scenes with lower usefulness score
+
+    Returns:
+        (kept scenes, pruned scenes, dict with usefulness by product id)
+    """
+    kept = []
+    pruned = []
+    usefulness = {}
+    for scene in scenes:
+        feature = scene[0]
+        try:
+            info = scene_usefulness(feature, max_solar_zenith)
+        except (IndexError, ValueError, KeyError):
+            # Can not assess the scene, keep it
+            kept.append(scene)
+            continue
+        usefulness[feature['id']] = info['usefulness']
+
+        cloudy = info['cloud_cover'] is not None and info['cloud_cover'] > max_cloud_cover
+        if cloudy or info['sunlit_fraction'] < min_sunlit_fraction or info['usefulness'] < min_usefulness:
+            pruned.append(scene)
+        else:
+            kept.append(scene)
+    return kept, pruned, usefulness
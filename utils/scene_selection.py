@@ -0,0 +1,167 @@
+"""
+Selection of a minimal set of scenes covering an AOI.
+
+Consecutive Sentinel-3 dumps overlap heavily, and the same acquisition is often delivered several times (NR, ST and NT
+timeliness, reprocessed baselines). Selecting every scene that overlaps the AOI therefore downloads, preprocesses and
+predicts much of the same area several times. The functions here first keep a single product per acquisition and then
+greedily pick scenes adding the most new AOI coverage until a target fraction of the achievable coverage is reached.
+"""
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from utils.product_catalog import parse_product_title
+
+# Preference of product timeliness (Non Time Critical > Short Time Critical > Near Real Time)
+TIMELINESS_WEIGHTS = {
+    'NT': 1.0,
+    'ST': 0.95,
+    'NR': 0.9,
+}
+
+
+class SelectionReport:
+    """
+    Summary of a scene selection
+    Args:
+        n_candidates (int): number of scenes passing the selection rule
+        n_unique (int): number of scenes after removing duplicate acquisitions
+        n_selected (int): number of selected scenes
+        candidate_coverage (float): fraction of the AOI covered by all candidates
+        selected_coverage (float): fraction of the AOI covered by the selected scenes
+        candidate_area (float): summed AOI overlap of all candidates (proportional to compute)
+        selected_area (float): summed AOI overlap of the selected scenes
+    """
+
+    def __init__(self, n_candidates, n_unique, n_selected, candidate_coverage, selected_coverage, candidate_area,
+                 selected_area):
+        self.n_candidates = n_candidates
+        self.n_unique = n_unique
+        self.n_selected = n_selected
+        self.candidate_coverage = candidate_coverage
+        self.selected_coverage = selected_coverage
+        self.candidate_area = candidate_area
+        self.selected_area = selected_area
+
+    @property
+    def scenes_saved(self):
+        return self.n_candidates - self.n_selected
+
+    @property
+    def compute_saved(self):
+        """Fraction of processed AOI area saved compared to processing every candidate"""
+        if self.candidate_area == 0:
+            return 0.0
+        return 1 - self.selected_area / self.candidate_area
+
+    def __str__(self):
+        return (
+            'Selected {} of {} scenes ({} unique acquisitions). '
+            'AOI coverage {:.1%} (all candidates: {:.1%}). Compute saved: {:.1%}'.format(
+                self.n_selected,
+                self.n_candidates,
+                self.n_unique,
+                self.selected_coverage,
+                self.candidate_coverage,
+                self.compute_saved,
+            )
+        )
+
+
+def _preference(title):
+    try:
+        meta = parse_product_title(title)
+    except (IndexError, ValueError):
+        return 0.0, ''
+    return TIMELINESS_WEIGHTS.get(meta['timeliness'], 0.5), meta['creation_time'].isoformat() + meta['baseline']
+
+
+def deduplicate_scenes(scenes):
+    """
+    Keep a single product per acquisition (platform and sensing start time). The product with best timeliness is kept,
+    and among those the most recently created.
+    Args:
+        scenes (list of (feature, ...)): scenes as tuples with the Finder API feature first
+
+    Returns:
+        list of scenes in the order of first occurrence
+    """
+    best = {}
+    order = []
+    for scene in scenes:
+        title = scene[0]['properties']['title']
+        try:
+            meta = parse_product_title(title)
+            acquisition = (meta['platform'], meta['start_time'])
+        except (IndexError, ValueError):
+            acquisition = title
+        if acquisition not in best:
+            order.append(acquisition)
+            best[acquisition] = scene
+        elif _preference(title) > _preference(best[acquisition][0]['properties']['title']):
+            best[acquisition] = scene
+    return [best[a] for a in order]
+
+
+def select_scenes(scenes, aoi, target_coverage=0.98, min_gain=0.005, weights=None):
+    """
+    Select a small set of scenes whose union covers the AOI
+    Args:
+        scenes (list of (feature, float)): candidate scenes as (Finder API feature, AOI overlap fraction)
+        aoi (shapely geometry): area of interest (lon/lat)
+        target_coverage (float): stop when this fraction of the coverage of all candidates is reached
+        min_gain (float): ignore scenes adding less than this fraction of the AOI
+        weights (dict[str, float], None): extra preference weight by product id, i.e. usefulness from
+            utils.scene_pruning
+
+    Returns:
+        (list of selected features, SelectionReport)
+    """
+    n_candidates = len(scenes)
+    unique = deduplicate_scenes(scenes)
+
+    aoi_area = aoi.area
+    parts = []
+    for feature, overlap in unique:
+        parts.append((feature, aoi.intersection(shape(feature['geometry'])), overlap))
+
+    candidate_union = unary_union([p[1] for p in parts]) if parts else None
+    candidate_coverage = candidate_union.area / aoi_area if parts else 0.0
+    candidate_area = sum(overlap for _, overlap in scenes)
+
+    selected = []
+    selected_area = 0.0
+    covered = None
+    remaining = list(parts)
+    while remaining:
+        coverage = covered.area / aoi_area if covered is not None else 0.0
+        if coverage >= target_coverage * candidate_coverage:
+            break
+
+        def score(part):
+            feature, geom, overlap = part
+            gain = (geom.difference(covered).area if covered is not None else geom.area) / aoi_area
+            weight, _ = _preference(feature['properties']['title'])
+            if weights is not None:
+                weight *= weights.get(feature['id'], 1.0)
+            return gain * weight, gain, overlap
+
+        scores = [score(p) for p in remaining]
+        best = max(range(len(remaining)), key=lambda i: (scores[i][0], scores[i][2]))
+        if scores[best][1] < min_gain:
+            break
+
+        feature, geom, overlap = remaining.pop(best)
+        selected.append(feature)
+        selected_area += overlap
+        covered = geom if covered is None else covered.union(geom)
+
+    report = SelectionReport(
+        n_candidates=n_candidates,
+        n_unique=len(unique),
+        n_selected=len(selected),
+        candidate_coverage=candidate_coverage,
+        selected_coverage=covered.area / aoi_area if covered is not None else 0.0,
+        candidate_area=candidate_area,
+        selected_area=selected_area,
+    )
+    return selected, report
@@ -0,0 +1,190 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.tiled_prediction import (
+    _cut_patch,
+    _insert_patch,
+    gpu_no_of_var,
+    np_to_var,
+    patch_origins,
+    tiled_prediction,
+    var_to_np,
+)
+
+
+class _Scene:
+    def __init__(self, key, data, n_tiles):
+        self.key = key
+        self.data = data
+        self.pending = n_tiles
+        self.output = None
+        self.submitted = time.time()
+
+
+class TileScheduler:
+    """
+    Runs a segmentation network over patches from several images, packing them into full batches.
+
+    Each image is cut into patches like in tiled_prediction (mosaicing). Patches are queued across images, and the
+    network is run whenever a full batch is available, so small images (or the last patches of an image) share a batch
+    with the next image instead of running a partially filled one. Images smaller than a patch in both dimensions are
+    run whole and on their own, like in tiled_prediction, so all entry points give the same output. The output of a
+    patch is inserted in the output of its own image, which is returned when all its patches are predicted.
+
+    Usage:
+        scheduler = TileScheduler(net, [512, 512], [128, 128])
+        for key, data in images:
+            for key, prediction in scheduler.submit(key, data):
+                ...
+        for key, prediction in scheduler.flush():
+            ...
+        scheduler.report()
+    """
+
+    def __init__(
+        self,
+        net,
+        patch_size=(512, 512),
+        patch_overlap=(128, 128),
+        batch_size=8,
+        apply_softmax=False,
+        precision="float",
+    ):
+        """
+        Args:
+            net (torch.nn.Module): A pytorch segmentation model (input size must be equal to output size)
+            patch_size ([int,int]): Size of patches
+            patch_overlap ([int,int]): How much overlap there should be between patches
+            batch_size (int): number of patches pr batch
+            apply_softmax (bool): Apply softmax across of ouput channels
+            precision (str): 'half' or 'float'
+        """
+        if type(patch_size) == int:
+            patch_size = [patch_size, patch_size]
+        if type(patch_overlap) == int:
+            patch_overlap = [patch_overlap, patch_overlap]
+        self.net = net
+        self.patch_size = list(patch_size)
+        self.patch_overlap = list(patch_overlap)
+        self.batch_size = batch_size
+        self.apply_softmax = apply_softmax
+        self.precision = precision
+
+        self._queue = []
+        self._finished = []
+        self.batch_tiles = []
+        self.latency = {}
+
+    def submit(self, key, data):
+        """
+        Queue the patches of an image and run all full batches
+        Args:
+            key: Identifier of the image, returned with its prediction
+            data (np.array): The image (np.array 2D (single channel) or 3D (multiple channels))
+
+        Returns:
+            list of (key, prediction) for the images that are completed
+        """
+        if len(data.shape) == 2:
+            data = np.expand_dims(data, -1)
+        if np.all([data.shape[i] < self.patch_size[i] for i in range(2)]):
+            # Same whole image branch as tiled_prediction
+            submitted = time.time()
+            output = tiled_prediction(
+                data,
+                self.net,
+                self.patch_size,
+                self.patch_overlap,
+                apply_softmax=self.apply_softmax,
+                precision=self.precision,
+            )
+            self.latency[key] = time.time() - submitted
+            self._finished.append((key, output))
+            return self.pop_finished()
+        rows, cols = patch_origins(data.shape, self.patch_size, self.patch_overlap)
+        scene = _Scene(key, data, len(rows) * len(cols))
+        self._queue.extend((scene, x0, x1) for x0 in rows for x1 in cols)
+
+        while len(self._queue) >= self.batch_size:
+            self._run_batch()
+        return self.pop_finished()
+
+    def flush(self):
+        """
+        Run the remaining patches (the last batch may be partially filled)
+        Returns:
+            list of (key, prediction) for the images that are completed
+        """
+        while len(self._queue) > 0:
+            self._run_batch()
+        return self.pop_finished()
+
+    def pop_finished(self):
+        finished, self._finished = self._finished, []
+        return finished
+
+    def _run_batch(self):
+        batch, self._queue = self._queue[: self.batch_size], self._queue[self.batch_size :]
+        patches = [
+            _cut_patch(scene.data, x0, x1, self.patch_size, self.patch_overlap)
+            for scene, x0, x1 in batch
+        ]
+
+        # Run it through model
+        with torch.no_grad():
+            batched_data = np.moveaxis(np.stack([p[0] for p in patches], 0), -1, 1)
+            batched_data = np_to_var(batched_data, gpu_no_of_var(self.net))
+            batched_data = (
+                batched_data.float() if self.precision == "float" else batched_data.half()
+            )
+            out_patches_torch = self.net(batched_data)
+            if self.apply_softmax:
+                out_patches_torch = F.softmax(out_patches_torch, dim=1)
+
+        out_patches = np.moveaxis(var_to_np(out_patches_torch), 1, -1)
+        del out_patches_torch  # Make sure output is flushed from GPU
+        self.batch_tiles.append(len(batch))
+
+        for (scene, x0, x1), (_, pad_val_0, pad_val_1), out_patch in zip(batch, patches, out_patches):
+            if scene.output is None:
+                scene.output = np.zeros(
+                    scene.data.shape[:2] + (out_patch.shape[2],),
+                    dtype=np.result_type(scene.data.dtype, out_patch.dtype),
+                )
+            _insert_patch(
+                scene.output,
+                out_patch,
+                x0,
+                x1,
+                pad_val_0,
+                pad_val_1,
+                self.patch_size,
+                self.patch_overlap,
+            )
+            scene.pending -= 1
+            if scene.pending == 0:
+                self.latency[scene.key] = time.time() - scene.submitted
+                self._finished.append((scene.key, scene.output))
+                scene.data = None
+
+    @property
+    def occupancy(self):
+        """Mean fraction of the batch size used by the batches run so far"""
+        if len(self.batch_tiles) == 0:
+            return 0.0
+        return float(np.mean(self.batch_tiles)) / self.batch_size
+
+    def report(self):
+        """
+        Print batch occupancy and per image latency (from submit until the last patch is predicted)
+        """
+        print(
+            'Ran {} tiles in {} batches of {}, occupancy {:.0%}'.format(
+                sum(self.batch_tiles), len(self.batch_tiles), self.batch_size, self.occupancy
+            )
+        )
+        for key, seconds in self.latency.items():
+            print('{}: {:.2f} s'.format(key, seconds))
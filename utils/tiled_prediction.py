@@ -56,12 +56,8 @@ def tiled_prediction(
     ####### Process entire image in one go (and avoid overhead with mosaicing)
     if patch_size is None or np.all([data.shape[i] < patch_size[i] for i in range(2)]):
 
-        # Compute required padding
-        ds = np.array(data.shape)
-        pad_val = (
-            (1 - (ds / make_input_divisable_with - ds // make_input_divisable_with))
-            * make_input_divisable_with
-        ).astype("int")
+        # Compute required padding (none if the size is already divisible)
+        pad_val = [(-data.shape[i]) % make_input_divisable_with for i in range(2)]
         data = np.pad(data, [[0, pad_val[0]], [0, pad_val[1]], [0, 0]], mode="constant")
 
         # Run through network
@@ -94,24 +90,11 @@ def tiled_prediction(
 
     ####### Or do mosaicing
 
-    # Add padding to avoid trouble when removing the overlap later
-    data = np.pad(
-        data,
-        [
-            [patch_overlap[0], patch_overlap[0]],
-            [patch_overlap[1], patch_overlap[1]],
-            [0, 0],
-        ],
-        "constant",
-    )
-
-    # Loop through patches identified by upper-left pixel
-    upper_left_x0 = np.arange(
-        0, data.shape[0] - patch_overlap[0], patch_size[0] - patch_overlap[0] * 2
-    )
-    upper_left_x1 = np.arange(
-        0, data.shape[1] - patch_overlap[1], patch_size[1] - patch_overlap[1] * 2
-    )
+    # The data is padded with patch_overlap zeros on all sides to avoid trouble when removing the overlap later.
+    # Patches are cut from the unpadded data instead of padding the whole image, so a (memory-mapped) input is
+    # never copied in full.
+    # Loop through patches identified by upper-left pixel (in the padded image)
+    upper_left_x0, upper_left_x1 = patch_origins(data.shape, patch_size, patch_overlap)
 
     predictions = []
 
@@ -123,22 +106,10 @@ def tiled_prediction(
 
     for x0 in upper_left_x0:
         for x1 in upper_left_x1:
-            # Cut out a small patch of the data
-            data_patch = data[x0 : x0 + patch_size[0], x1 : x1 + patch_size[1], :]
-
-            # Pad with zeros if we are at the edges
-            pad_val_0 = patch_size[0] - data_patch.shape[0]
-            pad_val_1 = patch_size[1] - data_patch.shape[1]
-
-            if pad_val_0 > 0:
-                data_patch = np.pad(
-                    data_patch, [[0, pad_val_0], [0, 0], [0, 0]], "constant"
-                )
-
-            if pad_val_1 > 0:
-                data_patch = np.pad(
-                    data_patch, [[0, 0], [0, pad_val_1], [0, 0]], "constant"
-                )
+            # Cut out a small patch of the data, padded with zeros if we are at the edges
+            data_patch, pad_val_0, pad_val_1 = _cut_patch(
+                data, x0, x1, patch_size, patch_overlap
+            )
 
             # Add to batch:
             batched_data.append(data_patch)
@@ -177,42 +148,23 @@ def tiled_prediction(
 
                 # Make output array (We do this here since it will then be agnostic to the number of output channels)
                 if len(predictions) == 0:
-                    predictions = np.concatenate(
-                        [
-                            data[
-                                : -(patch_overlap[0] * 2),
-                                : -(patch_overlap[1] * 2),
-                                0:1,
-                            ]
-                            * 0
-                        ]
-                        * out_patches[0].shape[2],
-                        -1,
+                    predictions = np.zeros(
+                        data.shape[:2] + (out_patches[0].shape[2],),
+                        dtype=np.result_type(data.dtype, out_patches[0].dtype),
                     )
 
                 # Loop through samples in batch
                 for i in range(len(batched_data)):
-
-                    # Remove eventual padding related to edges
-                    out_patch = out_patches[i][
-                        0 : patch_size[0] - batched_pad_val_0[i],
-                        0 : patch_size[1] - batched_pad_val_1[i],
-                        :,
-                    ]
-
-                    # Remove eventual padding related to overlap between data_patches
-                    out_patch = out_patch[
-                        patch_overlap[0] : -patch_overlap[0],
-                        patch_overlap[1] : -patch_overlap[1],
-                        :,
-                    ]
-
-                    # Insert output_patch in out array
-                    predictions[
-                        batched_x0[i] : batched_x0[i] + out_patch.shape[0],
-                        batched_x1[i] : batched_x1[i] + out_patch.shape[1],
-                        :,
-                    ] = out_patch
+                    _insert_patch(
+                        predictions,
+                        out_patches[i],
+                        batched_x0[i],
+                        batched_x1[i],
+                        batched_pad_val_0[i],
+                        batched_pad_val_1[i],
+                        patch_size,
+                        patch_overlap,
+                    )
 
                 # Empty batch-lists
                 batched_data = []
@@ -224,6 +176,212 @@ def tiled_prediction(
     return predictions
 
 
+def tiled_prediction_dask(
+    data,
+    net,
+    patch_size=(512, 512),
+    patch_overlap=(128, 128),
+    n_classes=1,
+    tiles_per_chunk=2,
+    batch_size=8,
+    precision="float",
+):
+    """
+    Lazy version of tiled_prediction for a dask array.
+
+    The image is chunked in tiles_per_chunk x tiles_per_chunk patch centres (patch_size - 2 * patch_overlap), and each
+    chunk gets a halo of patch_overlap pixels from its neighbours (zeros at the image edges) with dask.array.overlap. The
+    halo should cover the receptive field of the network. The patches of a chunk are cut from the chunk and its halo, so
+    they see the same data as in tiled_prediction and the output is the same. Each chunk is predicted in one task, by
+    whatever dask scheduler is configured. Images smaller than a patch in both dimensions are predicted whole in one
+    task, like in tiled_prediction.
+    Args:
+        data (dask.array.Array): The large image, H x W x C, with a single chunk along the channels
+        net (torch.nn.Module): A pytorch segmentation model (input size must be equal to output size)
+        patch_size ([int,int]): Size of patches
+        patch_overlap ([int,int]): How much overlap there should be between patches (the halo of the chunks)
+        n_classes (int): Number of output channels of the network
+        tiles_per_chunk (int): Patches along each side of a chunk
+        batch_size(int): number of samples pr batch
+        precision (str): 'half' or 'float'
+
+    Returns:
+        Predictions for large image (lazy dask.array.Array H x W x n_classes, float32)
+    """
+    import dask.array as da
+    from dask.base import tokenize
+
+    if type(patch_size) == int:
+        patch_size = [patch_size, patch_size]
+    if type(patch_overlap) == int:
+        patch_overlap = [patch_overlap, patch_overlap]
+    patch_size, patch_overlap = list(patch_size), list(patch_overlap)
+    step = [patch_size[i] - 2 * patch_overlap[i] for i in range(2)]
+    if data.ndim == 2:
+        data = data[:, :, None]
+    shape = data.shape
+
+    if all(shape[i] < patch_size[i] for i in range(2)):
+        data = data.rechunk(-1)
+        return data.map_blocks(
+            _predict_whole,
+            net,
+            precision,
+            dtype="float32",
+            chunks=data.chunks[:2] + ((n_classes,),),
+            name="tiled-prediction-" + tokenize(data.name, id(net), precision),
+        )
+
+    # Pad to whole patch centres, so every chunk starts at a patch and is at least as large as the halo
+    pad_val = [(-shape[i]) % step[i] for i in range(2)]
+    data = da.pad(data, [[0, pad_val[0]], [0, pad_val[1]], [0, 0]], mode="constant")
+    data = data.rechunk((step[0] * tiles_per_chunk, step[1] * tiles_per_chunk, -1))
+    halo = da.overlap.overlap(
+        data,
+        depth={0: patch_overlap[0], 1: patch_overlap[1], 2: 0},
+        boundary={0: 0, 1: 0, 2: "none"},
+    )
+    output = halo.map_blocks(
+        _predict_block,
+        net,
+        patch_size,
+        patch_overlap,
+        batch_size,
+        precision,
+        dtype="float32",
+        chunks=data.chunks[:2] + ((n_classes,),),
+        # Tokenizing the network would hash all its weights
+        name="tiled-prediction-" + tokenize(halo.name, id(net), patch_size, patch_overlap, precision),
+    )
+    return output[: shape[0], : shape[1]]
+
+
+def _predict_whole(block, net, precision):
+    """
+    Predict a whole image in one go (see tiled_prediction)
+    Returns:
+        Predictions for the image (np.array H x W x C, float32)
+    """
+    return tiled_prediction(block, net, precision=precision).astype(np.float32, copy=False)
+
+
+def _predict_block(block, net, patch_size, patch_overlap, batch_size, precision):
+    """
+    Predict a chunk with a halo of patch_overlap pixels on all sides (see tiled_prediction_dask)
+    Returns:
+        Predictions for the chunk without halo (np.array H x W x C, float32)
+    """
+    step = [patch_size[i] - 2 * patch_overlap[i] for i in range(2)]
+    inner = [block.shape[i] - 2 * patch_overlap[i] for i in range(2)]
+    origins = [(x0, x1) for x0 in range(0, inner[0], step[0]) for x1 in range(0, inner[1], step[1])]
+    output = None
+    for b in range(0, len(origins), batch_size):
+        batch = origins[b : b + batch_size]
+        # The block is the padded image of tiled_prediction, cut patches starting at x0, x1 in it
+        patches = [
+            _cut_patch(block, x0 + patch_overlap[0], x1 + patch_overlap[1], patch_size, patch_overlap)[0]
+            for x0, x1 in batch
+        ]
+        with torch.no_grad():
+            batched_data = np_to_var(np.moveaxis(np.stack(patches, 0), -1, 1), gpu_no_of_var(net))
+            batched_data = batched_data.float() if precision == "float" else batched_data.half()
+            out_patches_torch = net(batched_data)
+        out_patches = np.moveaxis(var_to_np(out_patches_torch), 1, -1)
+        del out_patches_torch  # Make sure output is flushed from GPU
+
+        if output is None:
+            output = np.zeros(tuple(inner) + (out_patches.shape[-1],), dtype="float32")
+        for (x0, x1), out_patch in zip(batch, out_patches):
+            n0, n1 = min(step[0], inner[0] - x0), min(step[1], inner[1] - x1)
+            output[x0 : x0 + n0, x1 : x1 + n1] = out_patch[
+                patch_overlap[0] : patch_overlap[0] + n0, patch_overlap[1] : patch_overlap[1] + n1
+            ]
+    return output
+
+
+def patch_origins(shape, patch_size, patch_overlap):
+    """
+    Upper-left pixels of the patches covering an image, in the image padded with patch_overlap on all sides
+    Args:
+        shape (tuple): Shape of the (unpadded) image
+        patch_size ([int,int]): Size of patches
+        patch_overlap ([int,int]): How much overlap there should be between patches
+
+    Returns:
+        (rows, columns) - np.arrays of upper-left rows and columns
+    """
+    return [
+        np.arange(
+            0, shape[i] + patch_overlap[i], patch_size[i] - patch_overlap[i] * 2
+        )
+        for i in range(2)
+    ]
+
+
+def _insert_patch(predictions, out_patch, x0, x1, pad_val_0, pad_val_1, patch_size, patch_overlap):
+    """
+    Remove padding and overlap from a predicted patch and insert it in the output array
+    Args:
+        predictions (np.array): Output array (H x W x C)
+        out_patch (np.array): Predicted patch (patch_size x C)
+        x0 (int): Upper row of the patch in the padded image
+        x1 (int): Left column of the patch in the padded image
+        pad_val_0 (int): Rows of the patch beyond the padded image
+        pad_val_1 (int): Columns of the patch beyond the padded image
+        patch_size ([int,int]): Size of patches
+        patch_overlap ([int,int]): How much overlap there should be between patches
+    """
+    # Remove eventual padding related to edges
+    out_patch = out_patch[
+        0 : patch_size[0] - pad_val_0,
+        0 : patch_size[1] - pad_val_1,
+        :,
+    ]
+
+    # Remove eventual padding related to overlap between data_patches
+    out_patch = out_patch[
+        patch_overlap[0] : out_patch.shape[0] - patch_overlap[0],
+        patch_overlap[1] : out_patch.shape[1] - patch_overlap[1],
+        :,
+    ]
+
+    # Insert output_patch in out array
+    predictions[
+        x0 : x0 + out_patch.shape[0],
+        x1 : x1 + out_patch.shape[1],
+        :,
+    ] = out_patch
+
+
+def _cut_patch(data, x0, x1, patch_size, patch_overlap):
+    """
+    Cut a patch from data as if it was zero-padded with patch_overlap on all sides
+    Args:
+        data (np.array): The (unpadded) image, H x W x C
+        x0 (int): Upper row of the patch in the padded image
+        x1 (int): Left column of the patch in the padded image
+        patch_size ([int,int]): Size of patches
+        patch_overlap ([int,int]): Padding on each side
+
+    Returns:
+        (patch, pad_val_0, pad_val_1) - the patch (patch_size) and the number of rows/columns beyond the padded image
+    """
+    upper_left = [x0, x1]
+    patch = np.zeros(tuple(patch_size) + data.shape[2:], dtype=data.dtype)
+    src, dst, pad_vals = [], [], []
+    for i in range(2):
+        # Rows/columns inside the padded image
+        n = min(patch_size[i], data.shape[i] + 2 * patch_overlap[i] - upper_left[i])
+        pad_vals.append(patch_size[i] - n)
+        # ... and inside the data
+        start = upper_left[i] - patch_overlap[i]
+        lo, hi = max(start, 0), min(start + n, data.shape[i])
+        src.append(slice(lo, max(hi, lo)))
+        dst.append(slice(lo - start, max(hi, lo) - start))
+    patch[dst[0], dst[1]] = data[src[0], src[1]]
+    return patch, pad_vals[0], pad_vals[1]
+
+
 def put_on_gpu_like(cpu_var, gpu_var):
     """
     Take a variable and put on same gpu as gpu_var
@@ -0,0 +1,293 @@
+"""
+Work queue on a shared POSIX file system.
+
+Jobs are JSON files that move between the folders of the queue root:
+
+    pending/<job id>.json                 waiting for a worker
+    claimed/<job id>.<worker id>.json     being processed; the modification time is the last heartbeat
+    done/<job id>.json                    finished (with result)
+    failed/<job id>.json                  failed max_attempts times (with errors)
+
+All state changes are single rename() calls, which are atomic on POSIX file systems (including NFS), so two workers can
+never claim the same pending job. A worker holds a lease on its job for `lease` seconds after each heartbeat. If a worker
+dies, its lease runs out and reap() moves the job back to pending (or to failed after max_attempts).
+
+A worker that stalls for longer than its lease may find its job reclaimed by someone else. complete() then fails with
+LeaseLost and the result must be discarded, so a job is only ever completed once. Results should be written to a
+temporary location and only moved into place after complete() succeeds (or be idempotent). Leases are compared to
+the clocks of the nodes, so they must be much longer than the clock difference between them.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+STATES = ('pending', 'claimed', 'done', 'failed')
+
+
+class LeaseLost(Exception):
+    """The job was reclaimed by the queue (the lease ran out)"""
+
+
+def default_worker_id():
+    return '{}-{}'.format(socket.gethostname().replace('.', '_'), os.getpid())
+
+
+def _write_json(path, obj):
+    tmp_path = '{}.{}.tmp'.format(path, default_worker_id())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Job:
+    def __init__(self, queue, job_id, path, data):
+        self.queue = queue
+        self.id = job_id
+        self.path = path
+        self.data = data
+
+    @property
+    def payload(self):
+        return self.data['payload']
+
+    def heartbeat(self):
+        """
+        Renew the lease
+        Raises:
+            LeaseLost if the job was reclaimed
+        """
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            raise LeaseLost(self.id)
+
+    def complete(self, result=None):
+        self.queue.complete(self, result)
+
+    def fail(self, error):
+        self.queue.fail(self, error)
+
+
+class WorkQueue:
+    """
+    File based work queue
+    Args:
+        root (str): queue folder on the shared file system
+        lease (float): seconds a claim is valid after the last heartbeat
+        max_attempts (int): number of claims of a job before it is moved to failed
+    """
+
+    def __init__(self, root, lease=600.0, max_attempts=3):
+        self.root = root
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for state in STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    def _job_ids(self, state):
+        return [name.split('.')[0] for name in os.listdir(os.path.join(self.root, state)) if name.endswith('.json')]
+
+    def enqueue(self, job_id, payload):
+        """
+        Add a job, unless a job with the same id is already queued, running or finished
+        Args:
+            job_id (str): unique id of the job (letters, digits and underscores)
+            payload (dict): JSON serializable job description
+
+        Returns:
+            (bool) True if the job was added
+        """
+        if '.' in job_id or '/' in job_id:
+            raise ValueError('Job ids can not contain "." or "/": {}'.format(job_id))
+        if any(job_id in self._job_ids(state) for state in ('claimed', 'done', 'failed')):
+            return False
+        tmp_path = self._path('pending', '{}.{}.tmp'.format(job_id, default_worker_id()))
+        _write_json(tmp_path, {'id': job_id, 'payload': payload, 'attempts': 0, 'errors': []})
+        try:
+            # link() fails if the job exists, which rename() would silently overwrite
+            os.link(tmp_path, self._path('pending', job_id + '.json'))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def claim(self, worker_id=None):
+        """
+        Claim a pending job
+        Args:
+            worker_id (None, str): id of the worker (host and process id if None)
+
+        Returns:
+            (Job) or None if there are no pending jobs
+        """
+        worker_id = worker_id or default_worker_id()
+        if '.' in worker_id or '/' in worker_id:
+            raise ValueError('Worker ids can not contain "." or "/": {}'.format(worker_id))
+        job_ids = self._job_ids('pending')
+        random.shuffle(job_ids)  # Less contention between workers
+        for job_id in job_ids:
+            pending = self._path('pending', job_id + '.json')
+            path = self._path('claimed', '{}.{}.json'.format(job_id, worker_id))
+            try:
+                # Start the lease before the job appears in claimed, so it is not reaped right away
+                os.utime(pending)
+                os.rename(pending, path)
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+            with open(path) as f:
+                data = json.load(f)
+            return Job(self, job_id, path, data)
+        return None
+
+    def complete(self, job, result=None):
+        """
+        Mark a claimed job as done
+        Raises:
+            LeaseLost if the job was reclaimed, the result must then be discarded
+        """
+        # Take the job out of claimed first, so it can not be reaped while the result is written
+        committing = self._path('claimed', '{}.commit'.format(os.path.basename(job.path)))
+        try:
+            # rename() keeps the modification time, renew it so the commit is not taken as stale
+            os.utime(job.path)
+            os.rename(job.path, committing)
+        except FileNotFoundError:
+            raise LeaseLost(job.id)
+        _write_json(committing, dict(job.data, result=result, worker=os.path.basename(job.path).split('.')[1]))
+        os.rename(committing, self._path('done', job.id + '.json'))
+
+    def fail(self, job, error):
+        """
+        Give up a claimed job. It is retried until it has been claimed max_attempts times.
+        Raises:
+            LeaseLost if the job was reclaimed
+        """
+        self._release(job.path, job.data, error, LeaseLost(job.id))
+
+    def _release(self, path, data, error, lost):
+        releasing = path + '.release'
+        try:
+            os.utime(path)
+            os.rename(path, releasing)
+        except FileNotFoundError:
+            if lost is not None:
+                raise lost
+            return False
+        data = dict(data, attempts=data['attempts'] + 1, errors=data['errors'] + [str(error)])
+        _write_json(releasing, data)
+        state = 'failed' if data['attempts'] >= self.max_attempts else 'pending'
+        os.rename(releasing, self._path(state, data['id'] + '.json'))
+        return True
+
+    def reap(self):
+        """
+        Move jobs with expired leases back to pending (or to failed)
+        Returns:
+            (list) ids of reclaimed jobs
+        """
+        reaped = []
+        now = time.time()
+        folder = os.path.join(self.root, 'claimed')
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                if name.endswith('.tmp') or os.path.getmtime(path) + self.lease >= now:
+                    continue
+                with open(path) as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue  # Completed, released or being written meanwhile
+
+            try:
+                if name.endswith('.commit') and 'result' in data:
+                    # The worker died after writing the result, but before moving it to done
+                    os.rename(path, self._path('done', data['id'] + '.json'))
+                    continue
+                for suffix in ('.commit', '.release'):
+                    # The worker died while completing or releasing the job
+                    if name.endswith(suffix):
+                        os.rename(path, path[:-len(suffix)])
+                        path = path[:-len(suffix)]
+            except FileNotFoundError:
+                continue  # Handled by another worker
+            if self._release(path, data, 'lease of {} expired'.format(name.split('.')[1]), None):
+                reaped.append(data['id'])
+        return reaped
+
+    def status(self):
+        """Number of jobs in each state"""
+        return {state: len(self._job_ids(state)) for state in STATES}
+
+    def results(self):
+        """Finished jobs as {job id: job data}"""
+        results = {}
+        for job_id in self._job_ids('done'):
+            with open(self._path('done', job_id + '.json')) as f:
+                results[job_id] = json.load(f)
+        return results
+
+
+def run_worker(queue, handler, worker_id=None, poll=10.0, heartbeat=None, exit_when_empty=False):
+    """
+    Claim and process jobs until the queue is empty (or forever)
+    Args:
+        queue (WorkQueue): queue
+        handler (callable): called with the job payload, returns a JSON serializable result
+        worker_id (None, str): id of the worker
+        poll (float): seconds to wait when there are no pending jobs
+        heartbeat (None, float): seconds between heartbeats (a quarter of the lease if None)
+        exit_when_empty (bool): return when no jobs are pending or running
+
+    Returns:
+        (int) number of jobs completed by this worker
+    """
+    heartbeat = heartbeat or queue.lease / 4
+    completed = 0
+    while True:
+        queue.reap()
+        job = queue.claim(worker_id)
+        if job is None:
+            if exit_when_empty and queue.status()['claimed'] == 0:
+                return completed
+            time.sleep(poll)
+            continue
+
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(heartbeat):
+                try:
+                    job.heartbeat()
+                except LeaseLost:
+                    return
+
+        beater = threading.Thread(target=beat, daemon=True)
+        beater.start()
+        try:
+            result = handler(job.payload)
+        except Exception as e:
+            stop.set()
+            print('Job {} failed: {!r}'.format(job.id, e))
+            try:
+                job.fail(repr(e))
+            except LeaseLost:
+                pass
+            continue
+        finally:
+            stop.set()
+            beater.join()
+
+        try:
+            job.complete(result)
+            completed += 1
+        except LeaseLost:
+            print('Lease of job {} was lost, discarding result'.format(job.id))
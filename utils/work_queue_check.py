@@ -0,0 +1,122 @@
+"""
+Multi-process check of utils.work_queue: lease expiry, reap() and LeaseLost.
+
+Worker processes claim jobs from a queue with a short lease. Some workers abandon a claimed job (as if they died), which
+reap() must move back to pending, and some stall past their lease without heartbeats, so their job may be reclaimed and
+complete() must fail with LeaseLost. At the end every job must be done exactly once, by the worker whose complete()
+succeeded.
+
+Usage:
+    python -m utils.work_queue_check --jobs 200 --processes 8 --lease 0.05
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.work_queue import LeaseLost, WorkQueue
+
+
+def _worker(root, lease, seed, abandon_rate, stall_rate):
+    """
+    Claim and complete jobs until the queue is empty, abandoning and stalling some of them
+    Returns:
+        (dict) worker id, ids of the jobs it completed, and counts of abandoned, lost and reaped jobs
+    """
+    queue = WorkQueue(root, lease=lease, max_attempts=1000)
+    rng = random.Random(seed)
+    worker_id = 'check{}_{}'.format(seed, os.getpid())
+    stats = {'worker': worker_id, 'completed': [], 'abandoned': 0, 'lost': 0, 'reaped': 0}
+    while True:
+        stats['reaped'] += len(queue.reap())
+        job = queue.claim(worker_id)
+        if job is None:
+            status = queue.status()
+            if status['pending'] == 0 and status['claimed'] == 0:
+                return stats
+            time.sleep(lease / 10)
+            continue
+        r = rng.random()
+        if r < abandon_rate:
+            # No heartbeat, release or completion, like a worker that died
+            stats['abandoned'] += 1
+            continue
+        time.sleep(lease * (2.0 if r < abandon_rate + stall_rate else rng.uniform(0.0, 0.2)))
+        try:
+            job.complete({'worker': worker_id})
+            stats['completed'].append(job.id)
+        except LeaseLost:
+            stats['lost'] += 1
+
+
+def check(root, jobs=200, processes=8, lease=0.05, abandon_rate=0.05, stall_rate=0.05):
+    """
+    Process a queue of jobs with several worker processes and check that each job was completed exactly once
+    Args:
+        root (str): empty queue folder
+        jobs (int): number of jobs
+        processes (int): number of worker processes
+        lease (float): lease in seconds
+        abandon_rate (float): fraction of claimed jobs the workers abandon
+        stall_rate (float): fraction of claimed jobs the workers stall on for twice the lease
+
+    Returns:
+        (dict) counts of abandoned, lost and reaped jobs, and (list) problems found (empty if the check passed)
+    """
+    queue = WorkQueue(root, lease=lease, max_attempts=1000)
+    for i in range(jobs):
+        queue.enqueue('job{:05d}'.format(i), {'index': i})
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [
+            pool.submit(_worker, root, lease, seed, abandon_rate, stall_rate) for seed in range(processes)
+        ]
+        workers = [future.result() for future in futures]
+
+    problems = []
+    completed = {}
+    for stats in workers:
+        for job_id in stats['completed']:
+            if job_id in completed:
+                problems.append('{} completed by both {} and {}'.format(job_id, completed[job_id], stats['worker']))
+            completed[job_id] = stats['worker']
+    results = queue.results()
+    expected = {'job{:05d}'.format(i) for i in range(jobs)}
+    if set(results) != expected:
+        problems.append('{} jobs done, {} expected'.format(len(results), jobs))
+    if set(completed) != expected:
+        problems.append('{} jobs completed by the workers, {} expected'.format(len(completed), jobs))
+    for job_id, data in results.items():
+        if job_id in completed and not (data['worker'] == data['result']['worker'] == completed[job_id]):
+            problems.append('{} done by {}, but completed by {}'.format(job_id, data['worker'], completed[job_id]))
+    status = queue.status()
+    if status['pending'] or status['claimed'] or status['failed']:
+        problems.append('Jobs left in the queue: {}'.format(status))
+
+    counts = {key: sum(stats[key] for stats in workers) for key in ('abandoned', 'lost', 'reaped')}
+    return counts, problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--lease', type=float, default=0.05, help='Lease in seconds')
+    parser.add_argument('--abandon-rate', type=float, default=0.05, help='Fraction of claimed jobs abandoned')
+    parser.add_argument('--stall-rate', type=float, default=0.05, help='Fraction of claimed jobs stalled on')
+    parser.add_argument('--root', default=None, help='Queue folder, i.e. on a shared file system (temporary if None)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.root) as root:
+        t0 = time.time()
+        counts, problems = check(
+            root, args.jobs, args.processes, args.lease, args.abandon_rate, args.stall_rate)
+        print('{} jobs with {} processes in {:.1f} s: {} abandoned, {} reaped, {} results discarded (LeaseLost)'.format(
+            args.jobs, args.processes, time.time() - t0, counts['abandoned'], counts['reaped'], counts['lost']))
+    for problem in problems:
+        print(problem)
+    print('FAILED' if problems else 'OK: every job was completed exactly once')
+    sys.exit(1 if problems else 0)